@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Time sound searches between the demo Latin texts.
+
+Ingests Vergil's Aeneid and Cicero's De Oratore from this directory (unless
+they are already in the database) and times sound searches between them, line
+against line.  Matches are collected as MatchBlock entities, as the search jobs
+save them, since this pair has too many matches to hold as Match entities.  The
+first repetition includes reading the units and computing frequencies; later
+repetitions are served from the local cache.
+"""
+
+import argparse
+import getpass
+import json
+import os
+import time
+import uuid
+
+from tesserae.db import TessMongoConnection, Text
+from tesserae.db.entities import Search
+from tesserae.matchers import SparseMatrixSearch
+from tesserae.matchers.text_options import TextOptions
+from tesserae.utils.ingest import already_ingested, ingest_text
+
+DEMO_DIR = os.path.dirname(os.path.abspath(__file__))
+# author, title, and whether the text is prose for the source and target
+# texts, which are listed in text_metadata.json
+DEMO_TEXTS = [('vergil', 'aeneid', False), ('cicero', 'de oratore', True)]
+
+
+def parse_args(args=None):
+    p = argparse.ArgumentParser(
+        prog='benchmark_sound',
+        description='Time sound searches between the demo Latin texts')
+
+    db = p.add_argument_group(title='database',
+                              description='database connection details')
+
+    db.add_argument('--user', type=str, help='user to access the database as')
+    db.add_argument('--password',
+                    action='store_true',
+                    help='pass to be prompted for a database password')
+    db.add_argument('--host',
+                    type=str,
+                    default='127.0.0.1',
+                    help='the host name or IP address of the MongoDB database')
+    db.add_argument('--port',
+                    type=int,
+                    default=27017,
+                    help='the port that the database listens on')
+    db.add_argument('--database',
+                    type=str,
+                    default='tess_benchmark',
+                    help='the name of the database to access')
+
+    p.add_argument('--repeat',
+                   type=int,
+                   default=3,
+                   help='number of times to run the search')
+
+    return p.parse_args(args)
+
+
+def load_demo_texts(connection):
+    """Ingest the source and target demo texts if necessary
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+
+    Returns
+    -------
+    source, target : tesserae.db.entities.Text
+    """
+    with open(os.path.join(DEMO_DIR, 'text_metadata.json')) as ifh:
+        metadata = json.load(ifh)
+    texts = []
+    for author, title, is_prose in DEMO_TEXTS:
+        found = [m for m in metadata
+                 if m['author'] == author and m['title'] == title][0]
+        text = Text(author=author,
+                    title=title,
+                    language=found['language'],
+                    year=found['year'],
+                    path=os.path.join(DEMO_DIR, found['path']),
+                    is_prose=is_prose)
+        if not already_ingested(connection, text):
+            ingest_text(connection, text)
+        texts.append(
+            connection.find(Text.collection, author=author, title=title)[0])
+    return texts
+
+
+def run_benchmark(connection, repeat=3):
+    """Time sound searches between the demo texts
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    repeat : int
+        number of times to run the search
+
+    Returns
+    -------
+    list of (float, int)
+        the seconds taken by each search and the number of matches it found
+    """
+    source, target = load_demo_texts(connection)
+    matcher = SparseMatrixSearch(connection)
+    timings = []
+    for _ in range(repeat):
+        search = Search(results_id=uuid.uuid4().hex)
+        connection.insert(search)
+        start = time.perf_counter()
+        count = 0
+        for blocks in matcher.match_batches(search,
+                                            TextOptions(source, 'line'),
+                                            TextOptions(target, 'line'),
+                                            'sound',
+                                            stopwords=10,
+                                            stopword_basis='texts',
+                                            score_basis='sound',
+                                            freq_basis='texts',
+                                            max_distance=999,
+                                            distance_basis='frequency',
+                                            min_score=0,
+                                            compact=True):
+            count += sum(block.count for block in blocks)
+        timings.append((time.perf_counter() - start, count))
+        connection.delete(search)
+    return timings
+
+
+def main():
+    """Time sound searches between the demo Latin texts"""
+    args = parse_args()
+    if args.password:
+        password = getpass.getpass(prompt='Tesserae MongoDB Password: ')
+    else:
+        password = None
+
+    connection = TessMongoConnection(args.host,
+                                     args.port,
+                                     args.user,
+                                     password,
+                                     db=args.database)
+    for i, (seconds, count) in enumerate(
+            run_benchmark(connection, args.repeat)):
+        print(f'run {i + 1}: {seconds:.2f} s, {count} matches')
+
+
+if __name__ == '__main__':
+    main()
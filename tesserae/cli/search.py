@@ -15,7 +15,8 @@ from tesserae.db.entities import Search
 from tesserae.matchers import SparseMatrixSearch
 from tesserae.matchers.text_options import TextOptions
 from tesserae.utils.search import \
-    check_cache, NORMAL_SEARCH, get_results, PageOptions, _run_search
+    check_cache, NORMAL_SEARCH, get_results, PageOptions, _run_search, \
+    _run_batch_search
 from tesserae.utils.stopwords import create_stoplist, get_stoplist_tokens
 
 
@@ -71,6 +72,19 @@ def parse_args(args=None):
                         type=str,
                         choices=['line', 'phrase'],
                         help='units to match on the target text')
+    search.add_argument('--batch-target',
+                        nargs=2,
+                        action='append',
+                        default=[],
+                        metavar=('AUTHOR', 'TITLE'),
+                        help=('another target text to match the source text '
+                              'against, using the same units; may be given '
+                              'more than once'))
+    search.add_argument('--intra-text',
+                        action='store_true',
+                        help=('search the source text against itself, matching '
+                              'each pair of distinct units once; the target '
+                              'text and units must be the same as the source'))
     search.add_argument('--feature',
                         type=str,
                         choices=['form', 'lemmata'],
@@ -105,6 +119,24 @@ def parse_args(args=None):
                         type=int,
                         default=0,
                         help='lowest scoring match to keep')
+    search.add_argument('--top-k',
+                        type=int,
+                        default=None,
+                        help=('keep only this many of the highest scoring '
+                              'matches'))
+    search.add_argument('--processes',
+                        type=int,
+                        default=1,
+                        help='number of processes to divide matching among')
+    search.add_argument('--memory-budget',
+                        type=int,
+                        default=None,
+                        help=('megabytes that matching a block of source units '
+                              'may use'))
+    search.add_argument('--compact-results',
+                        action='store_true',
+                        help=('store matches as compressed blocks instead of '
+                              'one database document per match'))
 
     search.add_argument('--output',
                         type=str,
@@ -114,7 +146,10 @@ def parse_args(args=None):
                         choices=['csv', 'json', 'tab', 'xml'],
                         help='format to write the results in')
 
-    return p.parse_args(args)
+    parsed = p.parse_args(args)
+    if parsed.intra_text and parsed.batch_target:
+        p.error('--intra-text cannot be combined with --batch-target')
+    return parsed
 
 
 def main():
@@ -137,12 +172,16 @@ def main():
                                               author=source_author,
                                               title=source_title)[0],
                          unit_type=args.source_unit)
-    target_author = args.target_author.lower().replace('_', ' ')
-    target_title = args.target_title.lower().replace('_', ' ')
-    target = TextOptions(text=connection.find('texts',
-                                              author=target_author,
-                                              title=target_title)[0],
-                         unit_type=args.target_unit)
+    targets = []
+    for author, title in [(args.target_author, args.target_title)] + \
+            args.batch_target:
+        target_author = author.lower().replace('_', ' ')
+        target_title = title.lower().replace('_', ' ')
+        targets.append(
+            TextOptions(text=connection.find('texts',
+                                             author=target_author,
+                                             title=target_title)[0],
+                        unit_type=args.target_unit))
 
     start = time.time()
     stopword_indices = create_stoplist(
@@ -151,72 +190,97 @@ def main():
         args.feature,
         source.text.language,
         basis='corpus' if args.stopword_basis == 'corpus' else
-        [source.text.id, target.text.id])
+        [source.text.id] + [target.text.id for target in targets])
     stopword_tokens = get_stoplist_tokens(connection, stopword_indices,
                                           args.feature, source.text.language)
-    parameters = {
-        'source': {
-            'object_id': str(source.text.id),
-            'units': source.unit_type
-        },
-        'target': {
-            'object_id': str(target.text.id),
-            'units': target.unit_type
-        },
-        'method': {
-            'name': SparseMatrixSearch.matcher_type,
-            'feature': args.feature,
-            'stopwords': stopword_tokens,
-            'score_basis': args.score_basis,
-            'freq_basis': args.freq_basis,
-            'max_distance': args.max_distance,
-            'distance_basis': args.distance_basis,
-            'min_score': args.min_score
-        }
+    source_params = {
+        'object_id': str(source.text.id),
+        'units': source.unit_type
     }
-    results_id = check_cache(connection, parameters['source'],
-                             parameters['target'], parameters['method'])
-    if results_id:
-        print('Cached results found.')
-        search = connection.find(Search.collection,
-                                 results_id=results_id,
-                                 search_type=NORMAL_SEARCH)[0]
-    else:
-        search = Search(results_id=uuid.uuid4().hex,
-                        search_type=NORMAL_SEARCH,
-                        parameters=parameters)
-        connection.insert(search)
+    method_params = {
+        'name': SparseMatrixSearch.matcher_type,
+        'feature': args.feature,
+        'stopwords': stopword_tokens,
+        'score_basis': args.score_basis,
+        'freq_basis': args.freq_basis,
+        'max_distance': args.max_distance,
+        'distance_basis': args.distance_basis,
+        'min_score': args.min_score,
+        'intra_text': args.intra_text,
+        'top_k': args.top_k
+    }
+    searches = []
+    uncached = []
+    for target in targets:
+        parameters = {
+            'source': source_params,
+            'target': {
+                'object_id': str(target.text.id),
+                'units': target.unit_type
+            },
+            'method': method_params
+        }
+        results_id = check_cache(connection, parameters['source'],
+                                 parameters['target'], parameters['method'])
+        if results_id:
+            print('Cached results found.')
+            search = connection.find(Search.collection,
+                                     results_id=results_id,
+                                     search_type=NORMAL_SEARCH)[0]
+        else:
+            search = Search(results_id=uuid.uuid4().hex,
+                            search_type=NORMAL_SEARCH,
+                            parameters=parameters)
+            connection.insert(search)
+            uncached.append((search, target))
+        searches.append(search)
+    if uncached:
         search_params = {
             'source': source,
-            'target': target,
-            'feature': parameters['method']['feature'],
-            'stopwords': parameters['method']['stopwords'],
-            'score_basis': parameters['method']['score_basis'],
-            'freq_basis': parameters['method']['freq_basis'],
-            'max_distance': parameters['method']['max_distance'],
-            'distance_basis': parameters['method']['distance_basis'],
-            'min_score': parameters['method']['min_score']
+            'feature': method_params['feature'],
+            'stopwords': method_params['stopwords'],
+            'score_basis': method_params['score_basis'],
+            'freq_basis': method_params['freq_basis'],
+            'max_distance': method_params['max_distance'],
+            'distance_basis': method_params['distance_basis'],
+            'min_score': method_params['min_score'],
+            'intra_text': method_params['intra_text'],
+            'top_k': method_params['top_k'],
+            'processes': args.processes,
+            'memory_budget': args.memory_budget * 1024 * 1024
+            if args.memory_budget is not None else None,
+            'compact': args.compact_results
         }
-        _run_search(connection, search, SparseMatrixSearch.matcher_type,
-                    search_params)
-    matches = get_results(
-        connection, search.id,
-        PageOptions(sort_by='score',
-                    sort_order='descending',
-                    per_page=10,
-                    page_number=0))
-    end = time.time() - start
-    matches.sort(key=lambda x: x['score'], reverse=True)
-    print(f'Search found {len(matches)} matches in {end}s.')
-    display_count = 10 if len(matches) >= 10 else len(matches)
-    print(f'The Top {display_count} Matches')
-    print('------------------')
-    print()
-    print("Result\tScore\tSource Locus\tTarget Locus\tShared")
-    for i, m in enumerate(matches[:10]):
-        shared = m['matched_features']
-        print(f'{i}.\t{m["score"]}\t{m["source_tag"]}\t{m["target_tag"]}\t'
-              f'{[t for t in shared]}')
+        if len(targets) == 1:
+            search_params['target'] = targets[0]
+            _run_search(connection, searches[0],
+                        SparseMatrixSearch.matcher_type, search_params)
+        else:
+            search_params['targets'] = [target for _, target in uncached]
+            _run_batch_search(connection, [search for search, _ in uncached],
+                              SparseMatrixSearch.matcher_type, search_params)
+    for search, target in zip(searches, targets):
+        matches = get_results(
+            connection, search.id,
+            PageOptions(sort_by='score',
+                        sort_order='descending',
+                        per_page=10,
+                        page_number=0))
+        end = time.time() - start
+        matches.sort(key=lambda x: x['score'], reverse=True)
+        if len(targets) > 1:
+            print(f'Target: {target.text.author}, {target.text.title}')
+        print(f'Search found {len(matches)} matches in {end}s.')
+        display_count = 10 if len(matches) >= 10 else len(matches)
+        print(f'The Top {display_count} Matches')
+        print('------------------')
+        print()
+        print("Result\tScore\tSource Locus\tTarget Locus\tShared")
+        for i, m in enumerate(matches[:10]):
+            shared = m['matched_features']
+            print(f'{i}.\t{m["score"]}\t{m["source_tag"]}\t'
+                  f'{m["target_tag"]}\t{[t for t in shared]}')
+        print()
 
 
 if __name__ == '__main__':
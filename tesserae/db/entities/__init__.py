@@ -1,6 +1,7 @@
 from .entity import Entity
 from .feature import Feature
 from .match import Match
+from .match_block import MatchBlock
 from .multiresult import MultiResult
 from .search import Search
 from .swlist import StopwordsList
@@ -11,6 +12,7 @@ from .unit import Unit
 entity_map = {}
 entity_map[Feature.collection] = Feature
 entity_map[Match.collection] = Match
+entity_map[MatchBlock.collection] = MatchBlock
 entity_map[MultiResult.collection] = MultiResult
 entity_map[Search.collection] = Search
 entity_map[StopwordsList.collection] = StopwordsList
@@ -18,5 +20,5 @@ entity_map[Text.collection] = Text
 entity_map[Token.collection] = Token
 entity_map[Unit.collection] = Unit
 
-__all__ = ['Entity', 'Feature', 'Match', 'MultiResult', 'Search',
-           'Text', 'Token', 'Unit']
+__all__ = ['Entity', 'Feature', 'Match', 'MatchBlock', 'MultiResult',
+           'Search', 'Text', 'Token', 'Unit']
@@ -0,0 +1,151 @@
+"""Database standardization for compactly stored text matches.
+
+Classes
+-------
+MatchBlock
+    A chunk of the matches of a search, stored as compressed columns.
+"""
+import io
+import typing
+
+from bson.objectid import ObjectId
+import numpy as np
+
+from tesserae.db.entities.entity import Entity
+
+
+class MatchBlock(Entity):
+    """A chunk of the matches of a search, stored as compressed columns
+
+    Rather than storing each match as its own document, with its snippets,
+    tags, and matched features spelled out, a MatchBlock stores only the
+    numbers needed to reconstruct its matches; the rest is looked up from the
+    Units and Features they refer to when the matches are retrieved.
+
+    Parameters
+    ----------
+    id : bson.objectid.ObjectId, optional
+        Database id of the block. Should not be set locally.
+    search_id : bson.objectid.ObjectId, optional
+        Database id of search to which these matches belong.
+    index : int, optional
+        Position of this block among the blocks of its search; matches are in
+        the order found when blocks are read in order of this index
+    count : int, optional
+        The number of matches in this block
+    max_score : float, optional
+        The highest score among the matches in this block
+    language : str, optional
+        Language of the features matched
+    feature : str, optional
+        Type of the features matched
+    scores : bytes, optional
+        Compressed array of the score of each match (see ``get_scores()``)
+    columns : bytes, optional
+        Compressed arrays describing each match (see ``get_columns()``)
+
+    """
+
+    collection = 'match_blocks'
+
+    def __init__(self, id=None, search_id=None, index=None, count=None,
+                 max_score=None, language=None, feature=None, scores=None,
+                 columns=None):
+        super().__init__(id=id)
+        self.search_id: typing.Optional[ObjectId] = search_id
+        self.index: typing.Optional[int] = index
+        self.count: typing.Optional[int] = count
+        self.max_score: typing.Optional[float] = max_score
+        self.language: typing.Optional[str] = language
+        self.feature: typing.Optional[str] = feature
+        self.scores: typing.Optional[bytes] = scores
+        self.columns: typing.Optional[bytes] = columns
+
+    @classmethod
+    def from_arrays(cls, search_id, index, language, feature, scores,
+                    columns):
+        """Create a MatchBlock holding the given arrays
+
+        Parameters
+        ----------
+        search_id : bson.objectid.ObjectId
+            Database id of search to which these matches belong
+        index : int
+            Position of this block among the blocks of its search
+        language : str
+            Language of the features matched
+        feature : str
+            Type of the features matched
+        scores : 1d np.array of floats
+            The score of each match
+        columns : dict[str, np.array]
+            Arrays describing each match:
+            'source_unit_ids', 'target_unit_ids' : 2d np.array of uint8
+                row i holds the 12 bytes of the ObjectId of the source or
+                target Unit of match i
+            'feature_breaks', 'feature_inds' : 1d np.array of ints
+                the slice ``feature_inds[feature_breaks[i]:feature_breaks[i+1]]``
+                holds the indices of the Features matched in match i
+            'highlight_breaks', 'source_positions', 'target_positions' : 1d
+            np.array of ints
+                the slice ``highlight_breaks[i]:highlight_breaks[i+1]`` of the
+                position arrays holds the matched token positions of match i
+
+        Returns
+        -------
+        MatchBlock
+        """
+        return cls(search_id=search_id,
+                   index=index,
+                   count=len(scores),
+                   max_score=float(scores.max()) if len(scores) else None,
+                   language=language,
+                   feature=feature,
+                   scores=_pack({'scores': scores}),
+                   columns=_pack(columns))
+
+    def get_scores(self):
+        """Decompress the score of each match
+
+        Returns
+        -------
+        1d np.array of floats
+        """
+        return _unpack(self.scores)['scores']
+
+    def get_columns(self):
+        """Decompress the arrays describing each match
+
+        Returns
+        -------
+        dict[str, np.array]
+            see ``from_arrays()``
+        """
+        return _unpack(self.columns)
+
+    def unique_values(self):
+        uniques = {
+            'search_id': self.search_id,
+            'index': self.index
+        }
+        return uniques
+
+    def __repr__(self):
+        return (
+            f'MatchBlock(search_id={self.search_id}, index={self.index}, '
+            f'count={self.count}, max_score={self.max_score}, '
+            f'language={self.language}, feature={self.feature})'
+        )
+
+
+def _pack(arrays):
+    """Compress named arrays into bytes"""
+    with io.BytesIO() as ofh:
+        np.savez_compressed(ofh, **arrays)
+        return ofh.getvalue()
+
+
+def _unpack(data):
+    """Decompress named arrays packed by ``_pack()``"""
+    with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+        return {name: archive[name] for name in archive.files}
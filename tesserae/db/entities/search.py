@@ -41,6 +41,11 @@ class Search(Entity):
         Further information associated with the status
     last_queried : datetime.datetime, optional
         Date information about last time this Search was queried
+    match_stats : dict, optional
+        Information about how the matching work was divided up, useful for
+        tuning deployments; for example, SparseMatrixSearch records the number
+        of source units in each block it matched and the largest number of
+        nonzeros in any block's match matrix
     """
 
     collection = 'searches'
@@ -52,7 +57,7 @@ class Search(Entity):
 
     def __init__(
         self, id=None, results_id=None, search_type=None, parameters=None,
-            progress=None, status=None, msg=None):
+            progress=None, status=None, msg=None, match_stats=None):
         super().__init__(id=id)
         self.results_id: typing.Optional[str] = results_id \
             if results_id is not None else ''
@@ -68,6 +73,8 @@ class Search(Entity):
         self.msg: typing.Optional[str] = msg \
             if msg is not None else ''
         self.last_queried: datetime.datetime = datetime.datetime.utcnow()
+        self.match_stats: typing.Mapping[typing.Any, typing.Any] = \
+            match_stats if match_stats is not None else {}
 
     def unique_values(self):
         uniques = {
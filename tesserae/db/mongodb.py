@@ -40,6 +40,11 @@ import six
 import tesserae.db.entities
 
 
+# number of entities whose unique values are looked up in a single query when
+# checking for existing entries on insert
+UNIQUE_CHECK_BATCH_SIZE = 10000
+
+
 # https://goshippo.com/blog/measure-real-size-any-python-object/
 def get_size(obj, seen=None):
     """Recursively finds size of objects"""
@@ -87,6 +92,30 @@ def _dot_notate(doc):
     return {k: v for k, v in zip(dotted_keys, dotted_vals)}
 
 
+def _get_field(doc, field):
+    """Look up a field of a document, given in MongoDB dot notation
+    """
+    for key in field.split('.'):
+        doc = doc[key]
+    return doc
+
+
+def _hashable(val):
+    """Recursive function to make a document value usable as a set member
+    """
+    if isinstance(val, Mapping):
+        return tuple(sorted((k, _hashable(v)) for k, v in val.items()))
+    if isinstance(val, (list, tuple)):
+        return tuple(_hashable(v) for v in val)
+    return val
+
+
+def _unique_key(entity):
+    """Build a hashable key from the unique values of an entity
+    """
+    return _hashable(entity.unique_values())
+
+
 class TessMongoConnection():
     """Connection to a MongoDB instance configured for Tesserae.
 
@@ -174,6 +203,90 @@ class TessMongoConnection():
 
         return result
 
+    def iter_aggregate(self, collection, pipeline, encode=True,
+                       batch_size=None):
+        """Execute a MongoDB aggregation pipeline, one result at a time.
+
+        Unlike ``aggregate()``, results are fetched from the database in
+        batches as the returned generator is consumed, so that they need not
+        all be held in memory at once.
+
+        Parameters
+        ----------
+        collection : str
+            The MongoDB collection to search.
+        pipeline : list of dict
+            The list of pipeline stage commands.
+        encode : bool
+            If True, encode each result as a tesserae.db.entities.Entity
+            instance as it is reached. Set to False if `pipeline` will return
+            documents that do not match any Entity.
+        batch_size : int, optional
+            The number of documents to fetch from the database at a time.
+
+        Yields
+        ------
+        tesserae.db.entities.Entity or dict
+            The documents returned from the database.
+        """
+        kwargs = {'allowDiskUse': True}
+        if batch_size is not None:
+            kwargs['batchSize'] = batch_size
+        cursor = self.connection[collection].aggregate(pipeline, **kwargs)
+        yield from self._iter_cursor(collection, cursor, encode)
+
+    def iter_find(self, collection, sort=None, projection=None,
+                  batch_size=None, encode=True, **filter_values):
+        """Retrieve database entries one at a time.
+
+        Unlike ``find()``, entries are fetched from the database in batches
+        as the returned generator is consumed, so that they need not all be
+        held in memory at once.
+
+        Parameters
+        ----------
+        collection : str
+            The MongoDB collection to search.
+        sort : list of (str, int), optional
+            The order in which to retrieve entries.
+        projection : list of str or dict, optional
+            The fields to retrieve; by default, all fields are retrieved.
+            Entities encoded from projected documents hold default values for
+            the fields that were not retrieved, so they must not be passed to
+            ``update()``.
+        batch_size : int, optional
+            The number of documents to fetch from the database at a time.
+        encode : bool
+            If True, encode each entry as a tesserae.db.entities.Entity
+            instance as it is reached; otherwise, yield the documents as they
+            are.
+        filter_values
+            Keyword arguments with values to filter the database query.
+
+        Yields
+        ------
+        tesserae.db.entities.Entity or dict
+            The documents returned from the database.
+        """
+        query_filter = self.create_filter(**filter_values)
+        cursor = self.connection[collection].find(query_filter,
+                                                  projection,
+                                                  sort=sort)
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+        yield from self._iter_cursor(collection, cursor, encode)
+
+    def _iter_cursor(self, collection, cursor, encode):
+        """Yield documents from a cursor, closing it when done"""
+        entity = None
+        if encode and collection in tesserae.db.entities.entity_map:
+            entity = tesserae.db.entities.entity_map[collection]
+        try:
+            for doc in cursor:
+                yield entity.json_decode(doc) if entity is not None else doc
+        finally:
+            cursor.close()
+
     def delete(self, entity):
         """Delete one or more entries from the database.
 
@@ -232,6 +345,9 @@ class TessMongoConnection():
     def insert(self, entity):
         """Insert one or more entities into the database.
 
+        Entities that already have an id are not inserted again if an entry
+        with the same unique values exists in the database.
+
         Parameters
         ----------
         entity : tesserae.db.entities.Entity or list of Entity
@@ -246,27 +362,16 @@ class TessMongoConnection():
         if not isinstance(entity, list):
             entity = [entity]
 
-        filter_vals = {}
-        for e in entity:
-            for k, v in e.unique_values().items():
-                if k in filter_vals:
-                    filter_vals[k].append(v)
-                else:
-                    filter_vals[k] = [v]
-
-        try:
-            exists = self.find(entity[0].collection, **filter_vals)
-        except IndexError:
-            exists = []
-
-        if len(exists) != 0:
-            exists = [e.unique_values() for e in exists]
-            new_ents = []
-            for e in entity:
-                if e.id is None or not any(
-                    [e.unique_values() == ex for ex in exists]):
-                    new_ents.append(e)
-            entity = new_ents
+        # only entities that already have an id are skipped when matching
+        # entries exist, so there is nothing to check if none have one
+        with_ids = [e for e in entity if e.id is not None]
+        if with_ids:
+            exists = self._find_unique_keys(with_ids)
+            if exists:
+                entity = [
+                    e for e in entity
+                    if e.id is None or _unique_key(e) not in exists
+                ]
 
         try:
             collection = self.connection[entity[0].__class__.collection]
@@ -279,7 +384,37 @@ class TessMongoConnection():
 
         return result
 
-    def update(self, entity):
+    def _find_unique_keys(self, entity):
+        """Find which entities' unique values already exist in the database.
+
+        Parameters
+        ----------
+        entity : list of tesserae.db.entities.Entity
+            The entities to look up; all must belong to the same collection.
+
+        Returns
+        -------
+        set of tuple
+            Unique keys (see ``_unique_key``) of the matching database
+            entries.
+        """
+        collection = entity[0].collection
+        fields = [k for k in entity[0].unique_values() if k != 'id']
+        exists = set()
+        for start in range(0, len(entity), UNIQUE_CHECK_BATCH_SIZE):
+            filter_vals = {}
+            for e in entity[start:start + UNIQUE_CHECK_BATCH_SIZE]:
+                for k, v in e.unique_values().items():
+                    if k in filter_vals:
+                        filter_vals[k].append(v)
+                    else:
+                        filter_vals[k] = [v]
+            exists.update(
+                _unique_key(e) for e in self.iter_find(
+                    collection, projection=fields, **filter_vals))
+        return exists
+
+    def update(self, entity, fields=None):
         """Update existing entries in the database.
 
         No updates are made unless all updates can be made.
@@ -291,11 +426,17 @@ class TessMongoConnection():
             by its 'id', and all other attributes and corresponding values of
             the given entity will be used to update the database with a
             matching 'id'.
+        fields : list of str, optional
+            If given, only these attributes of each entity are sent to the
+            database; fields of embedded documents may be named in MongoDB
+            dot notation (e.g., 'frequencies.<text id>').
 
         Raises
         ------
         ValueError
             Raised when an entity does not have an 'id'
+        KeyError
+            Raised when an entity does not have one of the given fields
         pymongo.errors.BulkWriteError
             Raised when provided entities could not be updated
 
@@ -313,10 +454,12 @@ class TessMongoConnection():
         no_ids = []
         for i, e in enumerate(entity):
             if e.id is not None:
+                doc = e.json_encode(exclude=['_id'])
+                if fields is not None:
+                    doc = {f: _get_field(doc, f) for f in fields}
                 bulk.append(
-                    pymongo.operations.UpdateOne(
-                        {'_id': e.id},
-                        {'$set': e.json_encode(exclude=['_id'])}))
+                    pymongo.operations.UpdateOne({'_id': e.id},
+                                                 {'$set': doc}))
             else:
                 no_ids.append(i)
         if no_ids:
@@ -499,6 +642,12 @@ class TessMongoConnection():
         ])
         self.connection[tesserae.db.entities.MultiResult.
                         collection].create_index('match_id')
+        # index MatchBlock entities by Search.id, in order
+        self.connection[tesserae.db.entities.MatchBlock.
+                        collection].create_index([
+                            ('search_id', pymongo.ASCENDING),
+                            ('index', pymongo.ASCENDING),
+                        ])
 
     def drop_indices(self):
         """Drops all indices
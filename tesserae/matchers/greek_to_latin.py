@@ -1,14 +1,18 @@
 """Match Greek units to Latin units"""
-from collections import defaultdict
+import hashlib
+import pickle
 
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, identity
 
 from tesserae.data import load_greek_to_latin
 from tesserae.db.entities import Feature, Match
 from tesserae.matchers.sparse_encoding import \
-    _get_units, _inverse_averaged_freq_getter, _lookup_wrapper, \
-    gen_hits2positions, _get_distance_by_span, _get_distance_by_least_frequency
+    _get_units, _inverse_averaged_freq_getter, _ArrayLookup, \
+    _gen_block_hits, _get_distance_by_span, \
+    _get_distance_by_least_frequency, _construct_unit_feature_matrix, \
+    _mask_columns
+from tesserae.utils.cache import clear_prefix, load_arrays, save_arrays
 from tesserae.utils.calculations import \
     get_corpus_frequencies, get_feature_counts_by_text, \
     get_inverse_text_frequencies
@@ -174,20 +178,15 @@ class GreekToLatinSearch:
         latin_stoplist_set = set(
             get_feature_indices(self.connection, 'latin', 'lemmata',
                                 latin_stopwords))
-        greek_features = self.connection.find(Feature.collection,
-                                              language='greek',
-                                              feature='lemmata')
-        greek_features.sort(key=lambda x: x.index)
         latin_features = self.connection.find(Feature.collection,
                                               language='latin',
                                               feature='lemmata')
         latin_features.sort(key=lambda x: x.index)
-        greek_ind_to_other_greek_inds = _build_greek_ind_to_other_greek_inds(
+        greek_synonym_matrix = get_greek_synonym_matrix(
             self.connection, self.greek_to_latin)
-        valid_latin_tokens_to_indices = {
-            f.token: f.index
-            for f in latin_features if f.index not in latin_stoplist_set
-        }
+        translation_matrix = _mask_columns(
+            get_translation_matrix(self.connection, self.greek_to_latin,
+                                   latin_features), latin_stoplist_set)
 
         greek_units = _get_units(self.connection, source, 'lemmata')
         latin_units = _get_units(self.connection, target, 'lemmata')
@@ -196,21 +195,26 @@ class GreekToLatinSearch:
 
         greek_inv_frequencies_getter = _get_inv_greek_to_latin_freq_getter(
             self.connection, freq_basis, source, greek_units,
-            greek_ind_to_other_greek_inds)
+            greek_synonym_matrix)
         latin_inv_frequencies_getter = _get_inv_lemmata_freq_getter(
             self.connection, freq_basis, target, latin_units)
 
         search_id = search.id
 
+        # matched features include the translations of Greek stopwords found
+        # at matched positions
+        all_latinized_greek_matrix, greek_break_inds = \
+            make_latinized_greek_matrix(greek_units, set(),
+                                        translation_matrix)
+
         match_ents = []
         numerator_sparse_rows = []
         numerator_sparse_cols = []
         numerator_sparse_data = []
         denominators = []
         for greek_ind, latin_ind, positions in _gen_greek_to_latin_matches(
-                search, self.connection, greek_units, greek_features,
-                greek_stoplist_set, self.greek_to_latin,
-                valid_latin_tokens_to_indices, latin_units, latin_features,
+                search, self.connection, greek_units, greek_stoplist_set,
+                translation_matrix, latin_units, latin_features,
                 latin_stoplist_set):
             greek_unit = greek_units[greek_ind]
             latin_unit = latin_units[latin_ind]
@@ -234,10 +238,8 @@ class GreekToLatinSearch:
             if distance <= max_distance:
                 matched_greek_to_latin_features = \
                     _get_matched_greek_to_latin_features(
-                        greek_unit['features'], greek_positions,
-                        greek_features, self.greek_to_latin,
-                        valid_latin_tokens_to_indices
-                    )
+                        all_latinized_greek_matrix,
+                        greek_break_inds[greek_ind] + greek_positions)
                 matched_latin_features = [
                     latin_unit['features'][latin_pos]
                     for latin_pos in latin_positions
@@ -288,32 +290,68 @@ class GreekToLatinSearch:
         return match_ents
 
 
-def _reverse_mapping(a2bs):
-    result = defaultdict(set)
-    for a, bs in a2bs.items():
-        for b in bs:
-            result[b].add(a)
-    return result
-
-
-def _build_greek_ind_to_other_greek_inds(conn, greek_to_latin):
-    greek_token_to_form = {
-        f.token: f
-        for f in conn.find(
-            Feature.collection, language='greek', feature='form')
-    }
-    latin_to_greek = _reverse_mapping(greek_to_latin)
-    result = defaultdict(set)
-    for greek_token, latin_translations in greek_to_latin.items():
-        if greek_token in greek_token_to_form:
-            other_greek_inds = set()
-            for latin_token in latin_translations:
-                for other_greek_token in latin_to_greek[latin_token]:
-                    if other_greek_token in greek_token_to_form:
-                        other_greek_inds.add(
-                            greek_token_to_form[other_greek_token].index)
-            result[greek_token_to_form[greek_token].index] = other_greek_inds
-    return result
+def _get_translation_digest(greek_to_latin):
+    """Identify the contents of a translation dictionary for cache keys"""
+    return hashlib.sha1(pickle.dumps(greek_to_latin, protocol=4)).hexdigest()
+
+
+def get_greek_synonym_matrix(conn, greek_to_latin):
+    """Retrieve the matrix relating Greek forms which share a translation
+
+    The matrix is cached on disk.  It is identified by the number of Greek
+    form features in the database, which changes exactly when ingesting a
+    Greek text adds new forms, along with a digest of ``greek_to_latin``;
+    earlier versions of the matrix are removed when a new one is cached.
+
+    Parameters
+    ----------
+    conn : TessMongoConnection
+    greek_to_latin : dict[str, list of str]
+        Greek lemmata mapped to their Latin translations; see
+        ``tesserae.data.load_greek_to_latin()``
+
+    Returns
+    -------
+    csr_matrix
+        if ``M[i, j] == True``, the Greek form with index i is the Greek form
+        with index j or shares at least one Latin translation with it
+    """
+    greek_forms_size = conn.connection[Feature.collection].count_documents({
+        'language': 'greek',
+        'feature': 'form'
+    })
+    shape = (greek_forms_size, greek_forms_size)
+    key = (f'greek_synonyms_{greek_forms_size}_'
+           f'{_get_translation_digest(greek_to_latin)}')
+    cached = load_arrays('translations', key)
+    if cached is not None:
+        indices = cached['indices']
+        return csr_matrix(
+            (np.ones(len(indices), dtype=np.bool), indices, cached['indptr']),
+            shape=shape)
+    latin_token_to_column = {}
+    greek_inds = []
+    latin_cols = []
+    for f in conn.find(Feature.collection, language='greek', feature='form'):
+        for latin_token in greek_to_latin.get(f.token, []):
+            greek_inds.append(f.index)
+            latin_cols.append(
+                latin_token_to_column.setdefault(latin_token,
+                                                 len(latin_token_to_column)))
+    # if greek_to_latin_matrix[i, j] == True, the Greek form with index i
+    # translates to the Latin token associated with column j
+    greek_to_latin_matrix = csr_matrix(
+        (np.ones(len(greek_inds), dtype=np.int32), (greek_inds, latin_cols)),
+        shape=(greek_forms_size, len(latin_token_to_column)))
+    matrix = (greek_to_latin_matrix @ greek_to_latin_matrix.T +
+              identity(greek_forms_size, dtype=np.int32, format='csr'))
+    matrix.sum_duplicates()
+    save_arrays('translations', key, {
+        'indptr': matrix.indptr,
+        'indices': matrix.indices
+    })
+    clear_prefix('translations', 'greek_synonyms_', keep=key)
+    return matrix.astype(np.bool)
 
 
 def _get_inv_lemmata_freq_getter(conn, freq_basis, text_options, latin_units):
@@ -321,114 +359,180 @@ def _get_inv_lemmata_freq_getter(conn, freq_basis, text_options, latin_units):
         return _inverse_averaged_freq_getter(
             get_corpus_frequencies(conn, 'lemmata',
                                    text_options.text.language), latin_units)
-    return _lookup_wrapper(
+    return _ArrayLookup(
         get_inverse_text_frequencies(conn, 'lemmata', text_options.text.id))
 
 
 def _get_greek_to_latin_inv_freqs_by_text(conn, text_options, text_length,
-                                          greek_ind_to_other_greek_inds):
+                                          greek_synonym_matrix):
+    """Compute inverse frequencies of Greek forms and their synonyms
+
+    Parameters
+    ----------
+    conn : TessMongoConnection
+    text_options : tesserae.matchers.text_options.TextOptions
+        the Greek text whose frequencies are computed
+    text_length : int
+        the number of tokens in the Greek text
+    greek_synonym_matrix : csr_matrix
+        see ``get_greek_synonym_matrix()``
+
+    Returns
+    -------
+    1d np.array of floats
+        index by Greek form index to obtain the number of tokens in the text
+        divided by the number of times that form or any of its synonyms
+        appear; 0 for forms that do not appear in the text
+    """
     greek_lemma_counts = get_feature_counts_by_text(conn, 'lemmata',
                                                     text_options.text)
-    result = {}
-    for greek_form_ind, greek_counts in greek_lemma_counts.items():
-        already_seen = set([greek_form_ind])
-        value = greek_counts
-        for other_greek_ind in greek_ind_to_other_greek_inds[greek_form_ind]:
-            if other_greek_ind in already_seen:
-                continue
-            value += greek_lemma_counts[other_greek_ind]
-            already_seen.add(other_greek_ind)
-        if value > 0:
-            result[greek_form_ind] = float(text_length) / float(value)
-    return result
+    greek_form_inds = np.flatnonzero(greek_lemma_counts)
+    counts = np.zeros(greek_synonym_matrix.shape[0])
+    counts[:len(greek_lemma_counts)] = greek_lemma_counts
+    values = greek_synonym_matrix[greek_form_inds].astype(
+        np.float64) @ counts
+    inv_freqs = np.zeros(greek_synonym_matrix.shape[0])
+    found = values > 0
+    inv_freqs[greek_form_inds[found]] = float(text_length) / values[found]
+    return inv_freqs
 
 
 def _get_inv_greek_to_latin_freq_getter(conn, freq_basis, text_options,
-                                        greek_units,
-                                        greek_ind_to_other_greek_inds):
+                                        greek_units, greek_synonym_matrix):
     if freq_basis != 'texts':
         return _inverse_averaged_freq_getter(
             get_corpus_frequencies(conn, 'lemmata',
                                    text_options.text.language), greek_units)
     # otherwise, handle text case
     text_length = sum(len(u['forms']) for u in greek_units)
-    return _lookup_wrapper(
+    return _ArrayLookup(
         _get_greek_to_latin_inv_freqs_by_text(conn, text_options, text_length,
-                                              greek_ind_to_other_greek_inds))
-
-
-def make_latinized_greek_matrix(greek_units, greek_features,
-                                greek_stoplist_set, greek_to_latin,
-                                valid_latin_tokens_to_indices,
-                                latin_features_size):
-    latin_feature_inds = []
-    pos_inds = []
-    break_inds = [0]
-    for unit in greek_units:
-        end_break_inds = break_inds[-1]
-        cur_features = unit['features']
-        for i, features in enumerate(cur_features):
-            valid_greek_features = [
-                f for f in features if f not in greek_stoplist_set and f >= 0
-            ]
-            translated_tokens = [
-                greek_to_latin[greek_features[f].token]
-                for f in valid_greek_features
-                if greek_features[f].token in greek_to_latin
-            ]
-            valid_latin_features = [
-                valid_latin_tokens_to_indices[latin_token]
-                for translations in translated_tokens
-                for latin_token in translations
-                if latin_token in valid_latin_tokens_to_indices
-            ]
-            latin_feature_inds.extend(valid_latin_features)
-            pos_inds.extend([end_break_inds + i] * len(valid_latin_features))
-        break_inds.append(end_break_inds + len(cur_features))
-    return (csr_matrix(
-        (np.ones(len(pos_inds), dtype=np.bool),
-         (pos_inds, latin_feature_inds)),
-        shape=(break_inds[-1], latin_features_size)), np.array(break_inds))
-
-
-def _gen_greek_to_latin_matches(search, conn, greek_units, greek_features,
-                                greek_stoplist_set, greek_to_latin,
-                                valid_latin_tokens_to_indices, latin_units,
+                                              greek_synonym_matrix))
+
+
+def get_translation_matrix(conn, greek_to_latin, latin_features):
+    """Retrieve the matrix translating Greek lemmata into Latin lemmata
+
+    The matrix is cached on disk.  Since Feature entities are never removed
+    and their indices never change, the cached matrix is identified by the
+    number of Greek and Latin lemmata features in the database along with a
+    digest of ``greek_to_latin``; earlier versions of the matrix are removed
+    when a new one is cached.
+
+    Parameters
+    ----------
+    conn : TessMongoConnection
+    greek_to_latin : dict[str, list of str]
+        Greek lemmata mapped to their Latin translations; see
+        ``tesserae.data.load_greek_to_latin()``
+    latin_features : list of tesserae.db.entities.Feature
+        all Latin lemmata features, sorted by index
+
+    Returns
+    -------
+    csr_matrix
+        if ``M[i, j] == True``, the Latin lemma with index j is a translation
+        of the Greek lemma with index i
+    """
+    greek_features_size = conn.connection[Feature.collection].count_documents(
+        {
+            'language': 'greek',
+            'feature': 'lemmata'
+        })
+    shape = (greek_features_size, len(latin_features))
+    key = (f'greek_to_latin_{shape[0]}_{shape[1]}_'
+           f'{_get_translation_digest(greek_to_latin)}')
+    cached = load_arrays('translations', key)
+    if cached is not None:
+        indices = cached['indices']
+        return csr_matrix(
+            (np.ones(len(indices), dtype=np.bool), indices, cached['indptr']),
+            shape=shape)
+    latin_tokens_to_indices = {f.token: f.index for f in latin_features}
+    greek_inds = []
+    latin_inds = []
+    for f in conn.find(Feature.collection, language='greek',
+                       feature='lemmata'):
+        for latin_token in greek_to_latin.get(f.token, []):
+            if latin_token in latin_tokens_to_indices:
+                greek_inds.append(f.index)
+                latin_inds.append(latin_tokens_to_indices[latin_token])
+    matrix = csr_matrix(
+        (np.ones(len(greek_inds), dtype=np.bool), (greek_inds, latin_inds)),
+        shape=shape)
+    matrix.sum_duplicates()
+    save_arrays('translations', key, {
+        'indptr': matrix.indptr,
+        'indices': matrix.indices
+    })
+    clear_prefix('translations', 'greek_to_latin_', keep=key)
+    return matrix
+
+
+def make_latinized_greek_matrix(greek_units, greek_stoplist_set,
+                                translation_matrix):
+    """Build a matrix where rows correspond to positions within Greek units
+    and columns to the Latin lemmata that translate them
+
+    Parameters
+    ----------
+    greek_units : UnitArrays
+    greek_stoplist_set : set of int
+        Greek lemmata indices which should not be translated
+    translation_matrix : csr_matrix
+        see ``get_translation_matrix()``
+
+    Returns
+    -------
+    M : csr_matrix
+        if ``M[i, j] == True``, the position i has a Greek lemma which
+        translates to the Latin lemma j
+    break_inds : 1d np.array of int
+        for the slice ``break_inds[i]:break_inds[i+1]``, those are the position
+        indices that belong to ``greek_units[i]``
+    """
+    greek_matrix, break_inds = _construct_unit_feature_matrix(
+        greek_units, greek_stoplist_set, translation_matrix.shape[0])
+    latinized = greek_matrix.astype(np.int32) @ \
+        translation_matrix.astype(np.int32)
+    latinized.sort_indices()
+    return latinized.astype(np.bool), np.asarray(break_inds)
+
+
+def _gen_greek_to_latin_matches(search, conn, greek_units, greek_stoplist_set,
+                                translation_matrix, latin_units,
                                 latin_features, latin_stoplist_set):
     latinized_greek_matrix, greek_break_inds = make_latinized_greek_matrix(
-        greek_units, greek_features, greek_stoplist_set, greek_to_latin,
-        valid_latin_tokens_to_indices, len(latin_features))
-
-    for hits2positions in gen_hits2positions(search, conn,
-                                             latinized_greek_matrix,
-                                             greek_break_inds, latin_units,
-                                             latin_stoplist_set,
-                                             len(latin_features)):
-        overhits2positions = {
-            k: np.array(v)
-            for k, v in hits2positions.items() if len(v) >= 2
-        }
-        for (t_ind, s_ind), positions in overhits2positions.items():
-            yield (t_ind, s_ind, positions)
-
-
-def _get_matched_greek_to_latin_features(greek_unit_features, greek_positions,
-                                         greek_features, greek_to_latin,
-                                         valid_latin_tokens_to_indices):
-    result = []
-    for greek_pos in greek_positions:
-        greek_features_by_pos = greek_unit_features[greek_pos]
-        cur_pos_latin_features = []
-        for greek_feature_index in greek_features_by_pos:
-            greek_token = greek_features[greek_feature_index].token
-            if greek_token in greek_to_latin:
-                translations = greek_to_latin[greek_token]
-                for latin_token in translations:
-                    if latin_token in valid_latin_tokens_to_indices:
-                        cur_pos_latin_features.append(
-                            valid_latin_tokens_to_indices[latin_token])
-        result.append(cur_pos_latin_features)
-    return result
+        greek_units, greek_stoplist_set, translation_matrix)
+
+    for t_inds, s_inds, hit_breaks, t_poses, s_poses in _gen_block_hits(
+            [search], conn, latinized_greek_matrix, greek_break_inds,
+            latin_units, latin_stoplist_set, len(latin_features),
+            lambda *grouped: grouped):
+        positions = np.column_stack((t_poses, s_poses))
+        for t_ind, s_ind, start, end in zip(t_inds, s_inds, hit_breaks[:-1],
+                                            hit_breaks[1:]):
+            yield (t_ind, s_ind, positions[start:end])
+
+
+def _get_matched_greek_to_latin_features(latinized_greek_matrix, rows):
+    """List the Latin translations at matched Greek positions
+
+    Parameters
+    ----------
+    latinized_greek_matrix : csr_matrix
+        see ``make_latinized_greek_matrix()``; its indices must be sorted
+    rows : 1d np.array of int
+        the rows of ``latinized_greek_matrix`` for the matched positions
+
+    Returns
+    -------
+    list of list of int
+        the Latin lemmata indices translating each matched position
+    """
+    indptr = latinized_greek_matrix.indptr
+    indices = latinized_greek_matrix.indices
+    return [indices[indptr[row]:indptr[row + 1]].tolist() for row in rows]
 
 
 def _get_match_features(matched_greek_to_latin_features,
@@ -4,17 +4,41 @@ Classes
 -------
 
 """
+import heapq
 import itertools
+import multiprocessing
 
+from bson.objectid import ObjectId
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, vstack
 
-from tesserae.db.entities import Feature, Match, Unit
+from tesserae.db.entities import Feature, Match, MatchBlock, Unit
+from tesserae.utils.cache import load_arrays, save_arrays
 from tesserae.utils.calculations import \
-    get_corpus_frequencies, get_inverse_text_frequencies, get_sound_inverse_text_freq
+    get_corpus_frequencies, get_inverse_text_frequencies, \
+    get_sound_inverse_text_freq, get_text_version
+from tesserae.utils.progress import ProgressReporter
 from tesserae.utils.retrieve import TagHelper
 from tesserae.utils.stopwords import create_stoplist, get_stoplist_indices, get_stoplist_tokens
 
+# default number of bytes that matching one block of source units against
+# the target units may use
+MATCH_MEMORY_BUDGET = 256 * 1024 * 1024
+# most matches stored in one MatchBlock when matches are stored compactly
+COMPACT_BLOCK_SIZE = 50000
+# approximate number of bytes needed for each nonzero of a block's match
+# matrix, counting the product itself, its COO form, and the arrays made while
+# grouping hits by unit pair
+_BYTES_PER_PRODUCT_NONZERO = 96
+# a kept unit pair has at least two distinct matched positions in each unit,
+# so each unit contributes a distance of at least 2
+_MIN_MATCH_DISTANCE = 4
+# leeway for rounding when an upper bound on a score is compared against a
+# score computed in a different order
+_SCORE_BOUND_SLACK = 1e-9
+# set in the parent process before source blocks are handed to forked workers
+_block_processor = None
+
 
 class SparseMatrixSearch(object):
     matcher_type = 'original'
@@ -54,7 +78,9 @@ class SparseMatrixSearch(object):
                 'freq_basis': search_params['freq_basis'],
                 'max_distance': search_params['max_distance'],
                 'distance_basis': search_params['distance_basis'],
-                'min_score': search_params['min_score']
+                'min_score': search_params['min_score'],
+                'intra_text': search_params.get('intra_text', False),
+                'top_k': search_params.get('top_k')
             }
         }
 
@@ -107,7 +133,15 @@ class SparseMatrixSearch(object):
             'parameters.method.distance_basis':
             method['distance_basis'],
             'parameters.method.min_score':
-            method['min_score']
+            method['min_score'],
+            # searches saved before intra-text search existed have no value
+            'parameters.method.intra_text':
+            True if method.get('intra_text', False) else {
+                '$ne': True
+            },
+            # a missing value matches None, as for searches of every match
+            'parameters.method.top_k':
+            method.get('top_k')
         }
 
     def match(self,
@@ -121,7 +155,11 @@ class SparseMatrixSearch(object):
               freq_basis='texts',
               max_distance=10,
               distance_basis='frequency',
-              min_score=6):
+              min_score=6,
+              processes=1,
+              memory_budget=None,
+              intra_text=False,
+              top_k=None):
         """Find matches between one or more texts.
 
         Texts will contain lines or phrases with matching tokens, with varying
@@ -161,6 +199,27 @@ class SparseMatrixSearch(object):
         min_score : float
             The minimum score a match must have in order to be included in the
             results
+        processes : int, optional
+            The number of worker processes among which to divide blocks of
+            source units; results are the same no matter how many are used
+        memory_budget : int, optional
+            The number of bytes that matching a block of source units may use;
+            defaults to ``MATCH_MEMORY_BUDGET``.  The number of source units in
+            each block is chosen to fit within this budget, and the chosen
+            block sizes are recorded in ``search.match_stats``.  Each worker
+            process works on one block at a time.
+        intra_text : bool, optional
+            Whether to search a text against itself.  The source and target
+            must then be the same text with the same units, and each pair of
+            distinct units is matched only once, with the earlier unit as the
+            target unit.
+        top_k : int, optional
+            If given, only the ``top_k`` highest scoring matches with a score
+            of at least ``min_score`` are returned, in descending order of
+            score; among matches with equal scores, the ones that a full search
+            finds first are kept.  Unit pairs whose score cannot reach the
+            lowest score among the best matches found so far are not scored in
+            full, so that the search takes less time.
 
         Raises
         ------
@@ -171,7 +230,355 @@ class SparseMatrixSearch(object):
         -------
         list of tesserae.db.entities.Match
         """
-        texts = [source.text, target.text]
+        return self.match_many([search], source, [target], feature,
+                               stopwords=stopwords,
+                               stopword_basis=stopword_basis,
+                               score_basis=score_basis,
+                               freq_basis=freq_basis,
+                               max_distance=max_distance,
+                               distance_basis=distance_basis,
+                               min_score=min_score,
+                               processes=processes,
+                               memory_budget=memory_budget,
+                               intra_text=intra_text,
+                               top_k=top_k)[0]
+
+    def match_batches(self,
+                      search,
+                      source,
+                      target,
+                      feature,
+                      stopwords=10,
+                      stopword_basis='corpus',
+                      score_basis='word',
+                      freq_basis='texts',
+                      max_distance=10,
+                      distance_basis='frequency',
+                      min_score=6,
+                      processes=1,
+                      memory_budget=None,
+                      intra_text=False,
+                      top_k=None,
+                      compact=False):
+        """Find matches between two texts, one block of source units at a time
+
+        Together, the batches yielded contain the same matches that
+        ``match()`` returns, so that they can be saved while matching
+        continues.  When ``top_k`` is given, the best matches are only known
+        once every block has been scored, so they all arrive in the last batch.
+
+        Parameters
+        ----------
+        search, source, target, feature, stopwords, stopword_basis,
+        score_basis, freq_basis, max_distance, distance_basis, min_score,
+        processes, memory_budget, intra_text, top_k
+            See ``match()``.
+        compact : bool, optional
+            Whether to yield the matches as MatchBlock entities, which store
+            them compactly, instead of as Match entities.
+
+        Raises
+        ------
+        ValueError
+            Raised when a parameter was poorly specified
+
+        Yields
+        ------
+        list of tesserae.db.entities.Match or list of MatchBlock
+            The matches found in a block of source units
+        """
+        for block_matches in self.match_many_batches(
+                [search], source, [target], feature,
+                stopwords=stopwords,
+                stopword_basis=stopword_basis,
+                score_basis=score_basis,
+                freq_basis=freq_basis,
+                max_distance=max_distance,
+                distance_basis=distance_basis,
+                min_score=min_score,
+                processes=processes,
+                memory_budget=memory_budget,
+                intra_text=intra_text,
+                top_k=top_k,
+                compact=compact):
+            yield block_matches[0]
+
+    def match_many(self,
+                   searches,
+                   source,
+                   targets,
+                   feature,
+                   stopwords=10,
+                   stopword_basis='corpus',
+                   score_basis='word',
+                   freq_basis='texts',
+                   max_distance=10,
+                   distance_basis='frequency',
+                   min_score=6,
+                   processes=1,
+                   memory_budget=None,
+                   intra_text=False,
+                   top_k=None):
+        """Find matches between one source text and several target texts.
+
+        The source text is loaded once, and each block of its units is
+        matched against all of the target texts with a single matrix product.
+        The matches found for each target text are the same as those found by
+        ``match()`` with the same parameters, except that a stoplist computed
+        with ``stopword_basis='texts'`` uses the frequencies of all of the
+        texts.
+
+        Parameters
+        ----------
+        searches : list of tesserae.db.entities.Search
+            The search job associated with each target text.
+        source : tesserae.matchers.text_options.TextOptions
+            The source text to compare against, specifying by which units.
+        targets : list of tesserae.matchers.text_options.TextOptions
+            The target texts to compare against, specifying by which units.
+        feature, stopwords, stopword_basis, score_basis, freq_basis,
+        max_distance, distance_basis, min_score, processes, memory_budget,
+        intra_text, top_k
+            See ``match()``; ``top_k`` applies to each target text
+            separately.
+
+        Raises
+        ------
+        ValueError
+            Raised when a parameter was poorly specified
+
+        Returns
+        -------
+        list of list of tesserae.db.entities.Match
+            The matches found for each target text, in the order of
+            ``targets``
+        """
+        matches_list = [[] for _ in targets]
+        for block_matches in self.match_many_batches(
+                searches, source, targets, feature,
+                stopwords=stopwords,
+                stopword_basis=stopword_basis,
+                score_basis=score_basis,
+                freq_basis=freq_basis,
+                max_distance=max_distance,
+                distance_basis=distance_basis,
+                min_score=min_score,
+                processes=processes,
+                memory_budget=memory_budget,
+                intra_text=intra_text,
+                top_k=top_k):
+            for matches, found in zip(matches_list, block_matches):
+                matches.extend(found)
+        return matches_list
+
+    def match_many_batches(self,
+                           searches,
+                           source,
+                           targets,
+                           feature,
+                           stopwords=10,
+                           stopword_basis='corpus',
+                           score_basis='word',
+                           freq_basis='texts',
+                           max_distance=10,
+                           distance_basis='frequency',
+                           min_score=6,
+                           processes=1,
+                           memory_budget=None,
+                           intra_text=False,
+                           top_k=None,
+                           compact=False):
+        """Find matches against several targets, one source block at a time
+
+        Parameters
+        ----------
+        searches, source, targets, feature, stopwords, stopword_basis,
+        score_basis, freq_basis, max_distance, distance_basis, min_score,
+        processes, memory_budget, intra_text, top_k
+            See ``match_many()``.
+        compact
+            See ``match_batches()``.
+
+        Raises
+        ------
+        ValueError
+            Raised when a parameter was poorly specified
+
+        Yields
+        ------
+        list of list of tesserae.db.entities.Match or list of list of
+        MatchBlock
+            The matches found in a block of source units for each target
+            text, in the order of ``targets``
+        """
+        if len(searches) != len(targets):
+            raise ValueError(f'Expected one search per target text, but got '
+                             f'{len(searches)} searches for {len(targets)} '
+                             f'target texts')
+        scoring = {
+            'max_distance': max_distance,
+            'distance_basis': distance_basis,
+            'min_score': min_score,
+            'top_k': top_k
+        }
+        yield from self._gen_match_batches(searches, source, targets,
+                                           [[scoring] for _ in targets],
+                                           feature, stopwords, stopword_basis,
+                                           score_basis, freq_basis, processes,
+                                           memory_budget, intra_text, compact)
+
+    def match_sweep(self,
+                    searches,
+                    source,
+                    target,
+                    feature,
+                    scorings,
+                    stopwords=10,
+                    stopword_basis='corpus',
+                    score_basis='word',
+                    freq_basis='texts',
+                    processes=1,
+                    memory_budget=None,
+                    intra_text=False):
+        """Find matches between two texts under several scoring settings.
+
+        Candidate unit pairs and their matched positions are found once and
+        then scored under each of the settings.  The matches found for each
+        setting are the same as those found by ``match()`` with the same
+        parameters.
+
+        Parameters
+        ----------
+        searches : list of tesserae.db.entities.Search
+            The search job associated with each scoring setting.
+        source, target, feature
+            See ``match()``.
+        scorings : list of dict
+            The scoring settings, each with the keys 'max_distance',
+            'distance_basis', and 'min_score', and optionally 'top_k' (see
+            ``match()``).
+        stopwords, stopword_basis, score_basis, freq_basis, processes,
+        memory_budget, intra_text
+            See ``match()``.
+
+        Raises
+        ------
+        ValueError
+            Raised when a parameter was poorly specified
+
+        Returns
+        -------
+        list of list of tesserae.db.entities.Match
+            The matches found under each scoring setting, in the order of
+            ``scorings``
+        """
+        matches_list = [[] for _ in scorings]
+        for block_matches in self.match_sweep_batches(
+                searches, source, target, feature, scorings,
+                stopwords=stopwords,
+                stopword_basis=stopword_basis,
+                score_basis=score_basis,
+                freq_basis=freq_basis,
+                processes=processes,
+                memory_budget=memory_budget,
+                intra_text=intra_text):
+            for matches, found in zip(matches_list, block_matches):
+                matches.extend(found)
+        return matches_list
+
+    def match_sweep_batches(self,
+                            searches,
+                            source,
+                            target,
+                            feature,
+                            scorings,
+                            stopwords=10,
+                            stopword_basis='corpus',
+                            score_basis='word',
+                            freq_basis='texts',
+                            processes=1,
+                            memory_budget=None,
+                            intra_text=False,
+                            compact=False):
+        """Find matches under several scorings, one source block at a time
+
+        Parameters
+        ----------
+        searches, source, target, feature, scorings, stopwords,
+        stopword_basis, score_basis, freq_basis, processes, memory_budget,
+        intra_text
+            See ``match_sweep()``.
+        compact
+            See ``match_batches()``.
+
+        Raises
+        ------
+        ValueError
+            Raised when a parameter was poorly specified
+
+        Yields
+        ------
+        list of list of tesserae.db.entities.Match or list of list of
+        MatchBlock
+            The matches found in a block of source units under each scoring
+            setting, in the order of ``scorings``
+        """
+        if len(searches) != len(scorings):
+            raise ValueError(f'Expected one search per scoring setting, but '
+                             f'got {len(searches)} searches for '
+                             f'{len(scorings)} scoring settings')
+        for scoring in scorings:
+            missing = {'max_distance', 'distance_basis', 'min_score'} - \
+                set(scoring)
+            if missing:
+                raise ValueError(f'Scoring setting {scoring} is missing '
+                                 f'{sorted(missing)}')
+        scorings = [dict(scoring, top_k=scoring.get('top_k'))
+                    for scoring in scorings]
+        yield from self._gen_match_batches(searches, source, [target],
+                                           [scorings], feature, stopwords,
+                                           stopword_basis, score_basis,
+                                           freq_basis, processes,
+                                           memory_budget, intra_text, compact)
+
+    def _gen_match_batches(self, searches, source, targets, scorings_list,
+                           feature, stopwords, stopword_basis, score_basis,
+                           freq_basis, processes, memory_budget, intra_text,
+                           compact=False):
+        """Find and score matches, one block of source units at a time
+
+        Parameters
+        ----------
+        searches : list of tesserae.db.entities.Search
+            The search job associated with each scoring setting of each
+            target text, ordered by target text
+        source, targets
+            See ``match_many()``.
+        scorings_list : list of list of dict
+            The scoring settings for each target text; see ``match_sweep()``
+        feature, stopwords, stopword_basis, score_basis, freq_basis,
+        processes, memory_budget, intra_text
+            See ``match()``.
+        compact
+            See ``match_batches()``.
+
+        Yields
+        ------
+        list of list of tesserae.db.entities.Match or list of list of
+        MatchBlock
+            The matches found in a block of source units for each search
+        """
+        if intra_text and (len(targets) != 1
+                           or targets[0].text.id != source.text.id
+                           or targets[0].unit_type != source.unit_type):
+            raise ValueError('Intra-text search requires the source and '
+                             'target to be the same text with the same units')
+        for scorings in scorings_list:
+            for scoring in scorings:
+                if scoring['top_k'] is not None and scoring['top_k'] < 1:
+                    raise ValueError(f'Chosen top_k was invalid: '
+                                     f'{scoring["top_k"]} is not positive')
+        texts = [source.text] + [target.text for target in targets]
         if isinstance(stopwords, int):
             stopword_basis = stopword_basis if stopword_basis != 'texts' \
                     else texts
@@ -206,30 +613,120 @@ class SparseMatrixSearch(object):
                              f'"{source.text.language}" '
                              f'was not found in the database.')
 
-        target_units = _get_units(self.connection, target, feature)
+        target_units_list = [
+            _get_units(self.connection, target, feature) for target in targets
+        ]
         source_units = _get_units(self.connection, source, feature)
 
-        tag_helper = TagHelper(self.connection, texts)
+        source_inv_frequencies_getter, target_inv_frequencies_getters = \
+            _get_inv_frequencies_getters(self.connection, score_basis,
+                                         freq_basis, source, targets,
+                                         source_units, target_units_list)
+        make_block_scorer = _make_sound_block_scorer \
+            if score_basis == 'sound' else _make_block_scorer
+        stoplist_set = set(stoplist)
+        score_blocks = [
+            make_block_scorer(target_units, source_units, stoplist_set,
+                              scorings, source_inv_frequencies_getter,
+                              target_inv_frequencies_getter)
+            for target_units, scorings, target_inv_frequencies_getter in zip(
+                target_units_list, scorings_list,
+                target_inv_frequencies_getters)
+        ]
+        tag_helpers = [
+            TagHelper(self.connection, [source.text, target.text])
+            for target in targets
+        ]
+        # the target text index and scoring setting of each search
+        search_scorings = [(k, scoring)
+                           for k, scorings in enumerate(scorings_list)
+                           for scoring in scorings]
+        # matches of top-K searches are held back until every block is scored
+        held_results = [MatchResults.concatenate([]) for _ in searches]
+        # the number of MatchBlock entities created so far for each search
+        block_counts = [0 for _ in searches]
+
+        def _make_matches(i, k, results):
+            if not compact:
+                return results.to_matches(searches[i].id,
+                                          target_units_list[k], source_units,
+                                          features, tag_helpers[k])
+            blocks = results.to_blocks(searches[i].id, block_counts[i],
+                                       target_units_list[k], source_units,
+                                       source.text.language, feature)
+            block_counts[i] += len(blocks)
+            return blocks
+
+        for block_results in _gen_scored_blocks(searches, self.connection,
+                                                target_units_list,
+                                                source_units, stoplist_set,
+                                                len(features), score_blocks,
+                                                processes, memory_budget,
+                                                intra_text):
+            block_matches = []
+            for i, ((k, scoring), results) in enumerate(
+                    zip(search_scorings, block_results)):
+                # only matches that are kept need to be turned into Match
+                # or MatchBlock entities
+                results = results.select(
+                    results.scores >= scoring['min_score'])
+                if scoring['top_k'] is not None:
+                    held_results[i] = _select_best(
+                        MatchResults.concatenate([held_results[i], results]),
+                        scoring['top_k'])
+                    block_matches.append([])
+                    continue
+                block_matches.append(_make_matches(i, k, results))
+            yield block_matches
+        if any(scoring['top_k'] is not None for _, scoring in search_scorings):
+            block_matches = []
+            for i, ((k, scoring), held) in enumerate(
+                    zip(search_scorings, held_results)):
+                if scoring['top_k'] is None:
+                    block_matches.append([])
+                    continue
+                # a stable sort keeps the matches found first among ties
+                best = held.select(np.argsort(-held.scores, kind='mergesort'))
+                block_matches.append(_make_matches(i, k, best))
+            yield block_matches
 
-        if freq_basis != 'texts':
-            match_ents = _score_by_corpus_frequencies(search, self.connection,
-                                                      score_basis, texts,
-                                                      target_units,
-                                                      source_units, features,
-                                                      stoplist, distance_basis,
-                                                      max_distance, tag_helper)
-        else:
-            match_ents = _score_by_text_frequencies(search, self.connection,
-                                                    score_basis, texts,
-                                                    target_units, source_units,
-                                                    features, stoplist,
-                                                    distance_basis,
-                                                    max_distance, tag_helper)
 
-        return [m for m in match_ents if m.score >= min_score]
+def _get_units(connection, textoptions, feature):
+    """Retrieve unit information needed for matching
 
+    Unit information is served from the local disk cache when possible;
+    otherwise, it is pulled from the database and then cached.  Cached unit
+    information is stamped with the version of the text in the database (see
+    ``tesserae.utils.calculations.get_text_version()``), so it is pulled
+    again once the text changes, even if it changed on another host.
 
-def _get_units(connection, textoptions, feature):
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    textoptions : tesserae.matchers.text_options.TextOptions
+        The text and unit type whose units are to be retrieved
+    feature : str
+        The feature type to retrieve for each token
+
+    Returns
+    -------
+    UnitArrays
+        behaves like a list of unit dictionaries (see ``UnitArrays`` for
+        the keys contained in each dictionary)
+    """
+    key = f'{str(textoptions.text.id)}_{textoptions.unit_type}_{feature}'
+    version = get_text_version(connection, textoptions.text.id)
+    arrays = load_arrays(UnitArrays.cache_kind, key, version)
+    if arrays is not None:
+        return UnitArrays(textoptions.text.id, arrays)
+    units = UnitArrays.from_dicts(
+        textoptions.text.id, _aggregate_units(connection, textoptions,
+                                              feature))
+    save_arrays(UnitArrays.cache_kind, key, units.arrays, version)
+    return units
+
+
+def _aggregate_units(connection, textoptions, feature):
     return [
         u for u in connection.aggregate(
             Unit.collection,
@@ -266,243 +763,1098 @@ def _get_units(connection, textoptions, feature):
     ]
 
 
-def _score_by_corpus_frequencies(search, connection, score_basis, texts,
-                                 target_units, source_units, features,
-                                 stoplist, distance_basis, max_distance,
-                                 tag_helper):
-    if score_basis == 'sound':
-        if texts[0].language != texts[1].language:
-            source_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[0].language),
-                source_units)
-            target_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[1].language),
-                target_units)
-        else:
-            source_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[0].language),
-                itertools.chain.from_iterable([source_units, target_units]))
-            target_inv_frequencies_getter = source_inv_frequencies_getter
-        return _score_sound(search, connection, target_units, source_units, features,
-                    stoplist, distance_basis, max_distance,
-                    source_inv_frequencies_getter, target_inv_frequencies_getter,
-                    tag_helper)
-    else:
-        if texts[0].language != texts[1].language:
-            source_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[0].language),
-                source_units)
-            target_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[1].language),
-                target_units)
-        else:
-            source_inv_frequencies_getter = _inverse_averaged_freq_getter(
-                get_corpus_frequencies(connection, score_basis, texts[0].language),
-                itertools.chain.from_iterable([source_units, target_units]))
-            target_inv_frequencies_getter = source_inv_frequencies_getter
-        return _score(search, connection, target_units, source_units, features,
-                    stoplist, distance_basis, max_distance,
-                    source_inv_frequencies_getter, target_inv_frequencies_getter,
-                    tag_helper)
-
-
-def _score_by_text_frequencies(search, connection, score_basis, texts,
-                               target_units, source_units, features, stoplist,
-                               distance_basis, max_distance, tag_helper):
-    if score_basis == 'sound':
-        source_inv_frequencies_getter = _lookup_wrapper(
-            get_sound_inverse_text_freq(connection, texts[0].id))
-        target_inv_frequencies_getter = _lookup_wrapper(
-            get_sound_inverse_text_freq(connection, texts[1].id))
-        return _score_sound(search, connection, target_units, source_units, features,
-                    stoplist, distance_basis, max_distance,
-                    source_inv_frequencies_getter, target_inv_frequencies_getter,
-                    tag_helper)
-    else:
-        source_inv_frequencies_getter = _lookup_wrapper(
-            get_inverse_text_frequencies(connection, score_basis, texts[0].id))
-        target_inv_frequencies_getter = _lookup_wrapper(
-            get_inverse_text_frequencies(connection, score_basis, texts[1].id))
-        return _score(search, connection, target_units, source_units, features,
-                    stoplist, distance_basis, max_distance,
-                    source_inv_frequencies_getter, target_inv_frequencies_getter,
-                    tag_helper)
+def _pack_strings(strings):
+    """Encode strings into one byte array with offsets"""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
 
 
-def _get_trivial_distance(p0, p1):
-    """Calculates the distance between two positions
+def _flatten(lists, dtype):
+    """Flatten a list of lists into an array with offsets"""
+    breaks = np.zeros(len(lists) + 1, dtype=np.int64)
+    breaks[1:] = np.cumsum([len(inner) for inner in lists])
+    return np.fromiter(itertools.chain.from_iterable(lists),
+                       dtype=dtype,
+                       count=breaks[-1]), breaks
 
-    Parameters
-    ----------
-    p0, p1 : ints
-        token positions in the unit where matches were found
-    """
-    if p0 == p1:
-        return 0
-    return abs(p0 - p1) + 1
 
+class UnitArrays(object):
+    """Array-backed sequence of unit information used for matching
 
-def _get_distance_by_least_frequency(get_inv_freq, positions, forms):
-    """Obtains the distance by least frequency for a unit
+    Unit information is held in flat NumPy arrays so that it can be stored
+    compactly and so that matrix construction need not loop over units in
+    Python.  Indexing with an int yields the same dictionary that was
+    previously returned by the database query; slicing yields another
+    UnitArrays covering a contiguous run of units.
 
-    Contrary to the v3 help documentation on --dist in read_table.pl, v3
-    behavior is that distance is inclusive of both matched words.  Thus,
-    adjacent words have a distance of 2, an intervening word increases the
-    distance to 3, and so forth.  This function behaves as v3 behaves instead
-    of how it prescribes.
+    Each unit dictionary contains the following string keys and
+    corresponding values:
+    '_id' : bson.objectid.ObjectId
+        ObjectId of the Unit entity in the database
+    'index' : int
+        index of the Unit entity in the database
+    'tags' : list of str
+        tag information for this unit
+    'forms' : list of int
+        the ``...['forms'][y]`` is the integer associated with the form
+        Feature of the word token at position y
+    'features' : list of list of int
+        each position of this list corresponds to the same position in the
+        'forms' list; thus, ...['features'][a] is a list of the Feature indices
+        derived from ...['forms'][a].
 
-    Parameters
+    Attributes
     ----------
-    get_inv_freq : (int) -> float
-        a function that takes a word form index as input and returns its
-        inverse frequency as output
-    positions : 1d np.array of ints
-        token positions in the unit where matches were found
-    forms : 1d np.array of ints
-        the token forms of the unit
+    text_id : bson.objectid.ObjectId
+        ObjectId of the Text to which the units belong
+    arrays : dict[str, np.array]
+        the flat arrays describing all units; slices share these arrays
     """
-    if len(set(forms[positions])) < 2:
-        return 0
-    if len(positions) == 2:
-        return _get_trivial_distance(positions[0], positions[1])
-    sorted_positions = np.array(sorted(positions))
-    inv_freqs = np.array([get_inv_freq(f) for f in forms[sorted_positions]])
-    # lowest inverse frequencies are the highest frequencies, so need to flip
-    freq_sort = np.argsort(-inv_freqs)
-    idx = sorted_positions[freq_sort]
-    if idx.shape[0] >= 2:
-        not_first_pos = idx[idx != idx[0]]
-        if not_first_pos.shape[0] > 0:
-            end = not_first_pos[0]
-            return np.abs(end - idx[0]) + 1
-    return 0
 
+    cache_kind = 'units'
 
-def _get_distance_by_span(matched_positions, forms):
-    """Calculate distance between two matching words
+    def __init__(self, text_id, arrays, start=0, stop=None, _memo=None):
+        self.text_id = text_id
+        self.arrays = arrays
+        self._start = start
+        self._stop = len(arrays['unit_ids']) if stop is None else stop
+        # materialized unit dictionaries are shared between slices
+        self._memo = _memo if _memo is not None else {}
 
-    Parameters
-    ----------
-    matched_positions : 1d np.array of ints
-        the positions at which matched words were found in a unit
-    forms : 1d np.array of ints
-        the token forms of the unit
-    """
-    if len(set(forms[matched_positions])) < 2:
-        return 0
-    if len(matched_positions) == 2:
-        return _get_trivial_distance(matched_positions[0],
-                                     matched_positions[1])
-    start_pos = np.min(matched_positions)
-    end_pos = np.max(matched_positions)
-    if start_pos != end_pos:
-        return np.abs(end_pos - start_pos) + 1
-    return 0
+    @classmethod
+    def from_dicts(cls, text_id, units):
+        """Build from unit dictionaries as returned by the database
 
+        Parameters
+        ----------
+        text_id : bson.objectid.ObjectId
+            ObjectId of the Text to which the units belong
+        units : list of dict
+            see ``UnitArrays`` for the keys required in each dictionary
 
-def _lookup_wrapper(d):
-    """Useful for making dictionaries act like functions"""
-    def _inner(key):
-        return d[key]
+        Returns
+        -------
+        UnitArrays
+        """
+        forms, form_breaks = _flatten([u['forms'] for u in units], np.int32)
+        features, feature_breaks = _flatten(
+            [f for u in units for f in u['features']], np.int32)
+        break_inds = np.zeros(len(units) + 1, dtype=np.int64)
+        break_inds[1:] = np.cumsum([len(u['features']) for u in units])
+        tag_breaks = np.zeros(len(units) + 1, dtype=np.int64)
+        tag_breaks[1:] = np.cumsum([len(u['tags']) for u in units])
+        tag_bytes, tag_offsets = _pack_strings(
+            [t for u in units for t in u['tags']])
+        snippet_bytes, snippet_offsets = _pack_strings(
+            [u['snippet'] if u['snippet'] is not None else '' for u in units])
+        matrix_indptr, matrix_indices = _get_position_feature_rows(
+            features, feature_breaks)
+        return cls(
+            text_id, {
+                # ObjectIds are stored as rows of their 12 raw bytes
+                'unit_ids': np.frombuffer(
+                    b''.join(u['_id'].binary for u in units),
+                    dtype=np.uint8).reshape(-1, 12),
+                'unit_indices': np.array([u['index'] for u in units],
+                                         dtype=np.int64),
+                'forms': forms,
+                'form_breaks': form_breaks,
+                'features': features,
+                'feature_breaks': feature_breaks,
+                'break_inds': break_inds,
+                'tag_bytes': tag_bytes,
+                'tag_offsets': tag_offsets,
+                'tag_breaks': tag_breaks,
+                'snippet_bytes': snippet_bytes,
+                'snippet_offsets': snippet_offsets,
+                # position by feature matrix of all features, stopwords
+                # included, so that it serves every stoplist
+                'matrix_indptr': matrix_indptr,
+                'matrix_indices': matrix_indices,
+            })
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError('UnitArrays only supports contiguous slices')
+            stop = max(start, stop)
+            return UnitArrays(self.text_id, self.arrays,
+                              self._start + start, self._start + stop,
+                              self._memo)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('unit index out of range')
+        ind = self._start + key
+        if ind not in self._memo:
+            self._memo[ind] = self._materialize(ind)
+        return self._memo[ind]
+
+    def _decode(self, name, i):
+        offsets = self.arrays[name + '_offsets']
+        return self.arrays[name + '_bytes'][offsets[i]:offsets[i + 1]]\
+            .tobytes().decode('utf-8')
+
+    def _materialize(self, ind):
+        arrays = self.arrays
+        form_breaks = arrays['form_breaks']
+        feature_breaks = arrays['feature_breaks']
+        features = arrays['features']
+        tag_breaks = arrays['tag_breaks']
+        pos_start = arrays['break_inds'][ind]
+        pos_end = arrays['break_inds'][ind + 1]
+        return {
+            '_id': ObjectId(arrays['unit_ids'][ind].tobytes()),
+            'text': self.text_id,
+            'index': int(arrays['unit_indices'][ind]),
+            'snippet': self._decode('snippet', ind),
+            'tags': [
+                self._decode('tag', t)
+                for t in range(tag_breaks[ind], tag_breaks[ind + 1])
+            ],
+            'forms':
+            arrays['forms'][form_breaks[ind]:form_breaks[ind + 1]].tolist(),
+            'features': [
+                features[feature_breaks[p]:feature_breaks[p + 1]].tolist()
+                for p in range(pos_start, pos_end)
+            ],
+        }
 
-    return _inner
+    @property
+    def break_inds(self):
+        """1d np.array of int: position breaks relative to the first unit"""
+        breaks = self.arrays['break_inds'][self._start:self._stop + 1]
+        return breaks - breaks[0]
 
+    def unit_id_rows(self, unit_inds):
+        """Look up the raw bytes of the ObjectIds of units
 
-def _inverse_averaged_freq_getter(d, units_iter):
-    cache = {}
-    for unit in units_iter:
-        for form, feats in zip(unit['forms'], unit['features']):
-            if form in cache:
-                continue
-            cache[form] = 1.0 / np.mean([d[f] for f in feats])
+        Parameters
+        ----------
+        unit_inds : 1d np.array of ints
+            indices of units, relative to this sequence
 
-    def _inner(key):
-        return cache[key]
+        Returns
+        -------
+        2d np.array of uint8
+            row i holds the 12 bytes of the ObjectId of unit ``unit_inds[i]``
+        """
+        return self.arrays['unit_ids'][self._start + unit_inds]
 
-    return _inner
+    def forms_at(self, unit_inds, positions):
+        """Look up the form index found at positions within units
 
+        Parameters
+        ----------
+        unit_inds : 1d np.array of ints
+            indices of units, relative to this sequence
+        positions : 1d np.array of ints
+            ``positions[i]`` is a token position within unit ``unit_inds[i]``
 
-def _extract_features_and_positions(units, stoplist_set):
-    """Grab feature and token information from units
+        Returns
+        -------
+        1d np.array of ints
+        """
+        form_breaks = self.arrays['form_breaks']
+        return self.arrays['forms'][form_breaks[self._start + unit_inds] +
+                                    positions]
 
-    All features for every token within each of the units will be accounted for
-    exactly once.
+    def flat_features(self):
+        """Feature indices of every unit, each unit's in position order
+
+        Returns
+        -------
+        features : 1d np.array of ints
+            for unit i, the slice ``features[breaks[i]:breaks[i+1]]`` is the
+            concatenation of the lists in ``self[i]['features']``
+        breaks : 1d np.array of ints
+        """
+        feature_breaks = self.arrays['feature_breaks']
+        breaks = feature_breaks[
+            self.arrays['break_inds'][self._start:self._stop + 1]]
+        return self.arrays['features'][breaks[0]:breaks[-1]], \
+            breaks - breaks[0]
+
+    def extract_features_and_positions(self, stoplist_set):
+        """Vectorized equivalent of ``_extract_features_and_positions()``"""
+        all_breaks = self.arrays['break_inds']
+        pos_start = all_breaks[self._start]
+        pos_end = all_breaks[self._stop]
+        feature_breaks = self.arrays['feature_breaks'][pos_start:pos_end + 1]
+        feature_inds = self.arrays['features'][
+            feature_breaks[0]:feature_breaks[-1]]
+        pos_inds = np.repeat(np.arange(pos_end - pos_start),
+                             np.diff(feature_breaks))
+        valid = feature_inds >= 0
+        if stoplist_set:
+            valid &= ~np.isin(feature_inds,
+                              np.fromiter(stoplist_set, dtype=np.int64))
+        return feature_inds[valid], pos_inds[valid], self.break_inds
+
+    def feature_matrix(self, stoplist_set, features_size):
+        """Vectorized equivalent of ``_construct_unit_feature_matrix()``
+
+        The matrix of all features is stored with the units, so only the
+        columns of the stopwords need to be cleared.
+
+        Parameters
+        ----------
+        stoplist_set : set of int
+            feature indices which should not be recorded
+        features_size : int
+            the total number of feature types for the class of features
+            contained in the units
+
+        Returns
+        -------
+        csr_matrix
+            if ``M[i, j] == True``, the position i has feature j appear
+        """
+        all_breaks = self.arrays['break_inds']
+        pos_start = all_breaks[self._start]
+        pos_end = all_breaks[self._stop]
+        indptr = self.arrays['matrix_indptr'][pos_start:pos_end + 1]
+        indices = self.arrays['matrix_indices'][indptr[0]:indptr[-1]]
+        matrix = csr_matrix(
+            (np.ones(len(indices), dtype=np.bool), indices,
+             indptr - indptr[0]),
+            shape=(pos_end - pos_start, features_size))
+        return _mask_columns(matrix, stoplist_set)
+
+
+def _get_position_feature_rows(features, feature_breaks):
+    """Find the distinct valid features at each position
 
     Parameters
     ----------
-    units
-        ``units`` should be either ``source_units`` or ``target_units`` from
-        ``_gen_matches(...)``
-    stoplist_set : set of int
-        feature indices which should not be recorded
+    features : 1d np.array of ints
+        feature indices of all positions; negative indices are not features
+    feature_breaks : 1d np.array of ints
+        the slice ``features[feature_breaks[i]:feature_breaks[i+1]]`` holds
+        the features of position i
 
     Returns
     -------
-    feature_inds : 1d np.array of int
-    pos_inds : 1d np.array of int
-        ``feature_inds[i]`` should be equal to a feature index present at the
-        position equal to ``pos_inds[i]``
-    break_inds : 1d np.array of int
-        for the slice ``break_inds[i]:break_inds[i+1]``, those are the position
-        indices that belong to ``units[i]``
-
-    Example
-    -------
-    >>> unit_0 = {... 'forms': [1], 'features': [[10, 20]]}
-    >>> unit_1 = {... 'forms': [5, 17], 'features': [[7], [21, 30]]}
-    >>> units = [unit_0, unit_1]
-    >>> feature_inds, pos_inds, break_inds = \
-    >>> ... _extract_features_and_positions(units, {7})
-    >>> feaure_inds == np.array([10, 20, 21, 30])
-    >>> pos_inds == np.array([0, 0, 2, 2])
-    >>> break_inds == np.array([0, 1, 3])
-
+    indptr, indices : 1d np.array of ints
+        the rows of a canonical CSR matrix whose rows are positions and whose
+        columns are features
     """
-    feature_inds = []
-    pos_inds = []
-    break_inds = [0]
-    for unit in units:
-        end_break_inds = break_inds[-1]
-        cur_features = unit['features']
-        for i, features in enumerate(cur_features):
-            valid_features = [
-                f for f in features if f not in stoplist_set and f >= 0
-            ]
-            if -1 in valid_features:
-                print(unit)
-            feature_inds.extend(valid_features)
-            pos_inds.extend([end_break_inds + i] * len(valid_features))
-        break_inds.append(end_break_inds + len(cur_features))
-    return np.array(feature_inds), np.array(pos_inds), np.array(break_inds)
+    num_positions = len(feature_breaks) - 1
+    pos_inds = np.repeat(np.arange(num_positions, dtype=np.int64),
+                         np.diff(feature_breaks))
+    valid = features >= 0
+    span = int(features.max()) + 1 if len(features) else 1
+    keys = np.unique(pos_inds[valid] * span + features[valid])
+    indptr = np.zeros(num_positions + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // span, minlength=num_positions),
+              out=indptr[1:])
+    return indptr, (keys % span).astype(np.int32)
 
 
-def _construct_feature_unit_matrix(units, stoplist_set, features_size):
-    """Build a matrix where rows correspond to features and columns to
-    positions within units
+def _mask_columns(matrix, excluded):
+    """Clear the entries of a boolean matrix in the specified columns
 
     Parameters
     ----------
-    units
-        ``units`` should be either ``source_units`` or ``target_units`` from
-        ``_gen_matches(...)``
-    stoplist_set : set of int
-        feature indices which should not be recorded
-    features_size : int
-        the total number of feature types for the class of features contained
-        in ``units``
+    matrix : csr_matrix
+    excluded : set of int
+        indices of the columns to clear
 
     Returns
     -------
-    M : csr_matrix
-        the result matrix; if ``M[i, j] == True``, the feature with index i
-        appears at position j.
-    break_inds : list of int
-        see ``_extract_features_and_positions()`` for details
+    csr_matrix
+        ``matrix`` itself if there is nothing to clear; otherwise, a copy
+    """
+    excluded = [i for i in excluded if 0 <= i < matrix.shape[1]]
+    if not excluded:
+        return matrix
+    keep = np.ones(matrix.shape[1], dtype=np.bool)
+    keep[excluded] = False
+    result = matrix.copy()
+    result.data = keep[result.indices]
+    result.eliminate_zeros()
+    return result
+
+
+class MatchResults(object):
+    """Columnar match information for scored unit pairs
+
+    Scoring records matches into flat NumPy arrays rather than creating a
+    Match entity for each one, so that filtering by score is cheap; Match
+    entities are created only for the matches that are kept.
 
+    Attributes
+    ----------
+    target_inds : 1d np.array of ints
+        index into the target units of each match
+    source_inds : 1d np.array of ints
+        index into the source units of each match
+    scores : 1d np.array of floats
+        score of each match
+    distances : 1d np.array of ints
+        distance of each match
+    highlight_breaks : 1d np.array of ints
+        the slice ``highlight_breaks[i]:highlight_breaks[i+1]`` of
+        ``target_positions`` and ``source_positions`` holds the highlight
+        information of match i
+    target_positions : 1d np.array of ints
+        matched token positions in the target unit
+    source_positions : 1d np.array of ints
+        matched token positions in the source unit
+    feature_breaks : 1d np.array of ints
+        the slice ``feature_breaks[i]:feature_breaks[i+1]`` of
+        ``feature_inds`` holds the matched features of match i
+    feature_inds : 1d np.array of ints
+        indices of matched features
     """
-    feature_inds, pos_inds, break_inds = _extract_features_and_positions(
-        units, stoplist_set)
-    for sw in stoplist_set:
+
+    def __init__(self, target_inds, source_inds, scores, distances,
+                 highlight_breaks, target_positions, source_positions,
+                 feature_breaks, feature_inds):
+        self.target_inds = target_inds
+        self.source_inds = source_inds
+        self.scores = scores
+        self.distances = distances
+        self.highlight_breaks = highlight_breaks
+        self.target_positions = target_positions
+        self.source_positions = source_positions
+        self.feature_breaks = feature_breaks
+        self.feature_inds = feature_inds
+
+    def __len__(self):
+        return len(self.scores)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Join MatchResults end to end
+
+        Parameters
+        ----------
+        parts : list of MatchResults
+
+        Returns
+        -------
+        MatchResults
+        """
+        if not parts:
+            return _MatchResultsBuilder().build()
+        return cls(
+            np.concatenate([p.target_inds for p in parts]),
+            np.concatenate([p.source_inds for p in parts]),
+            np.concatenate([p.scores for p in parts]),
+            np.concatenate([p.distances for p in parts]),
+            _concatenate_breaks([p.highlight_breaks for p in parts]),
+            np.concatenate([p.target_positions for p in parts]),
+            np.concatenate([p.source_positions for p in parts]),
+            _concatenate_breaks([p.feature_breaks for p in parts]),
+            np.concatenate([p.feature_inds for p in parts]))
+
+    def select(self, keep):
+        """Make a new MatchResults containing only some of the matches
+
+        Parameters
+        ----------
+        keep : 1d np.array of bool or ints
+            either a mask over the matches or the indices of the matches to
+            keep
+
+        Returns
+        -------
+        MatchResults
+        """
+        keep = np.arange(len(self))[keep]
+        highlight_breaks, highlight_inds = _select_segments(
+            self.highlight_breaks, keep)
+        feature_breaks, feature_inds = _select_segments(
+            self.feature_breaks, keep)
+        return MatchResults(self.target_inds[keep], self.source_inds[keep],
+                            self.scores[keep], self.distances[keep],
+                            highlight_breaks,
+                            self.target_positions[highlight_inds],
+                            self.source_positions[highlight_inds],
+                            feature_breaks, self.feature_inds[feature_inds])
+
+    def to_matches(self, search_id, target_units, source_units, features,
+                   tag_helper):
+        """Create Match entities
+
+        Parameters
+        ----------
+        search_id : bson.objectid.ObjectId
+            ObjectId of the Search to which the matches belong
+        target_units : UnitArrays or list of dict
+            the units indexed by ``target_inds``
+        source_units : UnitArrays or list of dict
+            the units indexed by ``source_inds``
+        features : list of tesserae.db.entities.Feature
+            Features sorted by index, as used to find the matches
+        tag_helper : tesserae.utils.retrieve.TagHelper
+
+        Returns
+        -------
+        list of tesserae.db.entities.Match
+        """
+        match_ents = []
+        for i in range(len(self)):
+            target_unit = target_units[self.target_inds[i]]
+            source_unit = source_units[self.source_inds[i]]
+            h_start = self.highlight_breaks[i]
+            h_end = self.highlight_breaks[i + 1]
+            f_start = self.feature_breaks[i]
+            f_end = self.feature_breaks[i + 1]
+            match_ents.append(
+                Match(search_id=search_id,
+                      source_unit=source_unit['_id'],
+                      target_unit=target_unit['_id'],
+                      source_tag=tag_helper.get_display_tag(
+                          source_unit['text'], source_unit['tags']),
+                      target_tag=tag_helper.get_display_tag(
+                          target_unit['text'], target_unit['tags']),
+                      matched_features=[
+                          features[int(mf)].token
+                          for mf in self.feature_inds[f_start:f_end]
+                      ],
+                      source_snippet=source_unit['snippet'],
+                      target_snippet=target_unit['snippet'],
+                      highlight=[
+                          (int(s_pos), int(t_pos)) for s_pos, t_pos in zip(
+                              self.source_positions[h_start:h_end],
+                              self.target_positions[h_start:h_end])
+                      ],
+                      score=self.scores[i]))
+        return match_ents
+
+    def to_blocks(self, search_id, start_index, target_units, source_units,
+                  language, feature):
+        """Create MatchBlock entities
+
+        Parameters
+        ----------
+        search_id : bson.objectid.ObjectId
+            ObjectId of the Search to which the matches belong
+        start_index : int
+            the index of the first block created
+        target_units : UnitArrays or list of dict
+            the units indexed by ``target_inds``
+        source_units : UnitArrays or list of dict
+            the units indexed by ``source_inds``
+        language : str
+            language of the features matched
+        feature : str
+            type of the features matched
+
+        Returns
+        -------
+        list of tesserae.db.entities.MatchBlock
+            the matches, in order, in blocks of at most
+            ``COMPACT_BLOCK_SIZE`` matches
+        """
+        blocks = []
+        for start in range(0, len(self), COMPACT_BLOCK_SIZE):
+            chunk = self.select(
+                np.arange(start, min(start + COMPACT_BLOCK_SIZE, len(self))))
+            blocks.append(
+                MatchBlock.from_arrays(
+                    search_id, start_index + len(blocks), language, feature,
+                    chunk.scores, {
+                        'source_unit_ids':
+                        _get_unit_id_rows(source_units, chunk.source_inds),
+                        'target_unit_ids':
+                        _get_unit_id_rows(target_units, chunk.target_inds),
+                        'feature_breaks': chunk.feature_breaks,
+                        'feature_inds': chunk.feature_inds,
+                        'highlight_breaks': chunk.highlight_breaks,
+                        'source_positions': chunk.source_positions,
+                        'target_positions': chunk.target_positions,
+                    }))
+        return blocks
+
+
+def _get_unit_id_rows(units, unit_inds):
+    """Look up the raw bytes of the ObjectIds of units
+
+    Parameters
+    ----------
+    units : UnitArrays or list of dict
+    unit_inds : 1d np.array of ints
+        indices into ``units``
+
+    Returns
+    -------
+    2d np.array of uint8
+        row i holds the 12 bytes of the ObjectId of unit ``unit_inds[i]``
+    """
+    if isinstance(units, UnitArrays):
+        return units.unit_id_rows(unit_inds)
+    return np.frombuffer(b''.join(units[int(i)]['_id'].binary
+                                  for i in unit_inds),
+                         dtype=np.uint8).reshape(-1, 12)
+
+
+class _MatchResultsBuilder(object):
+    """Accumulates matches one at a time into a MatchResults"""
+
+    def __init__(self):
+        self.target_inds = []
+        self.source_inds = []
+        self.numerators = []
+        self.distances = []
+        self.highlight_counts = []
+        self.target_positions = []
+        self.source_positions = []
+        self.feature_counts = []
+        self.feature_inds = []
+
+    def add(self, target_ind, source_ind, match_inv_frequencies, distance,
+            target_positions, source_positions, match_features):
+        """Record a match
+
+        Parameters
+        ----------
+        target_ind, source_ind : int
+            indices of the matched units
+        match_inv_frequencies : list of float
+            the inverse frequencies which sum to the score numerator
+        distance : int
+            the score denominator
+        target_positions, source_positions : 1d np.array of ints
+            highlight information
+        match_features : iterable of int
+            indices of matched features
+        """
+        self.target_inds.append(target_ind)
+        self.source_inds.append(source_ind)
+        # summed in order, as the sparse matrix used previously did
+        self.numerators.append(sum(match_inv_frequencies))
+        self.distances.append(distance)
+        self.highlight_counts.append(len(target_positions))
+        self.target_positions.append(target_positions)
+        self.source_positions.append(source_positions)
+        match_features = list(match_features)
+        self.feature_counts.append(len(match_features))
+        self.feature_inds.extend(match_features)
+
+    def build(self):
+        """Compute scores and assemble the recorded matches
+
+        Returns
+        -------
+        MatchResults
+        """
+        highlight_breaks = np.zeros(len(self.highlight_counts) + 1,
+                                    dtype=np.int64)
+        np.cumsum(self.highlight_counts, out=highlight_breaks[1:])
+        feature_breaks = np.zeros(len(self.feature_counts) + 1,
+                                  dtype=np.int64)
+        np.cumsum(self.feature_counts, out=feature_breaks[1:])
+        if self.numerators:
+            scores = np.log(np.array(self.numerators, dtype=np.float64)) - \
+                np.log(np.array(self.distances, dtype=np.float64))
+            target_positions = np.concatenate(self.target_positions)
+            source_positions = np.concatenate(self.source_positions)
+        else:
+            scores = np.zeros(0, dtype=np.float64)
+            target_positions = np.zeros(0, dtype=np.int64)
+            source_positions = np.zeros(0, dtype=np.int64)
+        return MatchResults(np.array(self.target_inds, dtype=np.int64),
+                            np.array(self.source_inds, dtype=np.int64),
+                            scores, np.array(self.distances, dtype=np.int64),
+                            highlight_breaks, target_positions,
+                            source_positions, feature_breaks,
+                            np.array(self.feature_inds, dtype=np.int64))
+
+
+class _ScoreThreshold(object):
+    """Running lower limit on the scores worth computing for a scoring setting
+
+    Without 'top_k', only ``min_score`` is needed; with it, the limit rises
+    to the lowest of the best 'top_k' scores seen so far.  Every block scorer
+    keeps its own, so a worker process never prunes more than the best scores
+    over all blocks would allow.
+
+    Parameters
+    ----------
+    scoring : dict
+        a scoring setting with the keys 'min_score' and 'top_k' (see
+        ``SparseMatrixSearch.match()``)
+    """
+
+    def __init__(self, scoring):
+        self.min_score = scoring['min_score']
+        self.top_k = scoring['top_k']
+        self.best = []
+
+    def admits(self, bound):
+        """Tell whether a score up to ``bound`` could still be kept"""
+        limit = self.min_score
+        if self.top_k is not None and len(self.best) >= self.top_k:
+            limit = max(limit, self.best[0])
+        return bound >= limit - _SCORE_BOUND_SLACK
+
+    def record(self, score):
+        """Account for a score that was computed in full"""
+        if self.top_k is None or score < self.min_score:
+            return
+        if len(self.best) < self.top_k:
+            heapq.heappush(self.best, score)
+        elif score > self.best[0]:
+            heapq.heapreplace(self.best, score)
+
+
+def _get_score_bounds(hit_breaks, target_inv_freqs, source_inv_freqs,
+                      distances):
+    """Bound the scores of unit pairs from above
+
+    Every hit counts its target and source inverse frequency towards the
+    numerator, even when a position is hit more than once, so the numerator
+    is at least the one actually scored.
+
+    Parameters
+    ----------
+    hit_breaks : 1d np.array of ints
+        the slice ``hit_breaks[i]:hit_breaks[i+1]`` holds the hits of unit
+        pair i; every unit pair must have at least one hit
+    target_inv_freqs, source_inv_freqs : 1d np.array of floats
+        inverse frequency of the target and source form at each hit
+    distances : 1d np.array of ints or int
+        the distance of each unit pair, or a lower bound on all of them
+
+    Returns
+    -------
+    1d np.array of floats
+    """
+    if len(hit_breaks) <= 1:
+        return np.zeros(0, dtype=np.float64)
+    numerators = np.add.reduceat(target_inv_freqs + source_inv_freqs,
+                                 hit_breaks[:-1])
+    with np.errstate(divide='ignore'):
+        return np.log(numerators) - np.log(np.maximum(distances, 1))
+
+
+def _select_best(results, count):
+    """Keep the highest scoring matches, in the order in which they were found
+
+    Parameters
+    ----------
+    results : MatchResults
+    count : int
+        the most matches to keep; among matches with equal scores, the ones
+        found first are kept
+
+    Returns
+    -------
+    MatchResults
+    """
+    if len(results) <= count:
+        return results
+    best = np.argsort(-results.scores, kind='mergesort')[:count]
+    return results.select(np.sort(best))
+
+
+def _concatenate_breaks(breaks_list):
+    """Join breaks arrays of flat arrays that are joined end to end"""
+    offsets = np.cumsum([0] + [b[-1] for b in breaks_list[:-1]])
+    return np.concatenate([breaks_list[0][:1]] + [
+        b[1:] + offset for b, offset in zip(breaks_list, offsets)
+    ])
+
+
+def _select_segments(breaks, keep):
+    """Gather segments of a flat array
+
+    Parameters
+    ----------
+    breaks : 1d np.array of ints
+        the slice ``breaks[i]:breaks[i+1]`` is segment i
+    keep : 1d np.array of ints
+        the segments to gather, in the order they are wanted
+
+    Returns
+    -------
+    new_breaks : 1d np.array of ints
+        breaks for the gathered segments
+    inds : 1d np.array of ints
+        indices into the flat array of the elements of the gathered segments
+    """
+    starts = breaks[:-1][keep]
+    counts = breaks[1:][keep] - starts
+    new_breaks = np.zeros(len(keep) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_breaks[1:])
+    inds = np.repeat(starts - new_breaks[:-1], counts) + \
+        np.arange(new_breaks[-1])
+    return new_breaks, inds
+
+
+def _get_inv_frequencies_getters(connection, score_basis, freq_basis, source,
+                                 targets, source_units, target_units_list):
+    """Make the functions which look up inverse frequencies for scoring
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    score_basis, freq_basis
+        see ``SparseMatrixSearch.match()``
+    source : tesserae.matchers.text_options.TextOptions
+    targets : list of tesserae.matchers.text_options.TextOptions
+    source_units : UnitArrays
+    target_units_list : list of UnitArrays
+        the units of each target
+
+    Returns
+    -------
+    source_inv_frequencies_getter : (int) -> float
+    target_inv_frequencies_getters : list of (int) -> float
+        one for each target
+    """
+    source_language = source.text.language
+    if freq_basis != 'texts':
+        # the inverse frequency of a form only depends on the language, so
+        # texts in the same language can share a getter
+        source_inv_frequencies_getter = _inverse_averaged_freq_getter(
+            get_corpus_frequencies(connection, score_basis, source_language),
+            itertools.chain.from_iterable([source_units] + [
+                target_units
+                for target, target_units in zip(targets, target_units_list)
+                if target.text.language == source_language
+            ]))
+        target_inv_frequencies_getters = [
+            source_inv_frequencies_getter
+            if target.text.language == source_language else
+            _inverse_averaged_freq_getter(
+                get_corpus_frequencies(connection, score_basis,
+                                       target.text.language), target_units)
+            for target, target_units in zip(targets, target_units_list)
+        ]
+        return source_inv_frequencies_getter, target_inv_frequencies_getters
+
+    def _get_text_getter(text):
+        if score_basis == 'sound':
+            return _ArrayLookup(
+                get_sound_inverse_text_freq(connection, text.id))
+        return _ArrayLookup(
+            get_inverse_text_frequencies(connection, score_basis, text.id))
+
+    return _get_text_getter(source.text), [
+        _get_text_getter(target.text) for target in targets
+    ]
+
+
+def _get_trivial_distance(p0, p1):
+    """Calculates the distance between two positions
+
+    Parameters
+    ----------
+    p0, p1 : ints
+        token positions in the unit where matches were found
+    """
+    if p0 == p1:
+        return 0
+    return abs(p0 - p1) + 1
+
+
+def _get_distance_by_least_frequency(get_inv_freq, positions, forms):
+    """Obtains the distance by least frequency for a unit
+
+    Contrary to the v3 help documentation on --dist in read_table.pl, v3
+    behavior is that distance is inclusive of both matched words.  Thus,
+    adjacent words have a distance of 2, an intervening word increases the
+    distance to 3, and so forth.  This function behaves as v3 behaves instead
+    of how it prescribes.
+
+    Parameters
+    ----------
+    get_inv_freq : (int) -> float
+        a function that takes a word form index as input and returns its
+        inverse frequency as output
+    positions : 1d np.array of ints
+        token positions in the unit where matches were found
+    forms : 1d np.array of ints
+        the token forms of the unit
+    """
+    if len(set(forms[positions])) < 2:
+        return 0
+    if len(positions) == 2:
+        return _get_trivial_distance(positions[0], positions[1])
+    sorted_positions = np.array(sorted(positions))
+    inv_freqs = np.array([get_inv_freq(f) for f in forms[sorted_positions]])
+    # lowest inverse frequencies are the highest frequencies, so need to flip;
+    # a stable sort keeps the earliest position first among ties
+    freq_sort = np.argsort(-inv_freqs, kind='mergesort')
+    idx = sorted_positions[freq_sort]
+    if idx.shape[0] >= 2:
+        not_first_pos = idx[idx != idx[0]]
+        if not_first_pos.shape[0] > 0:
+            end = not_first_pos[0]
+            return np.abs(end - idx[0]) + 1
+    return 0
+
+
+def _get_distance_by_span(matched_positions, forms):
+    """Calculate distance between two matching words
+
+    Parameters
+    ----------
+    matched_positions : 1d np.array of ints
+        the positions at which matched words were found in a unit
+    forms : 1d np.array of ints
+        the token forms of the unit
+    """
+    if len(set(forms[matched_positions])) < 2:
+        return 0
+    if len(matched_positions) == 2:
+        return _get_trivial_distance(matched_positions[0],
+                                     matched_positions[1])
+    start_pos = np.min(matched_positions)
+    end_pos = np.max(matched_positions)
+    if start_pos != end_pos:
+        return np.abs(end_pos - start_pos) + 1
+    return 0
+
+
+def _segment_has_distinct_forms(hit_breaks, forms):
+    """Tell which segments of ``forms`` contain at least two distinct forms
+
+    Parameters
+    ----------
+    hit_breaks : 1d np.array of ints
+        the slice ``hit_breaks[i]:hit_breaks[i+1]`` is segment i; every
+        segment must be non-empty
+    forms : 1d np.array of ints
+        the token form at each hit
+
+    Returns
+    -------
+    1d np.array of bool
+    """
+    starts = hit_breaks[:-1]
+    return np.minimum.reduceat(forms, starts) != \
+        np.maximum.reduceat(forms, starts)
+
+
+def _get_distances_by_least_frequency(hit_breaks, positions, forms,
+                                      inv_freqs):
+    """Batched version of ``_get_distance_by_least_frequency()``
+
+    Distances for every unit pair of a source block are computed at once.
+    When several positions share the same inverse frequency, the earliest of
+    them is taken to be the less frequent one.
+
+    Parameters
+    ----------
+    hit_breaks : 1d np.array of ints
+        the slice ``hit_breaks[i]:hit_breaks[i+1]`` of the other arrays holds
+        the hits of unit pair i; every unit pair must have at least one hit
+    positions : 1d np.array of ints
+        token position within the unit of each hit
+    forms : 1d np.array of ints
+        token form at each hit
+    inv_freqs : 1d np.array of floats
+        inverse frequency of the form at each hit
+
+    Returns
+    -------
+    1d np.array of ints
+        the distance for each unit pair; 0 where there were fewer than two
+        distinct forms among the hits
+    """
+    num_pairs = len(hit_breaks) - 1
+    if num_pairs <= 0:
+        return np.zeros(0, dtype=np.int64)
+    counts = np.diff(hit_breaks)
+    starts = hit_breaks[:-1]
+    segments = np.repeat(np.arange(num_pairs), counts)
+    # within each segment, order hits from least frequent to most frequent,
+    # with ties broken by position
+    order = np.lexsort((positions, -inv_freqs, segments))
+    sorted_positions = positions[order]
+    first = sorted_positions[starts]
+    # the end position is the first position, in this order, that differs
+    # from the least frequent position
+    differs = sorted_positions != np.repeat(first, counts)
+    candidates = np.where(differs, np.arange(len(sorted_positions)),
+                          len(sorted_positions))
+    end_inds = np.minimum.reduceat(candidates, starts)
+    valid = _segment_has_distinct_forms(hit_breaks, forms)
+    distances = np.zeros(num_pairs, dtype=np.int64)
+    distances[valid] = np.abs(sorted_positions[end_inds[valid]] -
+                              first[valid]) + 1
+    return distances
+
+
+def _get_distances_by_span(hit_breaks, positions, forms):
+    """Batched version of ``_get_distance_by_span()``
+
+    Parameters
+    ----------
+    hit_breaks, positions, forms
+        see ``_get_distances_by_least_frequency()``
+
+    Returns
+    -------
+    1d np.array of ints
+        the distance for each unit pair; 0 where there were fewer than two
+        distinct forms among the hits
+    """
+    num_pairs = len(hit_breaks) - 1
+    if num_pairs <= 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = hit_breaks[:-1]
+    valid = _segment_has_distinct_forms(hit_breaks, forms)
+    distances = np.zeros(num_pairs, dtype=np.int64)
+    distances[valid] = (np.maximum.reduceat(positions, starts) -
+                        np.minimum.reduceat(positions, starts))[valid] + 1
+    return distances
+
+
+def _lookup_inv_freqs(get_inv_freq, forms):
+    """Look up inverse frequencies for many forms
+
+    The getter is called once per distinct form, unless it is an
+    ``_ArrayLookup``, whose array is indexed directly.
+
+    Parameters
+    ----------
+    get_inv_freq : (int) -> float
+        a function that takes a word form index as input and returns its
+        inverse frequency as output
+    forms : 1d np.array of ints
+
+    Returns
+    -------
+    1d np.array of floats
+    """
+    if isinstance(get_inv_freq, _ArrayLookup):
+        return get_inv_freq.values[forms].astype(np.float64)
+    unique_forms, inverse = np.unique(forms, return_inverse=True)
+    return np.array([get_inv_freq(f) for f in unique_forms],
+                    dtype=np.float64)[inverse.reshape(-1)]
+
+
+class _ArrayLookup(object):
+    """Make an array indexed by feature index act like a function
+
+    Parameters
+    ----------
+    values : 1d np.array
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+    def __call__(self, key):
+        return self.values[key]
+
+
+def _inverse_averaged_freq_getter(d, units_iter):
+    cache = {}
+    for unit in units_iter:
+        for form, feats in zip(unit['forms'], unit['features']):
+            if form in cache:
+                continue
+            cache[form] = 1.0 / np.mean([d[f] for f in feats])
+
+    def _inner(key):
+        return cache[key]
+
+    return _inner
+
+
+def _extract_features_and_positions(units, stoplist_set):
+    """Grab feature and token information from units
+
+    All features for every token within each of the units will be accounted for
+    exactly once.
+
+    Parameters
+    ----------
+    units : UnitArrays or list of dict
+        the units of a source or target text (see ``UnitArrays`` for the keys
+        of each dictionary)
+    stoplist_set : set of int
+        feature indices which should not be recorded
+
+    Returns
+    -------
+    feature_inds : 1d np.array of int
+    pos_inds : 1d np.array of int
+        ``feature_inds[i]`` should be equal to a feature index present at the
+        position equal to ``pos_inds[i]``
+    break_inds : 1d np.array of int
+        for the slice ``break_inds[i]:break_inds[i+1]``, those are the position
+        indices that belong to ``units[i]``
+
+    Example
+    -------
+    >>> unit_0 = {... 'forms': [1], 'features': [[10, 20]]}
+    >>> unit_1 = {... 'forms': [5, 17], 'features': [[7], [21, 30]]}
+    >>> units = [unit_0, unit_1]
+    >>> feature_inds, pos_inds, break_inds = \
+    >>> ... _extract_features_and_positions(units, {7})
+    >>> feaure_inds == np.array([10, 20, 21, 30])
+    >>> pos_inds == np.array([0, 0, 2, 2])
+    >>> break_inds == np.array([0, 1, 3])
+
+    """
+    if isinstance(units, UnitArrays):
+        return units.extract_features_and_positions(stoplist_set)
+    feature_inds = []
+    pos_inds = []
+    break_inds = [0]
+    for unit in units:
+        end_break_inds = break_inds[-1]
+        cur_features = unit['features']
+        for i, features in enumerate(cur_features):
+            valid_features = [
+                f for f in features if f not in stoplist_set and f >= 0
+            ]
+            if -1 in valid_features:
+                print(unit)
+            feature_inds.extend(valid_features)
+            pos_inds.extend([end_break_inds + i] * len(valid_features))
+        break_inds.append(end_break_inds + len(cur_features))
+    return np.array(feature_inds), np.array(pos_inds), np.array(break_inds)
+
+
+def _construct_feature_unit_matrix(units, stoplist_set, features_size):
+    """Build a matrix where rows correspond to features and columns to
+    positions within units
+
+    Parameters
+    ----------
+    units : UnitArrays or list of dict
+        the units of a source or target text (see ``UnitArrays`` for the keys
+        of each dictionary)
+    stoplist_set : set of int
+        feature indices which should not be recorded
+    features_size : int
+        the total number of feature types for the class of features contained
+        in ``units``
+
+    Returns
+    -------
+    M : csr_matrix
+        the result matrix; if ``M[i, j] == True``, the feature with index i
+        appears at position j.
+    break_inds : list of int
+        see ``_extract_features_and_positions()`` for details
+
+    """
+    if isinstance(units, UnitArrays):
+        return (units.feature_matrix(stoplist_set, features_size).T.tocsr(),
+                units.break_inds)
+    feature_inds, pos_inds, break_inds = _extract_features_and_positions(
+        units, stoplist_set)
+    for sw in stoplist_set:
         if np.any(feature_inds == sw):
             raise Exception('Stopword in Feature x Unit Matrix!')
     return (csr_matrix(
@@ -516,9 +1868,9 @@ def _construct_unit_feature_matrix(units, stoplist_set, features_size):
 
     Parameters
     ----------
-    units
-        ``units`` should be either ``source_units`` or ``target_units`` from
-        ``_gen_matches(...)``
+    units : UnitArrays or list of dict
+        the units of a source or target text (see ``UnitArrays`` for the keys
+        of each dictionary)
     stoplist_set : set of int
         feature indices which should not be recorded
     features_size : int
@@ -534,6 +1886,9 @@ def _construct_unit_feature_matrix(units, stoplist_set, features_size):
         see ``_extract_features_and_positions()`` for details
 
     """
+    if isinstance(units, UnitArrays):
+        return units.feature_matrix(stoplist_set,
+                                    features_size), units.break_inds
     feature_inds, pos_inds, break_inds = _extract_features_and_positions(
         units, stoplist_set)
     for sw in stoplist_set:
@@ -550,26 +1905,8 @@ def _bin_hits_to_unit_indices(rows, cols, row2t_unit_ind, target_breaks,
 
     Parameters
     ----------
-    rows : 1d np.array of ints
-        rows is all i for which ``match_matrix[i, j] == True``; also, for all
-        z, ``match_matrix[rows[z], cols[z]] == True``; all other indices should
-        yield False
-    cols : 1d np.array of ints
-        cols is all j for which ``match_matrix[i, j] == True``; also, for all
-        z, ``match_matrix[rows[z], cols[z]] == True``; all other indices should
-        yield False
-    row2t_unit_ind : 1d np.array of ints
-        mapping between row index of matrix and unit index of target
-    target_breaks : 1d np.array of ints
-        ``target_breaks[t]`` tells which row target unit t starts on; thus, the
-        range ``target_breaks[t]:target_breaks[t+1]`` includes all the rows
-        which belong to target unit t; ``len(target_breaks)`` is equal to one
-        more than the total number of target units
-    source_breaks : 1d np.array of ints
-        like ``target_breaks``, except it keeps track of which columns belong
-        to which source unit
-    su_start : int
-        an offset by which to increment source indices
+    rows, cols, row2t_unit_ind, target_breaks, source_breaks, su_start
+        see ``_group_hits()``
 
     Returns
     -------
@@ -596,196 +1933,637 @@ def _bin_hits_to_unit_indices(rows, cols, row2t_unit_ind, target_breaks,
     >>> hits2positions[(0, 0)] == np.array([[0, 0], [1, 2]])
 
     """
-    # keep track of mapping between matrix column index and source unit index
-    # in ``source_units``
-    col2s_unit_ind = np.array([
-        u_ind for u_ind in range(len(source_breaks) - 1)
-        for _ in range(source_breaks[u_ind + 1] - source_breaks[u_ind])
-    ])
-    tmp = {}
-    hits2positions = {}
-    t_inds = row2t_unit_ind[rows]
-    s_inds = col2s_unit_ind[cols]
-    t_poses = rows - target_breaks[t_inds]
-    s_poses = cols - source_breaks[s_inds]
-    # although s_inds needs to index the source_breaks by the ordering of this
-    # batch of source_units, s_inds needs to account for source_unit indices as
-    # referenced from outside of this batch
-    s_inds += su_start
-    for t_ind, s_ind, t_pos, s_pos in zip(t_inds, s_inds, t_poses, s_poses):
-        key = (t_ind, s_ind)
-        if key not in tmp:
-            tmp[key] = (t_pos, s_pos)
-        elif key not in hits2positions:
-            hits2positions[key] = [tmp[key], (t_pos, s_pos)]
-        else:
-            hits2positions[key].append((t_pos, s_pos))
-    hits2positions = {k: np.array(v) for k, v in hits2positions.items()}
-    return hits2positions
+    return _grouped_hits_to_dict(*_group_hits(
+        rows, cols, row2t_unit_ind, _breaks_to_unit_inds(source_breaks),
+        target_breaks, source_breaks, su_start))
 
 
-def gen_hits2positions(search, conn, target_feature_matrix, target_breaks,
-                       source_units, stoplist_set, features_size):
-    """Generate matching units based on unit information
+def _breaks_to_unit_inds(breaks):
+    """Map each position to the index of the unit it belongs to
+
+    Parameters
+    ----------
+    breaks : 1d np.array of ints
+        the range ``breaks[u]:breaks[u+1]`` includes all positions which
+        belong to unit u
+
+    Returns
+    -------
+    1d np.array of ints
+        the value at index p is the unit to which position p belongs
+    """
+    return np.repeat(np.arange(len(breaks) - 1), np.diff(breaks))
+
+
+def _group_hits(rows, cols, row2t_unit_ind, col2s_unit_ind, target_breaks,
+                source_breaks, su_start):
+    """Group the nonzeros of the ``match_matrix`` by unit pair
+
+    Only unit pairs with at least two hits are kept.  Within a unit pair, hits
+    keep the order in which they appear in ``rows`` and ``cols``.
+
+    Parameters
+    ----------
+    rows : 1d np.array of ints
+        rows is all i for which ``match_matrix[i, j] == True``; also, for all
+        z, ``match_matrix[rows[z], cols[z]] == True``; all other indices should
+        yield False
+    cols : 1d np.array of ints
+        cols is all j for which ``match_matrix[i, j] == True``; also, for all
+        z, ``match_matrix[rows[z], cols[z]] == True``; all other indices should
+        yield False
+    row2t_unit_ind : 1d np.array of ints
+        mapping between row index of matrix and unit index of target
+    col2s_unit_ind : 1d np.array of ints
+        mapping between column index of matrix and unit index of the source
+        units in this batch
+    target_breaks : 1d np.array of ints
+        ``target_breaks[t]`` tells which row target unit t starts on; thus, the
+        range ``target_breaks[t]:target_breaks[t+1]`` includes all the rows
+        which belong to target unit t; ``len(target_breaks)`` is equal to one
+        more than the total number of target units
+    source_breaks : 1d np.array of ints
+        like ``target_breaks``, except it keeps track of which columns belong
+        to which source unit
+    su_start : int
+        an offset by which to increment source indices
+
+    Returns
+    -------
+    t_inds : 1d np.array of ints
+        target unit index of each unit pair
+    s_inds : 1d np.array of ints
+        source unit index of each unit pair, offset by ``su_start``
+    hit_breaks : 1d np.array of ints
+        the slice ``hit_breaks[i]:hit_breaks[i+1]`` of ``t_poses`` and
+        ``s_poses`` holds the hits of unit pair i
+    t_poses : 1d np.array of ints
+        target position of each hit, grouped by unit pair
+    s_poses : 1d np.array of ints
+        source position of each hit, grouped by unit pair
+
+    """
+    hit_t_inds = row2t_unit_ind[rows]
+    hit_s_inds = col2s_unit_ind[cols]
+    num_source_units = len(source_breaks) - 1
+    keys = hit_t_inds.astype(np.int64) * num_source_units + hit_s_inds
+    # a stable sort keeps hits within a unit pair in their original order
+    order = np.argsort(keys, kind='mergesort')
+    unique_keys, counts = np.unique(keys[order], return_counts=True)
+    kept = counts >= 2
+    order = order[np.repeat(kept, counts)]
+    hit_breaks = np.zeros(np.count_nonzero(kept) + 1, dtype=np.int64)
+    np.cumsum(counts[kept], out=hit_breaks[1:])
+    unique_keys = unique_keys[kept]
+    hit_t_inds = hit_t_inds[order]
+    hit_s_inds = hit_s_inds[order]
+    t_poses = rows[order] - target_breaks[hit_t_inds]
+    s_poses = cols[order] - source_breaks[hit_s_inds]
+    # although source unit indices need to index the source_breaks by the
+    # ordering of this batch of source_units, the returned indices need to
+    # account for source_unit indices as referenced from outside of this batch
+    return (unique_keys // num_source_units,
+            unique_keys % num_source_units + su_start, hit_breaks, t_poses,
+            s_poses)
+
+
+def _grouped_hits_to_dict(t_inds, s_inds, hit_breaks, t_poses, s_poses):
+    """Convert the output of ``_group_hits()`` into a dictionary
+
+    Returns
+    -------
+    hits2positions : dict [(int, int), 2d np.array of ints]
+        see ``_bin_hits_to_unit_indices()`` for details
+    """
+    positions = np.column_stack((t_poses, s_poses))
+    return {(t_ind, s_ind): positions[start:end]
+            for t_ind, s_ind, start, end in zip(t_inds, s_inds,
+                                                hit_breaks[:-1],
+                                                hit_breaks[1:])}
+
+
+def _gen_block_hits(searches, conn, target_feature_matrix, target_breaks,
+                    source_units, stoplist_set, features_size, process_hits,
+                    processes=1, memory_budget=None, upper_triangle=False):
+    """Find unit pairs with at least two hits, one block of source units at a
+    time
+
+    The number of source units in each block is chosen so that matching the
+    block stays within ``memory_budget``; the block sizes are recorded on
+    each of ``searches`` (see ``_record_block_stats()``).
 
     Parameters
     ----------
-    source_units : list of dict
-        each dictionary represents unit information from the source text
-    target_units : list of dict
-        each dictionary represents unit information from the target text
+    searches : list of tesserae.db.entities.Search
+        the search jobs associated with this matching job; all of them
+        receive progress updates
+    conn : TessMongoConnection
+    target_feature_matrix : csr_matrix
+        matrix where rows correspond to target positions and columns to
+        features (see ``_construct_unit_feature_matrix()``)
+    target_breaks : 1d np.array of ints
+        ``target_breaks[t]`` tells which row target unit t starts on
+    source_units : UnitArrays or list of dict
+        the units of the source text
     stoplist_set : set of int
         feature indices on which matches should not be permitted
     features_size : int
         the total number of feature types for the class of features contained
-        in ``units``
+        in the units
+    process_hits : (1d np.array of ints, ...) -> object
+        a function that takes the arrays described in ``_group_hits()`` for a
+        block and returns the result for that block
+    processes : int, optional
+        see ``_map_source_blocks()``
+    memory_budget : int, optional
+        number of bytes that matching a block may use; defaults to
+        ``MATCH_MEMORY_BUDGET``.  The budget applies to each block, so that
+        the blocks (and so the order of the results) do not depend on how
+        many processes are used
+    upper_triangle : bool, optional
+        see ``_find_block_hits()``
 
-    Notes
-    -----
-    The dictionaries in the input lists must contain the following string keys
-    and corresponding values:
-    '_id' : bson.objectid.ObjectId
-        ObjectId of the Unit entity in the database
-    'index' : int
-        index of the Unit entity in the database
-    'tags' : list of str
-        tag information for this unit
-    'forms' : list of int
-        the ``...['forms'][y]`` is the integer associated with the form
-        Feature of the word token at position y
-    'features' : list of list of int
-        each position of this list corresponds to the same position in the
-        'forms' list; thus, ...['features'][a] is a list of the Feature indices
-        derived from ...['forms'][a].
+    Yields
+    ------
+    object
+        the result of ``process_hits`` for each block, in block order
+
+    """
+    if memory_budget is None:
+        memory_budget = MATCH_MEMORY_BUDGET
+    # keep track of mapping between matrix row index and target unit index
+    row2t_unit_ind = _breaks_to_unit_inds(target_breaks)
+    target_unit_matrix = _count_features_by_unit(
+        target_feature_matrix, row2t_unit_ind, len(target_breaks) - 1)
+    block_bounds, estimated_nnzs = _plan_source_blocks(
+        target_feature_matrix, source_units, stoplist_set,
+        memory_budget // _BYTES_PER_PRODUCT_NONZERO)
+
+    def _process_block(su_start, su_end):
+        grouped, nnz = _find_block_hits(target_feature_matrix, target_breaks,
+                                        row2t_unit_ind, target_unit_matrix,
+                                        source_units, su_start, su_end,
+                                        stoplist_set, features_size,
+                                        upper_triangle)
+        return process_hits(*grouped), nnz
+
+    nnzs = []
+    for result, nnz in _map_source_blocks(searches, conn, block_bounds,
+                                          _process_block, processes):
+        nnzs.append(nnz)
+        yield result
+    for search in searches:
+        _record_block_stats(search, memory_budget, block_bounds,
+                            estimated_nnzs, nnzs)
+
+
+def _plan_source_blocks(target_feature_matrix, source_units, stoplist_set,
+                        max_nnz):
+    """Divide the source units into blocks to be matched one at a time
+
+    Each block holds as many consecutive source units as possible without
+    the estimated number of nonzeros in its match matrix exceeding
+    ``max_nnz``, though every block holds at least one source unit.
+
+    The estimate is an upper bound: a source position with feature f can
+    match at most as many target positions as have feature f.
+
+    Parameters
+    ----------
+    target_feature_matrix, source_units, stoplist_set
+        see ``_gen_block_hits()``
+    max_nnz : int
+        the number of match matrix nonzeros a block may have
+
+    Returns
+    -------
+    block_bounds : 1d np.array of ints
+        block i covers the source units ``block_bounds[i]:block_bounds[i+1]``
+    estimated_nnzs : 1d np.array of floats
+        estimated number of match matrix nonzeros of each block
+    """
+    # number of target positions with each feature
+    target_counts = target_feature_matrix.getnnz(axis=0)
+    feature_inds, pos_inds, break_inds = _extract_features_and_positions(
+        source_units, stoplist_set)
+    feature_inds = np.asarray(feature_inds, dtype=np.int64)
+    pos_inds = np.asarray(pos_inds, dtype=np.int64)
+    unit_costs = np.bincount(
+        _breaks_to_unit_inds(np.asarray(break_inds))[pos_inds],
+        weights=target_counts[feature_inds],
+        minlength=len(source_units))
+    cumulative = np.zeros(len(source_units) + 1)
+    np.cumsum(unit_costs, out=cumulative[1:])
+    block_bounds = [0]
+    while block_bounds[-1] < len(source_units):
+        start = block_bounds[-1]
+        end = np.searchsorted(
+            cumulative, cumulative[start] + max_nnz, side='right') - 1
+        block_bounds.append(min(max(end, start + 1), len(source_units)))
+    block_bounds = np.array(block_bounds)
+    return block_bounds, np.diff(cumulative[block_bounds])
+
+
+def _record_block_stats(search, memory_budget, block_bounds, estimated_nnzs,
+                        nnzs):
+    """Note on the Search how source units were divided into blocks
+
+    Parameters
+    ----------
+    search : tesserae.db.entities.Search
+    memory_budget : int
+        number of bytes that matching a block was allowed to use
+    block_bounds, estimated_nnzs
+        see ``_plan_source_blocks()``
+    nnzs : list of int
+        actual number of match matrix nonzeros of each block
+    """
+    search.match_stats = {
+        'memory_budget': int(memory_budget),
+        'block_sizes': np.diff(block_bounds).tolist(),
+        'estimated_peak_nnz': int(max(estimated_nnzs, default=0)),
+        'peak_nnz': int(max(nnzs, default=0)),
+    }
+
+
+def _find_block_hits(target_feature_matrix, target_breaks, row2t_unit_ind,
+                     target_unit_matrix, source_units, su_start, su_end,
+                     stoplist_set, features_size, upper_triangle=False):
+    """Find unit pairs with at least two hits for one block of source units
+
+    Unit pairs which cannot have two hits are ruled out before hits are
+    found at the position level: the number of (target position, source
+    position, feature) triples that a unit pair shares is an upper bound on
+    its number of hits, and these counts for all unit pairs of the block come
+    from a single product of unit by feature count matrices.  Position level
+    hits are then only computed for the target units which remain, and only
+    the hits of unit pairs which remain are grouped.
+
+    Parameters
+    ----------
+    target_feature_matrix, target_breaks, source_units, stoplist_set,
+    features_size
+        see ``_gen_block_hits()``
+    row2t_unit_ind : 1d np.array of ints
+        mapping between row index of ``target_feature_matrix`` and target unit
+        index
+    target_unit_matrix : csr_matrix
+        the number of positions in each target unit with each feature (see
+        ``_count_features_by_unit()``)
+    su_start, su_end : int
+        the block consists of ``source_units[su_start:su_end]``
+    upper_triangle : bool, optional
+        if True, only unit pairs whose target unit index is less than their
+        source unit index are considered; when the target units are the
+        source units, this finds each pair of distinct units once
+
+    Returns
+    -------
+    grouped : tuple of 1d np.array of ints
+        see ``_group_hits()`` for details on what this tuple contains
+    nnz : int
+        number of nonzeros computed for the block's match matrix
+    """
+    feature_source_matrix, source_breaks = _construct_feature_unit_matrix(
+        source_units[su_start:su_end], stoplist_set, features_size)
+    col2s_unit_ind = _breaks_to_unit_inds(source_breaks)
+    num_source_units = len(source_breaks) - 1
+    if upper_triangle:
+        # no target unit after the last source unit of the block can be kept
+        target_unit_matrix = target_unit_matrix[:max(su_end - 1, 0)]
+    # how many (target position, source position, feature) triples each unit
+    # pair shares
+    shared_counts = target_unit_matrix.dot(
+        _count_features_by_unit(feature_source_matrix.T, col2s_unit_ind,
+                                num_source_units).T).tocsr()
+    shared_counts.sort_indices()
+    pair_t_inds = _breaks_to_unit_inds(shared_counts.indptr)
+    is_candidate = shared_counts.data >= 2
+    if upper_triangle:
+        is_candidate &= pair_t_inds < su_start + shared_counts.indices
+    candidates = np.flatnonzero(is_candidate)
+    # ordered by target unit, then by source unit
+    candidate_keys = pair_t_inds[candidates].astype(np.int64) \
+        * num_source_units + shared_counts.indices[candidates]
+    # only rows of target units in some candidate pair need to be multiplied
+    candidate_rows = np.flatnonzero(
+        np.isin(row2t_unit_ind,
+                np.unique(candidate_keys // num_source_units)))
+    # for every position of each remaining target unit, this matrix
+    # multiplication picks up which source unit positions shared at least one
+    # common feature
+    match_matrix = target_feature_matrix[candidate_rows].dot(
+        feature_source_matrix)
+    # this data structure keeps track of which target unit position matched
+    # with which source unit position
+    coo = match_matrix.tocoo()
+    rows = candidate_rows[coo.row]
+    cols = coo.col
+    hit_keys = row2t_unit_ind[rows].astype(np.int64) * num_source_units + \
+        col2s_unit_ind[cols]
+    found = np.searchsorted(candidate_keys, hit_keys)
+    found[found == len(candidate_keys)] = 0
+    in_candidate = candidate_keys[found] == hit_keys if \
+        len(candidate_keys) else np.zeros(len(hit_keys), dtype=bool)
+    return _group_hits(rows[in_candidate], cols[in_candidate],
+                       row2t_unit_ind, col2s_unit_ind, target_breaks,
+                       source_breaks, su_start), coo.nnz
+
+
+def _count_features_by_unit(position_feature_matrix, pos2unit_ind,
+                            num_units):
+    """Count how many positions of each unit have each feature
+
+    Parameters
+    ----------
+    position_feature_matrix : csr_matrix
+        matrix where rows correspond to positions and columns to features
+    pos2unit_ind : 1d np.array of ints
+        mapping between row index of ``position_feature_matrix`` and unit
+        index
+    num_units : int
+        the total number of units
+
+    Returns
+    -------
+    csr_matrix
+        matrix of ints where rows correspond to units and columns to features
+    """
+    num_positions = position_feature_matrix.shape[0]
+    unit_position_matrix = csr_matrix(
+        (np.ones(num_positions, dtype=np.int32),
+         (pos2unit_ind, np.arange(num_positions))),
+        shape=(num_units, num_positions))
+    return unit_position_matrix.dot(
+        position_feature_matrix.astype(np.int32)).tocsr()
+
+
+def _map_source_blocks(searches, conn, block_bounds, process_block,
+                       processes=1):
+    """Process every block of source units, in order
+
+    Parameters
+    ----------
+    searches : list of tesserae.db.entities.Search
+        The search jobs associated with this matching job.
+    conn : TessMongoConnection
+    block_bounds : 1d np.array of ints
+        see ``_plan_source_blocks()``
+    process_block : (int, int) -> object
+        a function that takes the bounds of a block of source units as input
+        and returns the result for that block
+    processes : int, optional
+        the number of worker processes among which to divide the blocks; the
+        blocks are processed in this process when it is less than 2
+
+    Yields
+    ------
+    object
+        the result of ``process_block`` for each block, in block order
+        regardless of how many worker processes were used
+    """
+    blocks = [(int(su_start), int(su_end))
+              for su_start, su_end in zip(block_bounds[:-1], block_bounds[1:])]
+    num_source_units = block_bounds[-1]
+    if processes is None or processes < 2 or len(blocks) < 2 or \
+            'fork' not in multiprocessing.get_all_start_methods():
+        with ProgressReporter(conn, searches) as progress:
+            for su_start, su_end in blocks:
+                progress.report(su_start / num_source_units)
+                yield process_block(su_start, su_end)
+        return
+    global _block_processor
+    # forked workers find ``process_block`` here, so the (possibly large)
+    # data it refers to is shared copy-on-write instead of being pickled
+    _block_processor = process_block
+    try:
+        # the workers are forked before the progress reporter starts its
+        # thread; callers that run threads of their own must start them only
+        # after the first result is yielded (see
+        # ``tesserae.utils.search._save_batches()``)
+        with multiprocessing.get_context('fork').Pool(
+                min(processes, len(blocks))) as pool, \
+                ProgressReporter(conn, searches) as progress:
+            for (su_start, _), result in zip(
+                    blocks, pool.imap(_run_block_processor, blocks)):
+                progress.report(su_start / num_source_units)
+                yield result
+    finally:
+        _block_processor = None
+
+
+def _run_block_processor(bounds):
+    """Process a source block in a worker of ``_map_source_blocks()``"""
+    return _block_processor(*bounds)
+
+
+def gen_hits2positions(search, conn, target_feature_matrix, target_breaks,
+                       source_units, stoplist_set, features_size):
+    """Generate matching units based on unit information
+
+    Parameters
+    ----------
+    search : tesserae.db.entities.Search
+        the search job associated with this matching job
+    conn : TessMongoConnection
+    target_feature_matrix, target_breaks, source_units, stoplist_set,
+    features_size
+        see ``_gen_block_hits()``
 
     Yields
     ------
     dict [(int, int), 2d np.array of ints]
         see ``_bin_hits_to_unit_indices()`` for details on what this dictionary
-        contains
+        contains; one dictionary is yielded per block of source units
 
     """
-    # keep track of mapping between matrix row index and target unit index
-    # in ``target_units``
-    row2t_unit_ind = np.array([
-        u_ind for u_ind in range(len(target_breaks) - 1)
-        for _ in range(target_breaks[u_ind + 1] - target_breaks[u_ind])
-    ])
-    stepsize = 500
-    for su_start in range(0, len(source_units), stepsize):
-        search.update_current_stage_value(su_start / len(source_units))
-        conn.update(search)
-        feature_source_matrix, source_breaks = _construct_feature_unit_matrix(
-            source_units[su_start:su_start + stepsize], stoplist_set,
-            features_size)
-        # for every position of each target unit, this matrix multiplication
-        # picks up which source unit positions shared at least one common
-        # feature
-        match_matrix = target_feature_matrix.dot(feature_source_matrix)
-        # this data structure keeps track of which target unit position matched
-        # with which source unit position
-        coo = match_matrix.tocoo()
-        yield _bin_hits_to_unit_indices(coo.row, coo.col, row2t_unit_ind,
-                                        target_breaks, source_breaks, su_start)
-
-
-def _gen_matches(search, conn, target_units, source_units, stoplist_set,
-                 features_size):
-    """Generate match information where at least 2 positions matched
+    yield from _gen_block_hits([search], conn, target_feature_matrix,
+                               target_breaks, source_units, stoplist_set,
+                               features_size, _grouped_hits_to_dict)
+
+
+def _gen_scored_blocks(searches, conn, target_units_list, source_units,
+                       stoplist_set, features_size, score_blocks, processes,
+                       memory_budget, upper_triangle=False):
+    """Find and score matches, one block of source units at a time
+
+    The target texts are matched against the source text together: their
+    unit-by-feature matrices are stacked, so that each block of source units
+    needs only one matrix product.
 
     Parameters
     ----------
-    search : tesserae.db.entities.Search
-        The search job associated with this matching job.
+    searches : list of tesserae.db.entities.Search
+        the search job associated with each target text; all of them receive
+        progress updates
     conn : TessMongoConnection
-    target_units : list of dict
-        each dictionary represents unit information from the target text
-    source_units : list of dict
-        each dictionary represents unit information from the source text
+    target_units_list : list of UnitArrays
+        the units of each target text
+    source_units : UnitArrays
+        the units of the source text
     stoplist_set : set of int
         feature indices on which matches should not be permitted
     features_size : int
         the total number of feature types for the class of features contained
-        in ``units``
-
-    Notes
-    -----
-    The dictionaries in the input lists must contain the following string keys
-    and corresponding values:
-    '_id' : bson.objectid.ObjectId
-        ObjectId of the Unit entity in the database
-    'index' : int
-        index of the Unit entity in the database
-    'tags' : list of str
-        tag information for this unit
-    'forms' : list of int
-        the ``...['forms'][y]`` is the integer associated with the form
-        Feature of the word token at position y
-    'features' : list of list of int
-        each position of this list corresponds to the same position in the
-        'forms' list; thus, ...['features'][a] is a list of the Feature indices
-        derived from ...['forms'][a].
+        in the units
+    score_blocks : list of (1d np.array of ints, ...) -> list of MatchResults
+        for each target text, a function that scores the unit pairs of a
+        block under one or more scoring settings; its arguments are the arrays
+        described in ``_group_hits()``, with target unit indices relative to
+        that target text
+    processes : int
+        see ``_map_source_blocks()``
+    memory_budget : int or None
+        see ``_gen_block_hits()``
+    upper_triangle : bool, optional
+        see ``_find_block_hits()``
 
     Yields
     ------
-    target_index : int
-        index into ``target_units``
-    source_index : int
-        index into ``source_units``
-    positions : 2d np.array
-        the first column contains target positions; the second column has
-        corresponding source positions
-    """
-    target_feature_matrix, target_breaks = _construct_unit_feature_matrix(
-        target_units, stoplist_set, features_size)
-    for hits2positions in gen_hits2positions(search, conn,
-                                             target_feature_matrix,
-                                             target_breaks, source_units,
-                                             stoplist_set, features_size):
-        overhits2positions = {
-            k: np.array(v)
-            for k, v in hits2positions.items() if len(v) >= 2
-        }
-        for (t_ind, s_ind), positions in overhits2positions.items():
-            yield (t_ind, s_ind, positions)
-
-
-def _score(search, conn, target_units, source_units, features, stoplist,
-           distance_basis, max_distance, source_inv_frequencies_getter,
-           target_inv_frequencies_getter, tag_helper):
-    match_ents = []
-    numerator_sparse_rows = []
-    numerator_sparse_cols = []
-    numerator_sparse_data = []
-    denominators = []
-    stoplist_set = set(stoplist)
-    features_size = len(features)
-    search_id = search.id
-    for target_ind, source_ind, positions in _gen_matches(
-            search, conn, target_units, source_units, stoplist_set,
-            features_size):
-        target_unit = target_units[target_ind]
-        source_unit = source_units[source_ind]
-        target_forms = np.array(target_unit['forms'])
-        source_forms = np.array(source_unit['forms'])
-        t_positions = positions[:, 0]
-        s_positions = positions[:, 1]
-        if distance_basis == 'span':
-            # adjacent matched words have a distance of 2, etc.
-            target_distance = _get_distance_by_span(t_positions, target_forms)
-            source_distance = _get_distance_by_span(s_positions, source_forms)
-        else:
-            target_distance = _get_distance_by_least_frequency(
-                target_inv_frequencies_getter, t_positions, target_forms)
-            source_distance = _get_distance_by_least_frequency(
-                source_inv_frequencies_getter, s_positions, source_forms)
-        if source_distance <= 0 or target_distance <= 0:
-        # less than two matching tokens in one of the units
-            continue
-        distance = source_distance + target_distance
-        if distance <= max_distance:
-            target_features = target_unit['features']
-            source_features = source_unit['features']
+    list of MatchResults
+        the matches found in a block of source units under each scoring
+        setting of each target text, ordered by target text; blocks are
+        yielded in order of the source units
+    """
+    matrices = [
+        _construct_unit_feature_matrix(target_units, stoplist_set,
+                                       features_size)
+        for target_units in target_units_list
+    ]
+    target_feature_matrix = vstack([m for m, _ in matrices], format='csr')
+    target_breaks = _concatenate_breaks(
+        [np.asarray(breaks) for _, breaks in matrices])
+    # target units of target text k have stacked indices from
+    # unit_offsets[k] up to unit_offsets[k+1]
+    unit_offsets = np.cumsum(
+        [0] + [len(target_units) for target_units in target_units_list])
+
+    def _score_hits(t_inds, s_inds, hit_breaks, t_poses, s_poses):
+        # unit pairs are ordered by target unit, so the pairs of each target
+        # text are contiguous
+        pair_bounds = np.searchsorted(t_inds, unit_offsets)
+        block_results = []
+        for k, score_block in enumerate(score_blocks):
+            start, end = pair_bounds[k], pair_bounds[k + 1]
+            hit_start, hit_end = hit_breaks[start], hit_breaks[end]
+            block_results.extend(
+                score_block(t_inds[start:end] - unit_offsets[k],
+                            s_inds[start:end],
+                            hit_breaks[start:end + 1] - hit_start,
+                            t_poses[hit_start:hit_end],
+                            s_poses[hit_start:hit_end]))
+        return block_results
+
+    yield from _gen_block_hits(searches, conn, target_feature_matrix,
+                               target_breaks, source_units, stoplist_set,
+                               features_size, _score_hits, processes,
+                               memory_budget, upper_triangle)
+
+
+def _make_block_scorer(target_units, source_units, stoplist_set, scorings,
+                       source_inv_frequencies_getter,
+                       target_inv_frequencies_getter):
+    """Make a function that scores the unit pairs of a block
+
+    Parameters
+    ----------
+    target_units, source_units : UnitArrays
+        the units being matched
+    stoplist_set : set of int
+        feature indices on which matches should not be permitted
+    scorings : list of dict
+        the scoring settings to score under; the keys 'distance_basis' and
+        'max_distance' are used (see ``SparseMatrixSearch.match()``)
+    source_inv_frequencies_getter, target_inv_frequencies_getter
+        : (int) -> float
+        functions that take a word form index as input and return its inverse
+        frequency in the source and target text, respectively
+
+    Returns
+    -------
+    (1d np.array of ints, ...) -> list of MatchResults
+        see ``_gen_scored_blocks()``; the matches are listed in the order of
+        ``scorings``.  Unit pairs whose score is certain to fall below the
+        ``_ScoreThreshold`` of a scoring setting may be left out.
+    """
+    thresholds = [_ScoreThreshold(scoring) for scoring in scorings]
+
+    def _score_block(t_inds, s_inds, hit_breaks, t_poses, s_poses):
+        counts = np.diff(hit_breaks)
+        t_forms = target_units.forms_at(np.repeat(t_inds, counts), t_poses)
+        s_forms = source_units.forms_at(np.repeat(s_inds, counts), s_poses)
+        t_inv_freqs = _lookup_inv_freqs(target_inv_frequencies_getter,
+                                        t_forms)
+        s_inv_freqs = _lookup_inv_freqs(source_inv_frequencies_getter,
+                                        s_forms)
+        # unit pairs which could not be kept even at the least possible
+        # distance need no distances computed
+        bounds = _get_score_bounds(hit_breaks, t_inv_freqs, s_inv_freqs,
+                                   _MIN_MATCH_DISTANCE)
+        possible = np.flatnonzero(
+            np.logical_or.reduce([
+                threshold.admits(bounds) for threshold in thresholds
+            ]))
+        if len(possible) < len(t_inds):
+            t_inds = t_inds[possible]
+            s_inds = s_inds[possible]
+            hit_breaks, hit_inds = _select_segments(hit_breaks, possible)
+            t_poses = t_poses[hit_inds]
+            s_poses = s_poses[hit_inds]
+            t_forms = t_forms[hit_inds]
+            s_forms = s_forms[hit_inds]
+            t_inv_freqs = t_inv_freqs[hit_inds]
+            s_inv_freqs = s_inv_freqs[hit_inds]
+        # distances only depend on the distance basis, so scorings which
+        # share a basis share the computation
+        distances_by_basis = {}
+        for distance_basis in {
+                scoring['distance_basis']
+                for scoring in scorings
+        }:
+            if distance_basis == 'span':
+                # adjacent matched words have a distance of 2, etc.
+                target_distances = _get_distances_by_span(
+                    hit_breaks, t_poses, t_forms)
+                source_distances = _get_distances_by_span(
+                    hit_breaks, s_poses, s_forms)
+            else:
+                target_distances = _get_distances_by_least_frequency(
+                    hit_breaks, t_poses, t_forms, t_inv_freqs)
+                source_distances = _get_distances_by_least_frequency(
+                    hit_breaks, s_poses, s_forms, s_inv_freqs)
+            # pairs with less than two matching tokens in one of the units
+            # have a distance of 0
+            distances_by_basis[distance_basis] = (
+                source_distances + target_distances,
+                (target_distances > 0) & (source_distances > 0))
+        distances_list = []
+        keeps = []
+        bounds_list = []
+        for scoring in scorings:
+            distances, valid = distances_by_basis[scoring['distance_basis']]
+            distances_list.append(distances)
+            keeps.append(valid & (distances <= scoring['max_distance']))
+            bounds_list.append(
+                _get_score_bounds(hit_breaks, t_inv_freqs, s_inv_freqs,
+                                  distances))
+        builders = [_MatchResultsBuilder() for _ in scorings]
+        for i in np.flatnonzero(np.logical_or.reduce(keeps)):
+            # thresholds rise as scores are recorded, so the bounds are
+            # checked again for each unit pair
+            wanted = [
+                j for j, (keep, bounds, threshold) in enumerate(
+                    zip(keeps, bounds_list, thresholds))
+                if keep[i] and threshold.admits(bounds[i])
+            ]
+            if not wanted:
+                continue
+            target_features = target_units[t_inds[i]]['features']
+            source_features = source_units[s_inds[i]]['features']
+            target_forms = t_forms[hit_breaks[i]:hit_breaks[i + 1]]
+            source_forms = s_forms[hit_breaks[i]:hit_breaks[i + 1]]
+            t_positions = t_poses[hit_breaks[i]:hit_breaks[i + 1]]
+            s_positions = s_poses[hit_breaks[i]:hit_breaks[i + 1]]
             match_features = set(
                 itertools.chain.from_iterable([
                     set(target_features[t_pos]).intersection(
@@ -794,186 +2572,256 @@ def _score(search, conn, target_units, source_units, features, stoplist,
                 ]))
             match_features -= stoplist_set
             if match_features:
+                # each matched position counts once towards the score
+                _, t_firsts = np.unique(t_positions, return_index=True)
+                _, s_firsts = np.unique(s_positions, return_index=True)
                 match_inv_frequencies = [
-                    target_inv_frequencies_getter(target_forms[pos])
-                    for pos in set(t_positions)
+                    target_inv_frequencies_getter(form)
+                    for form in target_forms[t_firsts]
                 ]
                 match_inv_frequencies.extend([
-                    source_inv_frequencies_getter(source_forms[pos])
-                    for pos in set(s_positions)
+                    source_inv_frequencies_getter(form)
+                    for form in source_forms[s_firsts]
                 ])
-                numerator_sparse_rows.extend([len(match_ents)] *
-                                            len(match_inv_frequencies))
-                numerator_sparse_cols.extend(
-                    [i for i in range(len(match_inv_frequencies))])
-                numerator_sparse_data.extend(match_inv_frequencies)
-                denominators.append(distance)
-                match_ents.append(
-                    Match(search_id=search_id,
-                        source_unit=source_unit['_id'],
-                        target_unit=target_unit['_id'],
-                        source_tag=tag_helper.get_display_tag(
-                            source_unit['text'], source_unit['tags']),
-                        target_tag=tag_helper.get_display_tag(
-                            target_unit['text'], target_unit['tags']),
-                        matched_features=[
-                            features[int(mf)].token for mf in match_features
-                        ],
-                        source_snippet=source_unit['snippet'],
-                        target_snippet=target_unit['snippet'],
-                        highlight=[
-                            (int(s_pos), int(t_pos))
-                            for s_pos, t_pos in zip(s_positions, t_positions)
-                        ]))
-    if match_ents:
-        numerators = csr_matrix(
-            (numerator_sparse_data, (numerator_sparse_rows,
-                                     numerator_sparse_cols))).sum(axis=-1).A1
-        scores = np.log(numerators) - np.log(denominators)
-        for match, score in zip(match_ents, scores):
-            match.score = score
-#    print('score matrix', scores)
-#    print(match_ents)
-    return match_ents
-    
-
-def _score_sound(search, conn, target_units, source_units, features, stoplist,
-           distance_basis, max_distance, source_inv_frequencies_getter,
-           target_inv_frequencies_getter, tag_helper):
-    match_ents = []
-    numerator_sparse_rows = []
-    numerator_sparse_cols = []
-    numerator_sparse_data = []
-    denominators = []
-    stoplist_set = set(stoplist)
-    features_size = len(features)
-    search_id = search.id
-    for target_ind, source_ind, positions in _gen_matches(
-            search, conn, target_units, source_units, stoplist_set,
-            features_size):
-        target_unit = target_units[target_ind]
-        source_unit = source_units[source_ind]
-        # the positions of the words in the sentence
-        # (needed for highlighting in the front end)
-        t_word_pos = positions[:, 0]
-        s_word_pos = positions[:, 1]       
-        target_sounds = []
-        source_sounds = []
-        # unpack indices of sound features from target_unit['features'] and source_unit['features']
-        # and append them to target_sounds and source_sounds, respectively, 
-        # in order of appearance in the text
-        for a in target_unit['features']:
-            for b in a:
-                target_sounds.append(b)
-        for a in source_unit['features']:
-            for b in a:
-                source_sounds.append(b)
-        t_positions = []
-        s_positions = []
-        # append to t_positions and s_positions 
-        # the positions in the text of the *matching sound features*.
-        # built differently from t_positions and s_positions in _score,
-        # where they record instead the positions in the text of *matching word forms*
-        for target in target_sounds:
-            for source in source_sounds:
-                if target == source:
-                    t_positions.append(target_sounds.index(target))
-                    s_positions.append(source_sounds.index(source))
-        # _get_distance_by_least_frequency expects these as 1d arrays
-        t_positions = np.array(t_positions)
-        s_positions = np.array(s_positions)
-        target_sounds = np.array(target_sounds)
-        source_sounds = np.array(source_sounds)
-        # get the shortest distance of a pair of the least frequent sound features
-        target_distance = _get_distance_by_least_frequency(
-                target_inv_frequencies_getter, t_positions, target_sounds)
-        source_distance = _get_distance_by_least_frequency(
-                source_inv_frequencies_getter, s_positions, source_sounds)
-#            target_distance = _get_sound_distance_by_least_frequency(
-#                    target_inv_frequencies_getter, t_positions, target_sounds)
-#        print('target', target_sounds, target_distance)
-#            source_distance = _get_sound_distance_by_least_frequency(
-#                    source_inv_frequencies_getter, s_positions, source_sounds)
-#        print('source', source_sounds, source_distance)
-        if source_distance <= 0 or target_distance <= 0:
-        # less than two matching tokens in one of the units
-            continue
-        # distance is both used to compare to max_distance below 
-        # and will become the denominator in the scoring formula
-        distance = source_distance + target_distance
-        # if distance > max_distance, then the matched sound features 
-        # are too far apart to make the lines 'sound alike'
-        if distance <= max_distance:
-            # now we are once again interested in 
-            # not just the least frequent sound features, 
-            # but in all the matching sound features
-            target_features = target_unit['features']
-            source_features = source_unit['features']
+                numerator = sum(match_inv_frequencies)
+                for j in wanted:
+                    score = np.log(numerator) - np.log(distances_list[j][i])
+                    if thresholds[j].admits(score):
+                        thresholds[j].record(score)
+                        builders[j].add(t_inds[i], s_inds[i],
+                                        match_inv_frequencies,
+                                        distances_list[j][i], t_positions,
+                                        s_positions, match_features)
+        return [builder.build() for builder in builders]
+
+    return _score_block
+
+
+def _make_sound_block_scorer(target_units, source_units, stoplist_set,
+                             scorings, source_inv_frequencies_getter,
+                             target_inv_frequencies_getter):
+    """Make a function that scores the unit pairs of a block by sound
+
+    Distances between sound features are always taken between the least
+    frequent ones, so the distance basis of each scoring setting is ignored.
+
+    Parameters
+    ----------
+    target_units, source_units, stoplist_set, scorings,
+    source_inv_frequencies_getter, target_inv_frequencies_getter
+        see ``_make_block_scorer()``; the getters take sound feature indices
+        as input
+
+    Returns
+    -------
+    (1d np.array of ints, ...) -> list of MatchResults
+        see ``_make_block_scorer()``
+    """
+    thresholds = [_ScoreThreshold(scoring) for scoring in scorings]
+    # indices of sound features from target_unit['features'] and
+    # source_unit['features'], in order of appearance in the text
+    target_sounds, target_sound_breaks = target_units.flat_features()
+    source_sounds, source_sound_breaks = source_units.flat_features()
+    all_sounds = np.concatenate((target_sounds, source_sounds))
+    min_sound = all_sounds.min() if len(all_sounds) else 0
+    span = all_sounds.max() - min_sound + 1 if len(all_sounds) else 1
+    target_index = _SoundIndex(target_sounds, target_sound_breaks, min_sound,
+                               span)
+    source_index = _SoundIndex(source_sounds, source_sound_breaks, min_sound,
+                               span)
+
+    def _score_block(t_inds, s_inds, hit_breaks, t_poses, s_poses):
+        # the positions in the text of the *matching sound features*; built
+        # differently from t_positions and s_positions in _score, where they
+        # record instead the positions in the text of *matching word forms*
+        sound_breaks, t_positions, s_positions, matched_sounds = \
+            _match_sounds(t_inds, s_inds, target_index, source_index)
+        t_inv_freqs = _lookup_inv_freqs(target_inv_frequencies_getter,
+                                        matched_sounds)
+        s_inv_freqs = _lookup_inv_freqs(source_inv_frequencies_getter,
+                                        matched_sounds)
+        # get the shortest distance of a pair of the least frequent sound
+        # features; pairs without matching sound features keep a distance of 0
+        counts = np.diff(sound_breaks)
+        nonempty = np.flatnonzero(counts > 0)
+        nonempty_breaks = np.zeros(len(nonempty) + 1, dtype=np.int64)
+        np.cumsum(counts[nonempty], out=nonempty_breaks[1:])
+        target_distances = np.zeros(len(t_inds), dtype=np.int64)
+        source_distances = np.zeros(len(t_inds), dtype=np.int64)
+        target_distances[nonempty] = _get_distances_by_least_frequency(
+            nonempty_breaks, t_positions, matched_sounds, t_inv_freqs)
+        source_distances[nonempty] = _get_distances_by_least_frequency(
+            nonempty_breaks, s_positions, matched_sounds, s_inv_freqs)
+        # distance is both used to compare to max_distance below and will
+        # become the denominator in the scoring formula; if distance >
+        # max_distance, then the matched sound features are too far apart to
+        # make the lines 'sound alike'
+        distances = source_distances + target_distances
+        # less than two matching tokens in one of the units gives a distance
+        # of 0
+        valid = (target_distances > 0) & (source_distances > 0)
+        keeps = [
+            valid & (distances <= scoring['max_distance'])
+            for scoring in scorings
+        ]
+        # every matched sound feature counts towards the score, so the bound
+        # equals the score up to rounding
+        bounds = np.full(len(t_inds), -np.inf)
+        bounds[nonempty] = _get_score_bounds(nonempty_breaks,
+                                             t_inv_freqs, s_inv_freqs,
+                                             distances[nonempty])
+        builders = [_MatchResultsBuilder() for _ in scorings]
+        for i in np.flatnonzero(np.logical_or.reduce(keeps)):
+            wanted = [
+                j for j, (keep, threshold) in enumerate(zip(keeps, thresholds))
+                if keep[i] and threshold.admits(bounds[i])
+            ]
+            if not wanted:
+                continue
+            t_ind = t_inds[i]
+            s_ind = s_inds[i]
+            # now we are once again interested in not just the least frequent
+            # sound features, but in all the matching sound features
             match_features = set(
                 itertools.chain.from_iterable([
-                    set(target_sounds).intersection(
-                        set(source_sounds))
+                    set(target_sounds[target_sound_breaks[t_ind]:
+                                      target_sound_breaks[t_ind + 1]].tolist())
+                    .intersection(
+                        set(source_sounds[source_sound_breaks[s_ind]:
+                                          source_sound_breaks[s_ind +
+                                                              1]].tolist()))
                 ]))
             match_features -= stoplist_set
             if match_features:
-                match_inv_frequencies = [
-                    target_inv_frequencies_getter(target_sounds[pos])
-                    for pos in t_positions
-                ]
-                match_inv_frequencies.extend([
-                    source_inv_frequencies_getter(source_sounds[pos])
-                    for pos in s_positions
-                ])
-                numerator_sparse_rows.extend([len(match_ents)] *
-                                            len(match_inv_frequencies))
-                numerator_sparse_cols.extend(
-                    [i for i in range(len(match_inv_frequencies))])
-                numerator_sparse_data.extend(match_inv_frequencies)
-                denominators.append(distance)
-                # match_ents.highlight is not the positions of sound features
-                # in a line, but the positions of the words to which they belong
-                match_ents.append(
-                    Match(search_id=search_id,
-                        source_unit=source_unit['_id'],
-                        target_unit=target_unit['_id'],
-                        source_tag=tag_helper.get_display_tag(
-                            source_unit['text'], source_unit['tags']),
-                        target_tag=tag_helper.get_display_tag(
-                            target_unit['text'], target_unit['tags']),
-                        matched_features=[
-                            features[int(mf)].token for mf in match_features
-                        ],
-                        source_snippet=source_unit['snippet'],
-                        target_snippet=target_unit['snippet'],
-                        highlight=[
-                            (int(s_pos), int(t_pos))
-                            for s_pos, t_pos in zip(s_word_pos, t_word_pos)
-                        ]))
-                #in this version match_ents.highlight is an *array* of positions
-#               match_ents.append(
-#                    Match(search_id=search_id,
-#                        source_unit=source_unit['_id'],
-#                        target_unit=target_unit['_id'],
-#                        source_tag=tag_helper.get_display_tag(
-#                            source_unit['text'], source_unit['tags']),
-#                        target_tag=tag_helper.get_display_tag(
-#                            target_unit['text'], target_unit['tags']),
-#                        matched_features=[
-#                            features[int(mf)].token for mf in match_features
-#                        ],
-#                        source_snippet=source_unit['snippet'],
-#                        target_snippet=target_unit['snippet'],
-#                        highlight=positions
-#                    ))
-    if match_ents:
-        numerators = csr_matrix(
-            (numerator_sparse_data, (numerator_sparse_rows,
-                                     numerator_sparse_cols))).sum(axis=-1).A1
-        scores = np.log(numerators) - np.log(denominators)
-        for match, score in zip(match_ents, scores):
-            match.score = score
-#    print('score matrix', scores)
-#    print(match_ents)
-    return match_ents
-    
-    
+                start, end = sound_breaks[i], sound_breaks[i + 1]
+                match_inv_frequencies = t_inv_freqs[start:end].tolist()
+                match_inv_frequencies.extend(s_inv_freqs[start:end].tolist())
+                score = np.log(sum(match_inv_frequencies)) - \
+                    np.log(distances[i])
+                # the highlight is not the positions of sound features in a
+                # line, but the positions of the words to which they belong
+                for j in wanted:
+                    if thresholds[j].admits(score):
+                        thresholds[j].record(score)
+                        builders[j].add(
+                            t_ind, s_ind, match_inv_frequencies,
+                            distances[i],
+                            t_poses[hit_breaks[i]:hit_breaks[i + 1]],
+                            s_poses[hit_breaks[i]:hit_breaks[i + 1]],
+                            match_features)
+        return [builder.build() for builder in builders]
+
+    return _score_block
+
+
+class _SoundIndex(object):
+    """Where each sound feature occurs within each unit of a text
+
+    Parameters
+    ----------
+    sounds : 1d np.array of ints
+        the sound features of every unit, in order of appearance
+    breaks : 1d np.array of ints
+        the slice ``sounds[breaks[i]:breaks[i+1]]`` belongs to unit i
+    min_sound : int
+        a lower bound on the values in ``sounds``
+    span : int
+        the number of possible sound feature values above ``min_sound``
+
+    Attributes
+    ----------
+    sounds, breaks, min_sound, span
+        as given
+    first_positions : 1d np.array of ints
+        for each sound feature occurrence, the position within its unit at
+        which the same sound feature first occurs
+    group_keys : 1d np.array of ints
+        sorted keys, one for each distinct (unit, sound feature) combination
+        (see ``key()``)
+    group_counts : 1d np.array of ints
+        how many times the sound feature of each key occurs in its unit
+    group_firsts : 1d np.array of ints
+        the position within its unit at which the sound feature of each key
+        first occurs
+    """
+
+    def __init__(self, sounds, breaks, min_sound, span):
+        self.sounds = sounds
+        self.breaks = breaks
+        self.min_sound = min_sound
+        self.span = span
+        unit_inds = _breaks_to_unit_inds(breaks)
+        keys = self.key(unit_inds, sounds)
+        # a stable sort puts the first occurrence first within each group
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+        group_starts = np.flatnonzero(
+            np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+        self.group_keys = sorted_keys[group_starts]
+        self.group_counts = np.diff(
+            np.concatenate((group_starts, [len(sorted_keys)])))
+        firsts = order[group_starts]
+        self.group_firsts = firsts - breaks[unit_inds[firsts]]
+        self.first_positions = np.empty(len(sounds), dtype=np.int64)
+        self.first_positions[order] = np.repeat(self.group_firsts,
+                                                self.group_counts)
+
+    def key(self, unit_inds, sounds):
+        """Combine unit indices and sound features into single keys"""
+        return unit_inds.astype(np.int64) * self.span + \
+            (sounds.astype(np.int64) - self.min_sound)
+
+
+def _match_sounds(t_inds, s_inds, target_index, source_index):
+    """Find where the sound features of unit pairs match
+
+    For each unit pair, every pairing of a target sound feature with an equal
+    source sound feature is a match.  Each match is recorded by the position
+    at which its sound feature first occurs in each unit, so a sound feature
+    that occurs twice in the target unit and three times in the source unit
+    yields six copies of the same pair of positions.  Within a unit pair,
+    matches are ordered by target sound feature position, then by source
+    sound feature position.
+
+    Parameters
+    ----------
+    t_inds, s_inds : 1d np.array of ints
+        the target and source units of each unit pair
+    target_index, source_index : _SoundIndex
+        sound feature information for the target and source units
+
+    Returns
+    -------
+    sound_breaks : 1d np.array of ints
+        the slice ``sound_breaks[i]:sound_breaks[i+1]`` of the other returned
+        arrays holds the matches of unit pair i
+    t_positions : 1d np.array of ints
+        the position within the target unit's sound features of each match
+    s_positions : 1d np.array of ints
+        the position within the source unit's sound features of each match
+    matched_sounds : 1d np.array of ints
+        the sound feature of each match
+    """
+    element_breaks, element_inds = _select_segments(target_index.breaks,
+                                                    t_inds)
+    pair_inds = _breaks_to_unit_inds(element_breaks)
+    sounds = target_index.sounds[element_inds]
+    keys = source_index.key(s_inds[pair_inds], sounds)
+    found = np.searchsorted(source_index.group_keys, keys)
+    found[found == len(source_index.group_keys)] = 0
+    if len(source_index.group_keys):
+        repeats = np.where(source_index.group_keys[found] == keys,
+                           source_index.group_counts[found], 0)
+    else:
+        repeats = np.zeros(len(keys), dtype=np.int64)
+    sound_breaks = np.zeros(len(t_inds) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pair_inds, weights=repeats,
+                          minlength=len(t_inds)).astype(np.int64),
+              out=sound_breaks[1:])
+    if len(source_index.group_keys):
+        s_positions = np.repeat(source_index.group_firsts[found], repeats)
+    else:
+        s_positions = np.zeros(0, dtype=np.int64)
+    return (sound_breaks,
+            np.repeat(target_index.first_positions[element_inds], repeats),
+            s_positions, np.repeat(sounds, repeats))
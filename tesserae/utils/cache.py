@@ -0,0 +1,184 @@
+"""Local disk cache for data derived from the Tesserae database
+
+Search repeatedly recomputes information which only changes when texts are
+ingested, removed, or given new features.  The functions defined in this
+module store such information as NumPy archives on local disk so that it can
+be reused across searches.
+
+Every cached item belongs to a kind (e.g., "units") and is named by a key.
+Keys for information derived from a single text must start with the string
+form of that text's ObjectId, followed by an underscore; this is what allows
+``clear_text`` to invalidate everything that was derived from a text.
+
+``clear_text`` only reaches the cache of the host on which it runs.  Items
+may therefore also be saved with a version number kept in the database (see
+``tesserae.utils.calculations.get_text_version``); loading them with the
+current version ignores items saved before the database changed, whichever
+host changed it.
+
+Routine Listings
+----------------
+load_arrays
+    Retrieve cached arrays.
+save_arrays
+    Store arrays in the cache.
+clear_text
+    Remove cached arrays derived from a text.
+clear_prefix
+    Remove cached arrays of a kind whose keys share a prefix.
+clear_all
+    Remove all cached arrays.
+"""
+import glob
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), 'tess_data', 'cache')
+# bump this whenever the layout of cached arrays changes so that stale files
+# are ignored instead of misread
+CACHE_FORMAT_VERSION = 3
+
+
+def _create_cache_path(kind, key):
+    """Create a path to the cache file for the specified kind and key
+
+    Parameters
+    ----------
+    kind : str
+        the category of cached information
+    key : str
+        name of the cached item within its kind
+
+    Returns
+    -------
+    str
+    """
+    return str(os.path.join(CACHE_DIR, kind, f'{key}.npz'))
+
+
+def load_arrays(kind, key, version=None):
+    """Retrieve cached arrays
+
+    Parameters
+    ----------
+    kind : str
+        the category of cached information
+    key : str
+        name of the cached item within its kind
+    version : int, optional
+        if specified, arrays saved with any other version (or with none) are
+        not returned
+
+    Returns
+    -------
+    dict[str, np.array] or None
+        the arrays stored under ``kind`` and ``key``; None if nothing usable
+        was found
+    """
+    path = _create_cache_path(kind, key)
+    try:
+        with np.load(path, allow_pickle=False) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+    except (OSError, ValueError, KeyError):
+        # missing, partially written, or otherwise unreadable files are
+        # treated as cache misses
+        return None
+    format_version = arrays.pop('_format_version', None)
+    if format_version is None or \
+            int(format_version) != CACHE_FORMAT_VERSION:
+        return None
+    saved_version = arrays.pop('_version', None)
+    if version is not None and \
+            (saved_version is None or int(saved_version) != version):
+        return None
+    return arrays
+
+
+def save_arrays(kind, key, arrays, version=None):
+    """Store arrays in the cache
+
+    The file is written to a temporary location first and then moved into
+    place, so concurrent readers never see a partially written file.
+
+    Parameters
+    ----------
+    kind : str
+        the category of cached information
+    key : str
+        name of the cached item within its kind
+    arrays : dict[str, np.array]
+        the arrays to store; names must not start with an underscore
+    version : int, optional
+        version of the database information the arrays were derived from
+        (see ``load_arrays()``)
+    """
+    if version is not None:
+        arrays = dict(arrays, _version=np.array(version))
+    path = _create_cache_path(kind, key)
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as ofh:
+            np.savez(ofh,
+                     _format_version=np.array(CACHE_FORMAT_VERSION),
+                     **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def clear_text(text_id, feature=None):
+    """Remove cached arrays derived from a text
+
+    Parameters
+    ----------
+    text_id : ObjectId
+        ObjectId of the Text whose derived information is out of date
+    feature : str, optional
+        if specified, only cached arrays whose key ends with this feature
+        type are removed
+    """
+    suffix = f'_{feature}.npz' if feature is not None else '.npz'
+    pattern = os.path.join(CACHE_DIR, '*', f'{str(text_id)}_*')
+    for path in glob.glob(pattern):
+        if path.endswith(suffix):
+            os.remove(path)
+
+
+def clear_prefix(kind, prefix, keep=None):
+    """Remove cached arrays of a kind whose keys share a prefix
+
+    This is useful for removing earlier versions of an item whose key
+    records the state of the database it was derived from.
+
+    Parameters
+    ----------
+    kind : str
+        the category of cached information
+    prefix : str
+        the start of the keys of the cached items to remove
+    keep : str, optional
+        the key of a cached item not to remove
+    """
+    kept = _create_cache_path(kind, keep) if keep is not None else None
+    pattern = os.path.join(glob.escape(os.path.join(CACHE_DIR, kind)),
+                           f'{glob.escape(prefix)}*.npz')
+    for path in glob.glob(pattern):
+        if path != kept:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # another process removed it first
+                pass
+
+
+def clear_all():
+    """Remove all cached arrays"""
+    if os.path.isdir(CACHE_DIR):
+        shutil.rmtree(CACHE_DIR)
@@ -1,9 +1,25 @@
-from collections import Counter
-
 import numpy as np
+import pymongo
 from scipy.sparse import csr_matrix
 
 from tesserae.db.entities import Feature, Unit
+from tesserae.utils.cache import load_arrays, save_arrays
+
+
+# cache kind under which corpus-wide feature counts are stored
+CORPUS_COUNTS_KIND = 'corpus_counts'
+# database collection holding the version of the corpus counts of each
+# language and feature, shared by every process using the database
+CORPUS_VERSIONS_COLLECTION = 'corpus_versions'
+# database collection holding the version of the information derived from
+# each text, shared by every process using the database
+TEXT_VERSIONS_COLLECTION = 'text_versions'
+# cache kinds under which per-text tables are stored; keys are made from the
+# text's ObjectId and the feature, so that ``clear_text`` invalidates them,
+# and tables are stamped with the text's version (see ``get_text_version()``)
+FEATURE_COUNTS_KIND = 'feature_counts'
+INV_TEXT_FREQS_KIND = 'inv_text_freqs'
+SOUND_INV_TEXT_FREQS_KIND = 'sound_inv_text_freqs'
 
 
 def get_corpus_frequencies(connection, feature, language):
@@ -36,6 +52,181 @@ def get_corpus_frequencies(connection, feature, language):
     -------
     np.array
     """
+    counts, _ = get_corpus_counts(connection, feature, language)
+    return counts / sum(counts)
+
+
+def get_corpus_counts(connection, feature, language):
+    """Get the number of instances of each feature type across the corpus
+
+    The counts are kept in the local cache, so that searches need not add up
+    the frequencies of every Feature in the database.  Whenever texts are
+    ingested or removed, ``update_corpus_counts()`` records a new version of
+    the counts in the database; cached counts computed for another version,
+    possibly by another process or on another host, are recomputed, as are
+    cached counts that do not cover every feature type in the database.
+
+    Parameters
+    ----------
+    connection : tesserae.db.mongodb.TessMongoConnection
+    feature : str
+        Feature category of interest
+    language : str
+        Language to which the features of interest belong
+
+    Returns
+    -------
+    counts : 1d np.array of ints
+        ``counts[i]`` is the number of instances of the feature type with
+        index i
+    version : int
+        a number which changes every time the counts are updated
+    """
+    version = _get_corpus_version(connection, feature, language)
+    arrays = load_arrays(CORPUS_COUNTS_KIND,
+                         _corpus_key(connection, feature, language))
+    if arrays is not None and 'corpus_version' in arrays and \
+            int(arrays['corpus_version']) == version:
+        num_features = connection.connection[
+            Feature.collection].count_documents({
+                'feature': feature,
+                'language': language
+            })
+        if len(arrays['counts']) == num_features:
+            return arrays['counts'], version
+    return _store_corpus_counts(connection, feature, language, version)
+
+
+def update_corpus_counts(connection, language, features=None):
+    """Recompute the cached corpus counts after the corpus changed
+
+    Parameters
+    ----------
+    connection : tesserae.db.mongodb.TessMongoConnection
+    language : str
+        Language of the texts that were ingested, removed, or changed
+    features : iterable of str, optional
+        Feature categories whose counts changed; by default, every feature
+        category of ``language`` found in the database
+    """
+    if features is None:
+        features = connection.connection[Feature.collection].distinct(
+            'feature', {'language': language})
+    for feature in features:
+        _store_corpus_counts(
+            connection, feature, language,
+            _increment_corpus_version(connection, feature, language))
+
+
+def _get_corpus_version(connection, feature, language):
+    """Look up the version of the corpus counts recorded in the database
+
+    Returns
+    -------
+    int
+        0 if the counts were never updated
+    """
+    doc = connection.connection[CORPUS_VERSIONS_COLLECTION].find_one(
+        {'_id': f'{language}_{feature}'})
+    return doc['version'] if doc is not None else 0
+
+
+def _increment_corpus_version(connection, feature, language):
+    """Record in the database that the corpus counts changed
+
+    Returns
+    -------
+    int
+        the new version of the corpus counts
+    """
+    doc = connection.connection[
+        CORPUS_VERSIONS_COLLECTION].find_one_and_update(
+            {'_id': f'{language}_{feature}'}, {'$inc': {
+                'version': 1
+            }},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER)
+    return doc['version']
+
+
+def get_text_version(connection, text_id):
+    """Look up the version of a text's units and features in the database
+
+    Information cached from a text is saved with this version (see
+    ``tesserae.utils.cache.load_arrays()``), so that caches on every host
+    stop serving it once the text changes.
+
+    Parameters
+    ----------
+    connection : tesserae.db.mongodb.TessMongoConnection
+    text_id : bson.objectid.ObjectId
+        ObjectId of the text of interest
+
+    Returns
+    -------
+    int
+        0 if the text was never changed
+    """
+    doc = connection.connection[TEXT_VERSIONS_COLLECTION].find_one(
+        {'_id': str(text_id)})
+    return doc['version'] if doc is not None else 0
+
+
+def increment_text_version(connection, text_id):
+    """Record in the database that a text's units or features changed
+
+    This must be called after the change is written, whenever a text is
+    ingested, removed, or given a new feature.
+
+    Parameters
+    ----------
+    connection : tesserae.db.mongodb.TessMongoConnection
+    text_id : bson.objectid.ObjectId
+        ObjectId of the text that changed
+
+    Returns
+    -------
+    int
+        the new version of the text
+    """
+    doc = connection.connection[
+        TEXT_VERSIONS_COLLECTION].find_one_and_update(
+            {'_id': str(text_id)}, {'$inc': {
+                'version': 1
+            }},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER)
+    return doc['version']
+
+
+def _corpus_key(connection, feature, language):
+    """Name cached corpus information by database, language, and feature
+
+    Several databases may share the local cache, so the database name is part
+    of the key.
+    """
+    return f'{connection.connection.name}_{language}_{feature}'
+
+
+def _store_corpus_counts(connection, feature, language, version):
+    """Count feature instances in the database and cache the counts
+
+    Parameters
+    ----------
+    connection : tesserae.db.mongodb.TessMongoConnection
+    feature : str
+        Feature category of interest
+    language : str
+        Language to which the features of interest belong
+    version : int
+        version of the corpus counts recorded in the database
+
+    Returns
+    -------
+    counts, version
+        see ``get_corpus_counts()``
+    """
+    key = _corpus_key(connection, feature, language)
     pipeline = [
         # Get all database documents of the specified feature and language
         # (from the "features" collection, as we later find out).
@@ -58,15 +249,17 @@ def get_corpus_frequencies(connection, feature, language):
                 }
             }
         }},
-        # Finally, sort those transformed documents by their index.
-        {'$sort': {'index': 1}}
     ]
-
-    freqs = connection.aggregate(
-            Feature.collection, pipeline, encode=False)
-    freqs = list(freqs)
-    freqs = np.array([freq['frequency'] for freq in freqs])
-    return freqs / sum(freqs)
+    freqs = list(connection.aggregate(
+            Feature.collection, pipeline, encode=False))
+    counts = np.zeros(len(freqs), dtype=np.int64)
+    for freq in freqs:
+        counts[freq['index']] = freq['frequency']
+    save_arrays(CORPUS_COUNTS_KIND, key, {
+        'counts': counts,
+        'corpus_version': np.array(version)
+    })
+    return counts, version
 
 
 def get_feature_counts_by_text(connection, feature, text):
@@ -90,90 +283,15 @@ def get_feature_counts_by_text(connection, feature, text):
 
     Returns
     -------
-    dict [int, int]
-        the key should be a feature index of type "form"; the associated
-        value is the number of tokens in the text sharing at least one same
-        feature type with the key word
+    1d np.array of ints
+        index by feature index of type "form" to obtain the number of tokens
+        in the text sharing at least one same feature type with that word; 0
+        for words that do not appear in the text
     """
-    tindex2mtindex = {}
-    findex2mfindex = {}
-    word_counts = Counter()
-    word_feature_pairs = set()
-    unit_proj = {
-        '_id': False,
-        'tokens.features.form': True
-    }
-    if feature != 'form':
-        unit_proj['tokens.features.'+feature] = True
-    db_cursor = connection.connection[Unit.collection].find(
-        {'text': text.id, 'unit_type': 'line'},
-        unit_proj
-    )
-    for unit in db_cursor:
-        for token in unit['tokens']:
-            cur_features = token['features']
-            # use the form index as an identifier for this token's word
-            # type
-            cur_tindex = cur_features['form'][0]
-            if cur_tindex not in tindex2mtindex:
-                tindex2mtindex[cur_tindex] = len(tindex2mtindex)
-            mtindex = tindex2mtindex[cur_tindex]
-            # we want to count word types by matrix indices for faster
-            # lookup when we get to the stage of counting up word type
-            # occurrences
-            word_counts[mtindex] += 1
-            for cur_findex in cur_features[feature]:
-                if cur_findex not in findex2mfindex:
-                    findex2mfindex[cur_findex] = len(findex2mfindex)
-                mfindex = findex2mfindex[cur_findex]
-                # record when a word type is associated with a feature type
-                word_feature_pairs.add((mtindex, mfindex))
-    csr_rows = []
-    csr_cols = []
-    for mtindex, mfindex in word_feature_pairs:
-        csr_rows.append(mtindex)
-        csr_cols.append(mfindex)
-    word_feature_matrix = csr_matrix(
-        (
-            np.ones(len(csr_rows), dtype=np.bool),
-            (np.array(csr_rows), np.array(csr_cols))
-        ),
-        shape=(len(tindex2mtindex), len(findex2mfindex))
-    )
-    # if matching_words_matrix[i, j] == True, then the word represented by
-    # position i shared at least one feature type with the word represented
-    # by position j
-    matching_words_matrix = word_feature_matrix.dot(
-        word_feature_matrix.transpose())
-    # since only matching tokens remain, the column indices indicate
-    # which tokens match the token represented by row i; we need to
-    # count up how many times each word appeared; first, we change match
-    # indicators into the number of times the token indicated by the column was
-    # found
-    mtindices = []
-    mtcounts = []
-    for mtindex, count in word_counts.items():
-        mtindices.append(mtindex)
-        mtcounts.append(count)
-    count_matrix = matching_words_matrix.dot(
-        csr_matrix(
-            (
-                np.array(mtcounts),
-                (np.array(mtindices), np.zeros(len(mtindices)))
-            ),
-            shape=(matching_words_matrix.shape[0], 1)
-        )
-    )
-    # now, we can sum up each row to find the total number of times all
-    # associated tokens appeared with the token represented by the row
-    summed_rows = count_matrix.sum(axis=-1)
-    # finally, we re-map matrix indices to feature indices
-    mtindex2tindex = {
-        mtindex: tindex for tindex, mtindex in tindex2mtindex.items()
-    }
-    return {
-        mtindex2tindex[i]: freq for i, freq in enumerate(summed_rows.A1)
-    }
+    return _get_cached_array(
+        connection, text.id, FEATURE_COUNTS_KIND, f'{str(text.id)}_{feature}',
+        lambda: _count_matching_tokens(
+            *_get_token_features(connection, feature, text.id)))
 
 
 def get_inverse_text_frequencies(connection, feature, text_id):
@@ -196,103 +314,34 @@ def get_inverse_text_frequencies(connection, feature, text_id):
 
     Returns
     -------
-    dict [int, float]
-        the key should be a feature index of type form; the associated
-        value is the inverse of the average proportion of words in the text
-        sharing at least one same feature type with the key word
+    1d np.array of floats
+        index by feature index of type form to obtain the inverse of the
+        average proportion of words in the text sharing at least one same
+        feature type with that word; 0 for words that do not appear in the
+        text
     """
-    tindex2mtindex = {}
-    findex2mfindex = {}
-    word_counts = Counter()
-    word_feature_pairs = set()
-    text_token_count = 0
-    unit_proj = {
-        '_id': False,
-        'tokens.features.form': True
-    }
-    if feature != 'form':
-        unit_proj['tokens.features.'+feature] = True
-    db_cursor = connection.connection[Unit.collection].find(
-        {'text': text_id, 'unit_type': 'line'},
-        unit_proj
-    )
-    for unit in db_cursor:
-        text_token_count += len(unit['tokens'])
-        for token in unit['tokens']:
-            cur_features = token['features']
-            # use the form index as an identifier 
-            # for this token's word type
-            cur_tindex = cur_features['form'][0]
-            if cur_tindex not in tindex2mtindex:
-                tindex2mtindex[cur_tindex] = len(tindex2mtindex)
-            # mtindex is esseentially a counter
-            # for the number of unique forms seen
-            mtindex = tindex2mtindex[cur_tindex]
-            # we want to count word types by matrix indices for faster
-            # lookup when we get to the stage of counting up word type
-            # occurrences
-            word_counts[mtindex] += 1
-            for cur_findex in cur_features[feature]:
-                if cur_findex not in findex2mfindex:
-                    findex2mfindex[cur_findex] = len(findex2mfindex)
-                mfindex = findex2mfindex[cur_findex]
-                # record when a word type is associated with a feature type
-                word_feature_pairs.add((mtindex, mfindex))
-    csr_rows = []
-    csr_cols = []
-    for mtindex, mfindex in word_feature_pairs:
-        csr_rows.append(mtindex)
-        csr_cols.append(mfindex)
-    word_feature_matrix = csr_matrix(
-        (
-            np.ones(len(csr_rows), dtype=np.bool),
-            (np.array(csr_rows), np.array(csr_cols))
-        ),
-        shape=(len(tindex2mtindex), len(findex2mfindex))
-    )
-    # if matching_words_matrix[i, j] == True, then the word represented by
-    # position i shared at least one feature type with the word represented
-    # by position j
-    matching_words_matrix = word_feature_matrix.dot(
-        word_feature_matrix.transpose())
-    # since only matching tokens remain, the column indices indicate
-    # which tokens match the token represented by row i; we need to
-    # count up how many times each word appeared; first, we change match
-    # indicators into the number of times the token indicated by the column was
-    # found
-    mtindices = []
-    mtcounts = []
-    for mtindex, count in word_counts.items():
-        mtindices.append(mtindex)
-        mtcounts.append(count)
-    count_matrix = matching_words_matrix.dot(
-        csr_matrix(
-            (
-                np.array(mtcounts),
-                (np.array(mtindices), np.zeros(len(mtindices)))
-            ),
-            shape=(matching_words_matrix.shape[0], 1)
-        )
-    )
-    # now, we can sum up each row to find the total number of times all
-    # associated tokens appeared with the token represented by the row
-    summed_rows = count_matrix.sum(axis=-1)
-    # dividing total number of tokens by the sums gives us the inverse
-    # frequencies
-    sparse_freqs = text_token_count / summed_rows
-    # finally, we re-map matrix indices to feature indices
-    mtindex2tindex = {
-        mtindex: tindex for tindex, mtindex in tindex2mtindex.items()
-    }
-    return {
-        mtindex2tindex[i]: freq for i, freq in enumerate(sparse_freqs.A1)
-    }
-    
-    
+    def _compute():
+        token_forms, pair_forms, pair_features = _get_token_features(
+            connection, feature, text_id)
+        counts = _count_matching_tokens(token_forms, pair_forms,
+                                        pair_features)
+        # dividing total number of tokens by the counts gives us the inverse
+        # frequencies; tokens without a form (such as numbers) still count
+        # towards the length of the text
+        inv_freqs = np.zeros(len(counts), dtype=np.float64)
+        present = np.bincount(token_forms[token_forms >= 0],
+                              minlength=len(counts)) > 0
+        inv_freqs[present] = len(token_forms) / counts[present]
+        return inv_freqs
+
+    return _get_cached_array(connection, text_id, INV_TEXT_FREQS_KIND,
+                             f'{str(text_id)}_{feature}', _compute)
+
+
 def get_sound_inverse_text_freq(connection, text_id):
     """Get the inverse frequencies of all the trigrams AKA sound features
     in a particular text.
-    
+
     Formula:
     inv freq = 1/(occurences of trigram in text/total trigrams in text)
 
@@ -304,38 +353,135 @@ def get_sound_inverse_text_freq(connection, text_id):
 
     Returns
     -------
-    dict [int, float]
-        the key should be a feature index of type form; the associated
-        value is the inverse frequency of the trigram
+    1d np.array of floats
+        index by feature index of type sound to obtain the inverse frequency
+        of the trigram; 0 for trigrams that do not appear in the text
+    """
+    def _compute():
+        _, _, sounds = _get_token_features(connection, 'sound', text_id)
+        # Frequency is the number of times a word occurs in a text
+        # divided by the total number of words in that text; placeholder
+        # features (index -1) count towards the total but get no entry
+        counts = np.bincount(sounds[sounds >= 0])
+        present = counts > 0
+        inv_freqs = np.zeros(len(counts), dtype=np.float64)
+        inv_freqs[present] = 1 / (counts[present] / len(sounds))
+        return inv_freqs
+
+    return _get_cached_array(connection, text_id, SOUND_INV_TEXT_FREQS_KIND,
+                             f'{str(text_id)}_sound', _compute)
+
+
+def _get_token_features(connection, feature, text_id):
+    """Flatten the forms and features of every token in the lines of a text
+
+    Parameters
+    ----------
+    connection : tesserae.db.mongodb.TessMongoConnection
+    feature : str
+        Feature category of interest
+    text_id : bson.objectid.ObjectId
+        ObjectId of the text whose tokens are to be retrieved
+
+    Returns
+    -------
+    token_forms : 1d np.array of ints
+        the form index of each token, in order of appearance
+    pair_forms, pair_features : 1d np.array of ints
+        for each feature instance of each token, the form index of the token
+        and the feature index of the instance
     """
-    units = []
     unit_proj = {
         '_id': False,
         'tokens.features.form': True
     }
-    unit_proj['tokens.features.sound'] = True
+    if feature != 'form':
+        unit_proj['tokens.features.'+feature] = True
     db_cursor = connection.connection[Unit.collection].find(
         {'text': text_id, 'unit_type': 'line'},
         unit_proj
     )
+    token_forms = []
+    pair_forms = []
+    pair_features = []
     for unit in db_cursor:
         for token in unit['tokens']:
             cur_features = token['features']
-            # use the sound feature index as an identifier. 
-            # sound feature does not need to stay connected to its word
-            for cur_tindex in cur_features['sound']:
-                # continually append units as each line is processed
-                units.append(cur_tindex)
-    # count number of times each feature member appears in text
-    units_count = Counter(units)
-    # Frequency is the number of times a word occurs in a text 
-    # divided by the total number of words in that text
-    frequencies = {}
-    inv_frequencies = {}
-    N_text = len(units)
-    for sound in units_count:
-        frequencies[sound] = units_count[sound]/N_text
-        inv_frequencies[sound] = 1/frequencies[sound]
-    return inv_frequencies
+            # use the form index as an identifier for this token's word
+            # type
+            cur_tindex = cur_features['form'][0]
+            token_forms.append(cur_tindex)
+            pair_forms.extend([cur_tindex] * len(cur_features[feature]))
+            pair_features.extend(cur_features[feature])
+    return (np.array(token_forms, dtype=np.int64),
+            np.array(pair_forms, dtype=np.int64),
+            np.array(pair_features, dtype=np.int64))
 
 
+def _count_matching_tokens(token_forms, pair_forms, pair_features):
+    """Count the tokens that share a feature type with each word type
+
+    Parameters
+    ----------
+    token_forms, pair_forms, pair_features
+        see ``_get_token_features()``
+
+    Returns
+    -------
+    1d np.array of ints
+        index by form index to obtain the number of tokens sharing at least
+        one same feature type with that word
+    """
+    # tokens that are not words (such as numbers) carry the placeholder
+    # index -1 and match nothing
+    token_forms = token_forms[token_forms >= 0]
+    valid = (pair_forms >= 0) & (pair_features >= 0)
+    pair_forms = pair_forms[valid]
+    pair_features = pair_features[valid]
+    num_forms = token_forms.max() + 1 if len(token_forms) else 0
+    word_counts = np.bincount(token_forms, minlength=num_forms)
+    # only word and feature types that appear in the text need a row or a
+    # column in the matrix
+    _, pair_cols = np.unique(pair_features, return_inverse=True)
+    num_cols = pair_cols.max() + 1 if len(pair_cols) else 0
+    word_feature_matrix = csr_matrix(
+        (np.ones(len(pair_forms), dtype=np.bool),
+         (pair_forms, pair_cols.reshape(-1))),
+        shape=(num_forms, num_cols))
+    # if matching_words_matrix[i, j] == True, then the word i shared at least
+    # one feature type with the word j
+    matching_words_matrix = word_feature_matrix.dot(
+        word_feature_matrix.transpose())
+    # counting up how many times each matching word appeared gives the total
+    # number of tokens associated with each word
+    return matching_words_matrix.astype(np.int64).dot(word_counts)
+
+
+def _get_cached_array(connection, text_id, kind, key, compute):
+    """Serve an array derived from a text from the local cache
+
+    Arrays are computed and stored on first use, stamped with the version of
+    the text (see ``get_text_version()``); arrays stored under another
+    version are computed again.
+
+    Parameters
+    ----------
+    connection : tesserae.db.mongodb.TessMongoConnection
+    text_id : bson.objectid.ObjectId
+        ObjectId of the text from which the array is derived
+    kind, key : str
+        where the array is cached (see ``tesserae.utils.cache``)
+    compute : () -> 1d np.array
+        computes the array when it is not in the cache
+
+    Returns
+    -------
+    1d np.array
+    """
+    version = get_text_version(connection, text_id)
+    arrays = load_arrays(kind, key, version)
+    if arrays is not None:
+        return arrays['values']
+    values = compute()
+    save_arrays(kind, key, {'values': values}, version)
+    return values
@@ -3,11 +3,23 @@ import os
 import shutil
 
 from tesserae.db.entities import \
-    Feature, Match, MultiResult, Search, Token, Unit
+    Feature, Match, MatchBlock, MultiResult, Search, Token, Unit
+from tesserae.utils.cache import clear_all, clear_text
+from tesserae.utils.calculations import increment_text_version, \
+    update_corpus_counts
 from tesserae.utils.multitext import \
     BigramWriter, MULTITEXT_SEARCH, unregister_bigrams
 from tesserae.utils.search import NORMAL_SEARCH
 
+# only these fields of a Search are needed to remove it and its results
+_SEARCH_PROJECTION = {
+    '$project': {
+        '_id': True,
+        'results_id': True,
+        'search_type': True
+    }
+}
+
 
 def remove_results(connection, searches):
     """Remove results in the database associated with a collection of searches
@@ -30,17 +42,19 @@ def remove_results(connection, searches):
     if normal_searches:
         matchdb = connection.connection[Match.collection]
         matchdb.delete_many({'search_id': {'$in': [s.id for s in searches]}})
+        blockdb = connection.connection[MatchBlock.collection]
+        blockdb.delete_many({'search_id': {'$in': [s.id for s in searches]}})
         # make sure that multitext searches that are built on top of the
         # searches that are about to be deleted are also included in the
         # multitext searches that are to be deleted
         multi_searches.extend(
-            connection.aggregate(Search.collection, [{
+            connection.iter_aggregate(Search.collection, [{
                 '$match': {
                     'parameters.search_uuid': {
                         '$in': [s.results_id for s in searches]
                     }
                 }
-            }]))
+            }, _SEARCH_PROJECTION]))
         connection.delete(normal_searches)
     if multi_searches:
         multidb = connection.connection[MultiResult.collection]
@@ -71,21 +85,22 @@ def remove_text(connection, text):
     connection.connection[Token.collection].delete_many({'text': text_id})
     connection.connection[Unit.collection].delete_many({'text': text_id})
 
-    searches = connection.aggregate(Search.collection, [{
-        '$match': {
-            '$or': [
-                {
-                    'parameters.source.object_id': str_text_id
-                },
-                {
-                    'parameters.target.object_id': str_text_id
-                },
-                {
-                    'parameters.text_ids': str_text_id
-                },
-            ]
-        }
-    }])
+    searches = list(
+        connection.iter_aggregate(Search.collection, [{
+            '$match': {
+                '$or': [
+                    {
+                        'parameters.source.object_id': str_text_id
+                    },
+                    {
+                        'parameters.target.object_id': str_text_id
+                    },
+                    {
+                        'parameters.text_ids': str_text_id
+                    },
+                ]
+            }
+        }, _SEARCH_PROJECTION]))
     remove_results(connection, searches)
 
     connection.connection[Feature.collection].update_many(
@@ -94,8 +109,11 @@ def remove_text(connection, text):
         }}, {'$unset': {
             'frequencies.' + str_text_id: ""
         }})
+    update_corpus_counts(connection, text.language)
 
     unregister_bigrams(connection, text)
+    increment_text_version(connection, text_id)
+    clear_text(text_id)
 
     connection.delete(text)
 
@@ -104,7 +122,7 @@ def obliterate(connection):
     """VERY DANGEROUS! Completely removes the database
 
     Also removes other files associated with the database (like bigram
-    databases)
+    databases and cached search data)
 
     Parameters
     ----------
@@ -114,5 +132,6 @@ def obliterate(connection):
     """
     if os.path.isdir(BigramWriter.BIGRAM_DB_DIR):
         shutil.rmtree(BigramWriter.BIGRAM_DB_DIR)
+    clear_all()
     for coll_name in connection.connection.list_collection_names():
         connection.connection.drop_collection(coll_name)
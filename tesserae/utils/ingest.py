@@ -2,18 +2,25 @@ import time
 import traceback
 
 from natsort import natsorted
+import pymongo
 
 from tesserae.db.entities import Feature, Token, Unit
 from tesserae.db.entities.text import Text, TextStatus
 from tesserae.features import get_featurizer
 from tesserae.tokenizers import tokenizer_map
 from tesserae.unitizer import Unitizer
+from tesserae.utils.cache import clear_text
+from tesserae.utils.calculations import increment_text_version, \
+    update_corpus_counts
 from tesserae.utils.coordinate import JobQueue
 from tesserae.utils.delete import remove_text
 from tesserae.utils.multitext import register_bigrams, MULTITEXT_SEARCH
 from tesserae.utils.search import NORMAL_SEARCH
 from tesserae.utils.tessfile import TessFile
 
+# number of documents to write to the database in a single bulk write
+UPDATE_BATCH_SIZE = 1000
+
 
 class IngestQueue(JobQueue):
     def __init__(self, db_cred):
@@ -176,6 +183,8 @@ def _ingest_tessfile(connection, text, tessfile, enable_multitext=False):
             features_for_update.append(f)
     connection.insert(features_for_insert)
     connection.update(features_for_update)
+    update_corpus_counts(connection, text.language,
+                         {f.feature for f in features})
 
     unitizer = Unitizer()
     lines, phrases = unitizer.unitize(tokens, tags, tessfile.metadata)
@@ -188,6 +197,7 @@ def _ingest_tessfile(connection, text, tessfile, enable_multitext=False):
 
     connection.insert_nocheck(tokens)
     connection.insert_nocheck(lines + phrases)
+    increment_text_version(connection, text.id)
     if enable_multitext:
         register_bigrams(connection, text)
 
@@ -303,6 +313,7 @@ def _add_feature_for_normal_search(connection, text, feature):
         oid_to_form, tokens, language, feature)
     _update_features(connection, text, feature, tokens,
                      form_oid_to_raw_features)
+    update_corpus_counts(connection, language, [feature])
     db_feature_cache = {
         f.token: f
         for f in connection.find(
@@ -313,11 +324,17 @@ def _add_feature_for_normal_search(connection, text, feature):
                    form_oid_to_raw_features)
     _update_units(connection, text, feature, db_feature_cache,
                   form_oid_to_raw_features, oid_to_form)
+    # cached unit information for this feature is now out of date, here and
+    # on every other host
+    increment_text_version(connection, text.id)
+    clear_text(text.id, feature)
 
 
 def _get_relevant_tokens(connection, text_id):
     """Retrieve only tokens with forms
 
+    Only the form of each token is retrieved from the database.
+
     Parameters
     ----------
     connection : tesserae.db.TessMongoConnection
@@ -327,10 +344,17 @@ def _get_relevant_tokens(connection, text_id):
 
     Returns
     -------
-    List[tesserae.db.entities.Token]
+    List[dict]
+        Token documents, holding only '_id' and 'features.form'
     """
-    tokens = connection.find(Token.collection, text=text_id)
-    return [t for t in tokens if 'form' in t.features and t.features['form']]
+    tokens = connection.iter_find(Token.collection,
+                                  projection={'features.form': True},
+                                  encode=False,
+                                  text=text_id)
+    return [
+        t for t in tokens
+        if 'form' in t.get('features', {}) and t['features']['form']
+    ]
 
 
 def _get_form_oid_to_raw_features(oid_to_form, tokens, language, feature):
@@ -340,8 +364,8 @@ def _get_form_oid_to_raw_features(oid_to_form, tokens, language, feature):
     ----------
     oid_to_form : Dict[ObjectId, tesserae.db.entities.Feature]
         Mapping between ObjectId of a form with its Feature entity
-    tokens : list of tesserae.db.entities.Token
-        All relevant tokens for a text
+    tokens : list of dict
+        All relevant token documents for a text
     language : str
         The language for which this feature type is being extracted
     feature : str
@@ -353,7 +377,7 @@ def _get_form_oid_to_raw_features(oid_to_form, tokens, language, feature):
     """
     oid_to_token = {f_id: f.token for f_id, f in oid_to_form.items()}
     form_oids_encountered = list(
-        set(token.features['form'] for token in tokens))
+        set(token['features']['form'] for token in tokens))
     return {
         form_oid: raw_features
         for form_oid, raw_features in zip(
@@ -379,8 +403,8 @@ def _update_features(connection, text, feature, tokens,
         The text to update with a new feature
     feature : str
         The type of feature to extract and account for from the text
-    tokens : list of tesserae.db.entities.Token
-        All relevant tokens from a text
+    tokens : list of dict
+        All relevant token documents from a text
     form_oid_to_raw_features : dict[ObjectId, list[str]]
         Mapping between form ObjectId and list of strings extracted as raw
         features for that form
@@ -396,7 +420,8 @@ def _update_features(connection, text, feature, tokens,
             tokens,
             form_oid_to_raw_features)
     connection.insert([f for f in token_to_features_for_insert.values()])
-    connection.update([f for f in token_to_features_for_update.values()])
+    connection.update([f for f in token_to_features_for_update.values()],
+                      fields=[f'frequencies.{text.id}'])
     expected_size = len(token_to_features_for_insert) + \
         len(db_feature_cache)
     wait_limit = 20
@@ -428,8 +453,8 @@ def _calculate_new_and_for_update_features(text, feature, db_feature_cache,
         Feature type of interest
     db_feature_cache : dict[str, tesserae.db.entities.Feature]
         Mapping between a feature's token and its corresponding Feature entity
-    tokens : list of tesserae.db.entities.Token
-        All Token entities associated with the text
+    tokens : list of dict
+        All relevant token documents associated with the text
     form_oid_to_raw_features : dict[ObjectId, list[str]]
         Mapping between form ObjectId and list of strings extracted as raw
         features for that form
@@ -439,7 +464,7 @@ def _calculate_new_and_for_update_features(text, feature, db_feature_cache,
     text_id_str = str(text.id)
     language = text.language
     for token in tokens:
-        form_oid = token.features['form']
+        form_oid = token['features']['form']
         f_tokens = form_oid_to_raw_features[form_oid]
         for f_token in f_tokens:
             if f_token:
@@ -471,14 +496,17 @@ def _calculate_new_and_for_update_features(text, feature, db_feature_cache,
 
 def _update_tokens(connection, tokens, feature, db_feature_cache,
                    form_oid_to_raw_features):
-    for token in tokens:
-        form_oid = token.features['form']
-        token.features[feature] = [
-            db_feature_cache[raw_feature].id
-            for raw_feature in form_oid_to_raw_features[form_oid]
-            if raw_feature in db_feature_cache
-        ]
-    connection.update(tokens)
+    updates = (pymongo.UpdateOne({'_id': token['_id']}, {
+        '$set': {
+            f'features.{feature}': [
+                db_feature_cache[raw_feature].id
+                for raw_feature in form_oid_to_raw_features[
+                    token['features']['form']]
+                if raw_feature in db_feature_cache
+            ]
+        }
+    }) for token in tokens)
+    _bulk_write(connection, Token.collection, updates)
 
 
 def _update_units(connection, text, feature, db_feature_cache,
@@ -494,14 +522,70 @@ def _update_units(connection, text, feature, db_feature_cache,
         ]
         for form_oid, raw_features in form_oid_to_raw_features.items()
     }
-    units = connection.find(Unit.collection, text=text.id)
-    for unit in units:
-        for token in unit.tokens:
-            form_index = token['features']['form'][0]
-            if form_index >= 0:
-                token['features'][feature] = form_index_to_feature_indices[
-                    form_index]
-    connection.update(units)
+    units = connection.iter_find(Unit.collection,
+                                 projection={'tokens.features.form': True},
+                                 batch_size=UPDATE_BATCH_SIZE,
+                                 encode=False,
+                                 text=text.id)
+    updates = (_get_unit_update(unit, feature, form_index_to_feature_indices)
+               for unit in units)
+    _bulk_write(connection, Unit.collection,
+                (update for update in updates if update is not None))
+
+
+def _get_unit_update(unit, feature, form_index_to_feature_indices):
+    """Build the update adding a feature to a unit's tokens
+
+    Only the new feature of each token is set, leaving the rest of the unit
+    untouched.
+
+    Parameters
+    ----------
+    unit : dict
+        Unit document, holding at least '_id' and the form of each of its
+        tokens
+    feature : str
+        The type of feature being added
+    form_index_to_feature_indices : dict[int, list[int]]
+        Mapping between form index and the indices of its features
+
+    Returns
+    -------
+    pymongo.UpdateOne or None
+        None if none of the unit's tokens has a form
+    """
+    new_values = {}
+    for i, token in enumerate(unit['tokens']):
+        form_index = token['features']['form'][0]
+        if form_index >= 0:
+            new_values[f'tokens.{i}.features.{feature}'] = \
+                form_index_to_feature_indices[form_index]
+    if not new_values:
+        return None
+    return pymongo.UpdateOne({'_id': unit['_id']}, {'$set': new_values})
+
+
+def _bulk_write(connection, collection, updates):
+    """Apply database updates in batches of UPDATE_BATCH_SIZE
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+        A connection to the database
+    collection : str
+        The collection to update
+    updates : iterable of pymongo.UpdateOne
+        The updates to apply
+    """
+    coll = connection.connection[collection]
+    batch = []
+    for update in updates:
+        batch.append(update)
+        if len(batch) >= UPDATE_BATCH_SIZE:
+            coll.bulk_write(batch)
+            batch = []
+    if batch:
+        coll.bulk_write(batch)
 
 
 def _add_feature_for_multitext_search(connection, text, feature):
@@ -16,7 +16,9 @@ from tesserae.db.entities import \
     Feature, Match, MultiResult, Search, Text, Unit
 from tesserae.db.entities.text import TextStatus
 from tesserae.utils.calculations import get_inverse_text_frequencies
+from tesserae.utils.progress import ProgressReporter
 from tesserae.utils.retrieve import TagHelper
+from tesserae.utils.search import has_compact_results
 
 MULTITEXT_SEARCH = 'multitext'
 
@@ -85,15 +87,22 @@ def _run_multitext(connection, results_status, parallels_uuid, texts_ids_strs,
     """
     start_time = time.time()
     try:
-        search = connection.find(Search.collection,
-                                 results_id=parallels_uuid)[0]
-        results_status.update_current_stage_value(0.33)
-        connection.update(results_status)
-        matches = connection.find(Match.collection, search_id=search.id)
-        results_status.update_current_stage_value(0.66)
-        connection.update(results_status)
-        texts = connection.find(Text.collection,
-                                _id=[ObjectId(tid) for tid in texts_ids_strs])
+        with ProgressReporter(connection, [results_status]) as progress:
+            search = connection.find(Search.collection,
+                                     results_id=parallels_uuid)[0]
+            if has_compact_results(connection, search.id):
+                raise ValueError(
+                    'Multitext search is not supported on compactly stored '
+                    f'results (search {parallels_uuid})')
+            progress.report(0.33)
+            matches = list(
+                connection.iter_find(Match.collection,
+                                     projection={'matched_features': True},
+                                     search_id=search.id))
+            progress.report(0.66)
+            texts = connection.find(
+                Text.collection,
+                _id=[ObjectId(tid) for tid in texts_ids_strs])
         results_status.update_current_stage_value(1.0)
 
         results_status.add_new_stage('get multitext data')
@@ -109,20 +118,20 @@ def _run_multitext(connection, results_status, parallels_uuid, texts_ids_strs,
         results_status.add_new_stage('save multitext results')
         connection.update(results_status)
         stepsize = 5000
-        for start in range(0, len(matches), stepsize):
-            results_status.update_current_stage_value(start / len(matches))
-            connection.update(results_status)
-            multiresults = [
-                MultiResult(search_id=search_id,
-                            match_id=m.id,
-                            bigram=list(bigram),
-                            units=[v[0] for v in values],
-                            scores=[v[1] for v in values])
-                for m, result in zip(matches[start:start + stepsize],
-                                     raw_results[start:start + stepsize])
-                for bigram, values in result.items() if values
-            ]
-            connection.insert_nocheck(multiresults)
+        with ProgressReporter(connection, [results_status]) as progress:
+            for start in range(0, len(matches), stepsize):
+                progress.report(start / len(matches))
+                multiresults = [
+                    MultiResult(search_id=search_id,
+                                match_id=m.id,
+                                bigram=list(bigram),
+                                units=[v[0] for v in values],
+                                scores=[v[1] for v in values])
+                    for m, result in zip(matches[start:start + stepsize],
+                                         raw_results[start:start + stepsize])
+                    for bigram, values in result.items() if values
+                ]
+                connection.insert_nocheck(multiresults)
 
         results_status.update_current_stage_value(1.0)
         results_status.status = Search.DONE
@@ -170,12 +179,7 @@ def compute_inverse_frequencies(connection, feature_type, text_id):
     1d np.array
         index by form index to obtain corresponding inverse text frequency
     """
-    inv_freqs_dict = get_inverse_text_frequencies(connection, feature_type,
-                                                  text_id)
-    inverse_frequencies = np.zeros(max(inv_freqs_dict) + 1)
-    inverse_frequencies[[k for k in inv_freqs_dict.keys()]] = \
-        [v for v in inv_freqs_dict.values()]
-    return inverse_frequencies
+    return get_inverse_text_frequencies(connection, feature_type, text_id)
 
 
 class BigramWriter:
@@ -485,30 +489,29 @@ def multitext_search(results_status, connection, matches, feature_type,
         restricted to those which are found in ``texts``
     """
     language = texts[0].language
-    token2index = {
-        f.token: f.index
-        for f in connection.find(
-            Feature.collection, feature=feature_type, language=language)
-    }
-    results_status.update_current_stage_value(0.25)
-    connection.update(results_status)
-
-    bigram_indices = set()
-    for m in matches:
-        for w1, w2 in itertools.combinations(sorted(m.matched_features), 2):
-            bigram_indices.add((token2index[w1], token2index[w2]))
-    results_status.update_current_stage_value(0.5)
-    connection.update(results_status)
-
-    bigram2units = defaultdict(list)
-    for text in texts:
-        bigram_data = lookup_bigrams(text.id,
-                                     'phrase' if text.is_prose else unit_type,
-                                     feature_type, bigram_indices)
-        for bigram, data in bigram_data.items():
-            bigram2units[bigram].extend([u for u in data])
-    results_status.update_current_stage_value(0.75)
-    connection.update(results_status)
+    with ProgressReporter(connection, [results_status]) as progress:
+        token2index = {
+            f.token: f.index
+            for f in connection.find(
+                Feature.collection, feature=feature_type, language=language)
+        }
+        progress.report(0.25)
+
+        bigram_indices = set()
+        for m in matches:
+            for w1, w2 in itertools.combinations(sorted(m.matched_features),
+                                                 2):
+                bigram_indices.add((token2index[w1], token2index[w2]))
+        progress.report(0.5)
+
+        bigram2units = defaultdict(list)
+        for text in texts:
+            bigram_data = lookup_bigrams(
+                text.id, 'phrase' if text.is_prose else unit_type,
+                feature_type, bigram_indices)
+            for bigram, data in bigram_data.items():
+                bigram2units[bigram].extend([u for u in data])
+        progress.report(0.75)
 
     return [{
         bigram: bigram2units[(token2index[bigram[0]], token2index[bigram[1]])]
@@ -672,21 +675,21 @@ def _retrieve_raw_multiresults(connection, search_id, original_matches):
     while start < len(original_matches):
         end = start + increment
         match_params['match_id'] = {'$in': original_match_ids[start:end]}
-        results.extend([
-            mr for mr in connection.aggregate(MultiResult.collection,
-                                              [{
-                                                  '$match': match_params
-                                              }, {
-                                                  '$project': {
-                                                      '_id': False,
-                                                      'match_id': True,
-                                                      'bigram': True,
-                                                      'units': True,
-                                                      'scores': True,
-                                                  }
-                                              }],
-                                              encode=False)
-        ])
+        pipeline = [{
+            '$match': match_params
+        }, {
+            '$project': {
+                '_id': False,
+                'match_id': True,
+                'bigram': True,
+                'units': True,
+                'scores': True,
+            }
+        }]
+        results.extend(
+            connection.iter_aggregate(MultiResult.collection,
+                                      pipeline,
+                                      encode=False))
         start = end
     return results
 
@@ -706,7 +709,7 @@ def _retrieve_id_to_needed_units(connection, raw_multiresults):
     -------
     Dict[ObjectId, tesserae.db.entities.Unit]
         mapping between an ObjectId and its corresponding Unit entity in the
-        database
+        database; only the text, tags, and snippet of each Unit are retrieved
     """
     result = {}
     needed_ids = list(
@@ -715,9 +718,10 @@ def _retrieve_id_to_needed_units(connection, raw_multiresults):
     start = 0
     while start < len(needed_ids):
         end = start + increment
-        result.update((unit.id, unit)
-                      for unit in connection.find(Unit.collection,
-                                                  _id=needed_ids[start:end]))
+        result.update((unit.id, unit) for unit in connection.iter_find(
+            Unit.collection,
+            projection=['text', 'tags', 'snippet'],
+            _id=needed_ids[start:end]))
         start = end
     return result
 
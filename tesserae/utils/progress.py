@@ -0,0 +1,104 @@
+"""Reporting the progress of long-running jobs"""
+import threading
+import traceback
+
+# seconds between writes of a job's progress to the database
+PROGRESS_INTERVAL = 1.0
+
+
+class ProgressReporter(object):
+    """Coalesces progress updates to Search entities
+
+    Progress reported through this object is only recorded in memory; a
+    background thread writes the latest value to the database every
+    ``interval`` seconds, so that the job reporting progress never waits on
+    the database to do so.  A reporter covers a single stage of the job:
+    leaving its ``with`` block stops the thread and writes any progress not
+    yet written, so that stage transitions and status changes made afterwards
+    are never overwritten by stale progress.
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    searches : list of tesserae.db.entities.Search
+        the status keepers of the job, all of which are in the same stage
+    interval : float, optional
+        seconds between writes to the database
+
+    Attributes
+    ----------
+    error : str or None
+        the traceback of the last error that kept progress from being
+        written, if any; the background thread retries writing at the next
+        interval
+
+    Examples
+    --------
+    >>> with ProgressReporter(connection, [search]) as progress:
+    ...     for i, block in enumerate(blocks):
+    ...         progress.report(i / len(blocks))
+    ...         process(block)
+    """
+    def __init__(self, connection, searches, interval=PROGRESS_INTERVAL):
+        self.connection = connection
+        self.searches = searches
+        self.interval = interval
+        self.error = None
+        self._value = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def report(self, value):
+        """Record the completion of the current stage
+
+        Parameters
+        ----------
+        value : float
+            completion of the current stage, from 0.0 to 1.0
+        """
+        with self._lock:
+            self._value = value
+
+    def flush(self):
+        """Write the latest reported progress to the database, if new"""
+        with self._lock:
+            value = self._value
+        if value is None:
+            return
+        for search in self.searches:
+            search.update_current_stage_value(value)
+        self.connection.update(self.searches, fields=['progress'])
+        with self._lock:
+            if self._value == value:
+                self._value = None
+
+    def close(self):
+        """Stop the background thread and write any remaining progress
+
+        Errors in writing are recorded in ``error`` rather than raised, so
+        that they neither replace an error raised during the stage nor fail a
+        stage whose work is already done.
+        """
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._try_flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._try_flush()
+
+    def _try_flush(self):
+        try:
+            self.flush()
+        # progress is written again once the database is reachable
+        except Exception:
+            self.error = traceback.format_exc()
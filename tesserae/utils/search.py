@@ -1,15 +1,31 @@
 """Helper functions for running Tesserae search"""
 import datetime
+import itertools
+import queue
+import threading
 import time
 import traceback
 
+from bson.objectid import ObjectId
 from natsort import natsorted
+import numpy as np
 
-from tesserae.db.entities import Match, Search
+from tesserae.db.entities import Feature, Match, MatchBlock, Search, Text, \
+    Unit
 import tesserae.matchers
+from tesserae.utils.progress import ProgressReporter
+from tesserae.utils.retrieve import TagHelper
 
 NORMAL_SEARCH = 'vanilla'
 
+# number of match batches that may wait to be saved before matching pauses
+SAVE_QUEUE_SIZE = 4
+# number of matches to insert into the database at a time
+SAVE_CHUNK_SIZE = 5000
+# number of Units or Features to look up at a time when retrieving compactly
+# stored matches
+LOOKUP_CHUNK_SIZE = 1000
+
 
 def submit_search(jobqueue, connection, results_id, matcher_type,
                   search_params):
@@ -44,6 +60,146 @@ def submit_search(jobqueue, connection, results_id, matcher_type,
     jobqueue.queue_job(_run_search, kwargs)
 
 
+def submit_batch_search(jobqueue, connection, results_ids, matcher_type,
+                        search_params):
+    """Submit a job for Tesserae search of one source against many targets
+
+    The source text is matched against all of the target texts at once, but
+    the results for each target text are kept by their own Search entity, just
+    as though a separate search had been submitted for each target text.
+
+    Parameters
+    ----------
+    jobqueue : tesserae.utils.coordinate.JobQueue
+    connection : TessMongoConnection
+    results_ids : list of str
+        UUIDs to associate with the searches to be performed, one for each
+        target text
+    matcher_type : str
+        the matcher to use for search to perform; must be a key in
+        tesserae.matchers.matcher_map, and the matcher must have a
+        ``match_many`` method
+    search_params : dict
+        parameter names mapped to arguments to be used for the search; instead
+        of 'target', 'targets' maps to a list of target texts
+
+    Raises
+    ------
+    ValueError
+        Raised when the matcher cannot search many targets at once, or when
+        the number of results_ids does not match the number of targets
+
+    """
+    matcher_class = tesserae.matchers.matcher_map[matcher_type]
+    if not hasattr(matcher_class, 'match_many'):
+        raise ValueError(f'Matcher "{matcher_type}" cannot search many target '
+                         f'texts at once')
+    targets = search_params['targets']
+    if len(results_ids) != len(targets):
+        raise ValueError(f'Expected one results_id per target text, but got '
+                         f'{len(results_ids)} for {len(targets)} target texts')
+    common_params = {
+        k: v
+        for k, v in search_params.items() if k != 'targets'
+    }
+    results_statuses = _create_searches(
+        connection, matcher_class, results_ids,
+        [dict(common_params, target=target) for target in targets])
+    kwargs = {
+        'results_statuses': results_statuses,
+        'matcher_type': matcher_type,
+        'search_params': search_params
+    }
+    jobqueue.queue_job(_run_batch_search, kwargs)
+
+
+def submit_sweep_search(jobqueue, connection, results_ids, matcher_type,
+                        search_params):
+    """Submit a job for Tesserae search under several scoring settings
+
+    Candidate matches are found once and scored under each setting, but the
+    results for each setting are kept by their own Search entity, just as
+    though a separate search had been submitted for each setting.
+
+    Parameters
+    ----------
+    jobqueue : tesserae.utils.coordinate.JobQueue
+    connection : TessMongoConnection
+    results_ids : list of str
+        UUIDs to associate with the searches to be performed, one for each
+        scoring setting
+    matcher_type : str
+        the matcher to use for search to perform; must be a key in
+        tesserae.matchers.matcher_map, and the matcher must have a
+        ``match_sweep_batches`` method
+    search_params : dict
+        parameter names mapped to arguments to be used for the search; instead
+        of 'max_distance', 'distance_basis', and 'min_score', 'scorings' maps
+        to a list of dictionaries, each of which holds those three parameters
+
+    Raises
+    ------
+    ValueError
+        Raised when the matcher cannot score under several settings at once,
+        or when the number of results_ids does not match the number of
+        scoring settings
+
+    """
+    matcher_class = tesserae.matchers.matcher_map[matcher_type]
+    if not hasattr(matcher_class, 'match_sweep_batches'):
+        raise ValueError(f'Matcher "{matcher_type}" cannot score under '
+                         f'several settings at once')
+    scorings = search_params['scorings']
+    if len(results_ids) != len(scorings):
+        raise ValueError(f'Expected one results_id per scoring setting, but '
+                         f'got {len(results_ids)} for {len(scorings)} scoring '
+                         f'settings')
+    common_params = {
+        k: v
+        for k, v in search_params.items() if k != 'scorings'
+    }
+    results_statuses = _create_searches(
+        connection, matcher_class, results_ids,
+        [dict(common_params, **scoring) for scoring in scorings])
+    kwargs = {
+        'results_statuses': results_statuses,
+        'matcher_type': matcher_type,
+        'search_params': search_params
+    }
+    jobqueue.queue_job(_run_sweep_search, kwargs)
+
+
+def _create_searches(connection, matcher_class, results_ids,
+                     search_params_list):
+    """Insert a Search entity for each of several searches
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    matcher_class
+        the class of the matcher to use for the searches
+    results_ids : list of str
+        UUIDs to associate with the searches
+    search_params_list : list of dict
+        the parameters of each search, as they would be given to
+        ``submit_search()``
+
+    Returns
+    -------
+    list of tesserae.db.entities.Search
+    """
+    results_statuses = [
+        Search(results_id=results_id,
+               search_type=NORMAL_SEARCH,
+               status=Search.INIT,
+               msg='',
+               parameters=matcher_class.paramify(single_params))
+        for results_id, single_params in zip(results_ids, search_params_list)
+    ]
+    connection.insert(results_statuses)
+    return results_statuses
+
+
 def _run_search(connection, results_status, matcher_type, search_params):
     """Instructions for running Tesserae search
 
@@ -62,34 +218,240 @@ def _run_search(connection, results_status, matcher_type, search_params):
     start_time = time.time()
     try:
         matcher = tesserae.matchers.matcher_map[matcher_type](connection)
+        _start_matching(connection, [results_status])
+        if hasattr(matcher, 'match_batches'):
+            batches = matcher.match_batches(results_status, **search_params)
+        else:
+            batches = [matcher.match(results_status, **search_params)]
+        _save_batches(connection, [results_status], batches, start_time)
+    # we want to catch all errors and log them into the Search entity
+    except:  # noqa: E722
+        _fail_searches(connection, [results_status])
+
+
+def _run_batch_search(connection, results_statuses, matcher_type,
+                      search_params):
+    """Instructions for running Tesserae search against many targets
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    results_statuses : list of tesserae.db.entities.Search
+        Status keepers, one for each target text
+    matcher_type : str
+        the matcher to use for search to perform; must be a key in
+        tesserae.matchers.matcher_map
+    search_params : dict
+        parameter names mapped to arguments to be used for the search; see
+        ``submit_batch_search()``
+
+    """
+    def _gen_block_matches(matcher):
+        return matcher.match_many_batches(results_statuses, **search_params)
+
+    _run_many_searches(connection, results_statuses, matcher_type,
+                       _gen_block_matches)
+
+
+def _run_sweep_search(connection, results_statuses, matcher_type,
+                      search_params):
+    """Instructions for running Tesserae search under several scorings
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    results_statuses : list of tesserae.db.entities.Search
+        Status keepers, one for each scoring setting
+    matcher_type : str
+        the matcher to use for search to perform; must be a key in
+        tesserae.matchers.matcher_map
+    search_params : dict
+        parameter names mapped to arguments to be used for the search; see
+        ``submit_sweep_search()``
+
+    """
+    def _gen_block_matches(matcher):
+        return matcher.match_sweep_batches(results_statuses, **search_params)
+
+    _run_many_searches(connection, results_statuses, matcher_type,
+                       _gen_block_matches)
+
+
+def _run_many_searches(connection, results_statuses, matcher_type,
+                       gen_block_matches):
+    """Run searches whose matches are found together
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    results_statuses : list of tesserae.db.entities.Search
+        Status keepers
+    matcher_type : str
+        the matcher to use for search to perform; must be a key in
+        tesserae.matchers.matcher_map
+    gen_block_matches : (matcher) -> iterable of list of list of Match
+        given the matcher, generates the matches found in each block of
+        source units for each search
+
+    """
+    start_time = time.time()
+    try:
+        matcher = tesserae.matchers.matcher_map[matcher_type](connection)
+        _start_matching(connection, results_statuses)
+        batches = (itertools.chain.from_iterable(block_matches)
+                   for block_matches in gen_block_matches(matcher))
+        _save_batches(connection, results_statuses, batches, start_time)
+    # we want to catch all errors and log them into the Search entities
+    except:  # noqa: E722
+        _fail_searches(connection, [
+            results_status for results_status in results_statuses
+            if results_status.status != Search.DONE
+        ])
+
+
+def _start_matching(connection, results_statuses):
+    """Mark searches as running and entering the match stage"""
+    for results_status in results_statuses:
         results_status.update_current_stage_value(1.0)
 
         results_status.status = Search.RUN
         results_status.last_queried = datetime.datetime.utcnow()
         results_status.add_new_stage('match and score')
         connection.update(results_status)
-        matches = matcher.match(results_status, **search_params)
-        matches.sort(key=lambda m: m.score, reverse=True)
-        results_status.update_current_stage_value(1.0)
 
+
+class _MatchWriter(threading.Thread):
+    """Thread which inserts batches of matches into the database
+
+    Batches are inserted in the order they are put on the queue, while the
+    thread that puts them there continues finding matches.  Once ``None`` is
+    put on the queue, the thread finishes.
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    batches : queue.Queue
+        holds the lists of tesserae.db.entities.Match to insert
+
+    Attributes
+    ----------
+    written : int
+        the number of matches inserted so far
+    error : str or None
+        the traceback of the error that stopped the thread from inserting
+        matches, if any
+    """
+    def __init__(self, connection, batches):
+        super().__init__(daemon=True)
+        self.connection = connection
+        self.batches = batches
+        self.written = 0
+        self.error = None
+
+    def run(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                # keep emptying the queue so that the matching thread is not
+                # left waiting on it
+                continue
+            try:
+                for start in range(0, len(batch), SAVE_CHUNK_SIZE):
+                    self.connection.insert_nocheck(batch[start:start +
+                                                         SAVE_CHUNK_SIZE])
+                self.written += len(batch)
+            # the error is reported by the thread that started this one
+            except:  # noqa: E722
+                self.error = traceback.format_exc()
+
+
+def _save_batches(connection, results_statuses, batches, start_time):
+    """Save matches as they are found and mark the searches as done
+
+    Matches are saved in the order found rather than sorted by score;
+    retrieval sorts them by score instead (see
+    ``retrieve_matches_by_search_id()``).
+
+    Parameters
+    ----------
+    connection : TessMongoConnection
+    results_statuses : list of tesserae.db.entities.Search
+        Status keepers whose matches are being saved
+    batches : iterable of iterable of tesserae.db.entities.Match or MatchBlock
+        batches of matches, which may still be being found
+    start_time : float
+        when the searches started, as given by ``time.time()``
+
+    Raises
+    ------
+    RuntimeError
+        Raised when the matches could not be saved
+
+    """
+    # matching may fork worker processes before yielding its first batch;
+    # getting that batch before the writer thread starts keeps the workers
+    # from being forked while the writer holds the database client's locks
+    batches = iter(batches)
+    first_batches = list(itertools.islice(batches, 1))
+    to_write = queue.Queue(maxsize=SAVE_QUEUE_SIZE)
+    writer = _MatchWriter(connection, to_write)
+    writer.start()
+    queued = 0
+    try:
+        for batch in itertools.chain(first_batches, batches):
+            if writer.error is not None:
+                break
+            batch = list(batch)
+            queued += len(batch)
+            to_write.put(batch)
+    except:  # noqa: E722
+        # matches of a failed search should not linger in the database
+        to_write.put(None)
+        writer.join()
+        _delete_matches(connection, results_statuses)
+        raise
+    to_write.put(None)
+
+    for results_status in results_statuses:
+        results_status.update_current_stage_value(1.0)
         results_status.add_new_stage('save results')
         connection.update(results_status)
-        stepsize = 5000
-        for start in range(0, len(matches), stepsize):
-            results_status.update_current_stage_value(start / len(matches))
-            connection.update(results_status)
-            connection.insert_nocheck(matches[start:start + stepsize])
-
+    with ProgressReporter(connection, results_statuses) as progress:
+        while writer.is_alive():
+            writer.join(timeout=1.0)
+            progress.report(writer.written / queued if queued else 1.0)
+    if writer.error is not None:
+        _delete_matches(connection, results_statuses)
+        raise RuntimeError(f'Could not save matches:\n{writer.error}')
+
+    for results_status in results_statuses:
         results_status.update_current_stage_value(1.0)
         results_status.status = Search.DONE
         results_status.msg = 'Done in {} seconds'.format(time.time() -
                                                          start_time)
         results_status.last_queried = datetime.datetime.utcnow()
         connection.update(results_status)
-    # we want to catch all errors and log them into the Search entity
-    except:  # noqa: E722
+
+
+def _delete_matches(connection, results_statuses):
+    """Remove any matches saved for the searches"""
+    for collection in [Match.collection, MatchBlock.collection]:
+        connection.connection[collection].delete_many({
+            'search_id': {
+                '$in':
+                [results_status.id for results_status in results_statuses]
+            }
+        })
+
+
+def _fail_searches(connection, results_statuses):
+    """Log the error being handled into the searches it brought down"""
+    msg = traceback.format_exc()
+    for results_status in results_statuses:
         results_status.status = Search.FAILED
-        results_status.msg = traceback.format_exc()
+        results_status.msg = msg
         results_status.last_queried = datetime.datetime.utcnow()
         connection.update(results_status)
 
@@ -215,8 +577,17 @@ def retrieve_matches_by_search_id(connection, search_id):
     Returns
     -------
     list of MatchResult
+        sorted by score, from highest to lowest
     """
-    return retrieve_matches(connection, [{'$match': {'search_id': search_id}}])
+    return retrieve_matches(connection, [{
+        '$match': {
+            'search_id': search_id
+        }
+    }, {
+        '$sort': {
+            'score': -1
+        }
+    }])
 
 
 def retrieve_matches_by_page(connection, search_id, page_options):
@@ -233,6 +604,9 @@ def retrieve_matches_by_page(connection, search_id, page_options):
     -------
     list of MatchResult
     """
+    if has_compact_results(connection, search_id):
+        return retrieve_compact_matches_by_page(connection, search_id,
+                                                page_options)
     all_specified = page_options.all_specified()
     if all_specified and page_options.sort_by == 'score':
         start = page_options.page_number * page_options.per_page
@@ -250,7 +624,22 @@ def retrieve_matches_by_page(connection, search_id, page_options):
             '$limit': page_options.per_page
         }])
     all_matches = retrieve_matches_by_search_id(connection, search_id)
-    if all_specified:
+    return _page_matches(all_matches, page_options)
+
+
+def _page_matches(all_matches, page_options):
+    """Sort and page through matches that have all been retrieved
+
+    Parameters
+    ----------
+    all_matches : list of MatchResult
+    page_options : PageOptions
+
+    Returns
+    -------
+    list of MatchResult
+    """
+    if page_options.all_specified():
         start = page_options.page_number * page_options.per_page
         end = start + page_options.per_page
         if page_options.sort_by == 'source_tag':
@@ -269,6 +658,161 @@ def retrieve_matches_by_page(connection, search_id, page_options):
     return all_matches
 
 
+def has_compact_results(connection, search_id):
+    """Check whether the matches of a search are stored compactly
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    search_id : ObjectId
+        ObjectId of Search whose results are of interest
+
+    Returns
+    -------
+    bool
+        True if the matches are stored as MatchBlock entities rather than as
+        Match entities
+    """
+    return connection.connection[MatchBlock.collection].find_one(
+        {'search_id': search_id}, projection={'_id': True}) is not None
+
+
+def retrieve_compact_matches_by_page(connection, search_id, page_options):
+    """Obtain relevant compactly stored matches according to the paging options
+
+    Matches are reconstructed from the MatchBlock entities of the search,
+    with their tags, snippets, and matched features looked up from the Units
+    and Features they refer to.  When paging by score, only the matches on
+    the requested page are reconstructed.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    search_id : ObjectId
+        ObjectId of Search whose results you are trying to retrieve
+    page_options : PageOptions
+
+    Returns
+    -------
+    list of MatchResult
+        in the same form as returned by ``retrieve_matches()``, except that
+        the 'object_id' of each match identifies its MatchBlock and its
+        position within that block
+    """
+    blocks = list(
+        connection.iter_find(
+            MatchBlock.collection,
+            sort=[('index', 1)],
+            projection=['index', 'count', 'language', 'feature', 'scores'],
+            search_id=search_id))
+    if not blocks:
+        return []
+    counts = [block.count for block in blocks]
+    scores = np.concatenate([block.get_scores() for block in blocks])
+    block_inds = np.repeat(np.arange(len(blocks)), counts)
+    rows = np.arange(len(scores)) - np.repeat(
+        np.cumsum([0] + counts[:-1]), counts)
+    if page_options.all_specified() and page_options.sort_by == 'score':
+        start = page_options.page_number * page_options.per_page
+        # a stable sort keeps matches with equal scores in the order found
+        order = np.argsort(
+            scores * page_options.sort_order,
+            kind='mergesort')[start:start + page_options.per_page]
+        return _reconstruct_matches(connection, blocks, block_inds[order],
+                                    rows[order], scores[order])
+    # as with Match entities, matches not paged by score come sorted by score
+    order = np.argsort(-scores, kind='mergesort')
+    return _page_matches(
+        _reconstruct_matches(connection, blocks, block_inds[order],
+                             rows[order], scores[order]), page_options)
+
+
+def _reconstruct_matches(connection, blocks, block_inds, rows, scores):
+    """Build MatchResults from compactly stored matches
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    blocks : list of tesserae.db.entities.MatchBlock
+        the blocks of a search, holding at least their ids, languages, and
+        features
+    block_inds : 1d np.array of ints
+        the index into ``blocks`` of the block holding each match
+    rows : 1d np.array of ints
+        the position of each match within its block
+    scores : 1d np.array of floats
+        the score of each match
+
+    Returns
+    -------
+    list of MatchResult
+    """
+    if len(scores) == 0:
+        return []
+    columns = {
+        block.id: block.get_columns()
+        for block in connection.iter_find(
+            MatchBlock.collection,
+            projection=['columns'],
+            _id=[blocks[i].id for i in np.unique(block_inds)])
+    }
+    found = []
+    for block_ind, row in zip(block_inds.tolist(), rows.tolist()):
+        block_id = blocks[block_ind].id
+        cols = columns[block_id]
+        f_start, f_end = cols['feature_breaks'][row:row + 2]
+        h_start, h_end = cols['highlight_breaks'][row:row + 2]
+        found.append(
+            (f'{block_id}-{row}',
+             ObjectId(cols['source_unit_ids'][row].tobytes()),
+             ObjectId(cols['target_unit_ids'][row].tobytes()),
+             cols['feature_inds'][f_start:f_end].tolist(),
+             [[s_pos, t_pos] for s_pos, t_pos in zip(
+                 cols['source_positions'][h_start:h_end].tolist(),
+                 cols['target_positions'][h_start:h_end].tolist())]))
+
+    unit_ids = list({unit_id for f in found for unit_id in f[1:3]})
+    units = {}
+    for start in range(0, len(unit_ids), LOOKUP_CHUNK_SIZE):
+        units.update((unit.id, unit) for unit in connection.iter_find(
+            Unit.collection,
+            projection=['text', 'tags', 'snippet'],
+            _id=unit_ids[start:start + LOOKUP_CHUNK_SIZE]))
+    tag_helper = TagHelper(
+        connection,
+        connection.find(Text.collection,
+                        _id=list({unit.text for unit in units.values()})))
+    feature_inds = sorted({ind for f in found for ind in f[3]})
+    tokens = {}
+    for start in range(0, len(feature_inds), LOOKUP_CHUNK_SIZE):
+        tokens.update((feature.index, feature.token)
+                      for feature in connection.iter_find(
+                          Feature.collection,
+                          projection=['index', 'token'],
+                          language=blocks[0].language,
+                          feature=blocks[0].feature,
+                          index=feature_inds[start:start + LOOKUP_CHUNK_SIZE]))
+
+    results = []
+    for (object_id, source_id, target_id, match_features,
+         highlight), score in zip(found, scores.tolist()):
+        source_unit = units[source_id]
+        target_unit = units[target_id]
+        results.append({
+            'object_id': object_id,
+            'source_tag': tag_helper.get_display_tag(source_unit.text,
+                                                     source_unit.tags),
+            'target_tag': tag_helper.get_display_tag(target_unit.text,
+                                                     target_unit.tags),
+            'matched_features': [tokens[ind] for ind in match_features],
+            'score': score,
+            'source_snippet': source_unit.snippet,
+            'target_snippet': target_unit.snippet,
+            'highlight': highlight
+        })
+    return results
+
+
 def get_results(connection, search_id, page_options):
     """Retrieve search results with associated id
 
@@ -300,6 +844,11 @@ def get_max_score(connection, search_id):
     float
         Maximum score of results associated with ``search_id``
     """
+    if has_compact_results(connection, search_id):
+        return max(
+            block['max_score']
+            for block in connection.connection[MatchBlock.collection].find(
+                {'search_id': search_id}, {'max_score': True}))
     return connection.connection[Match.collection].find_one(
         {'search_id': search_id}, sort=[('score', -1)])['score']
 
@@ -317,6 +866,11 @@ def get_results_count(connection, search_id):
     -------
     float
     """
+    if has_compact_results(connection, search_id):
+        return sum(
+            block['count']
+            for block in connection.connection[MatchBlock.collection].find(
+                {'search_id': search_id}, {'count': True}))
     return connection.connection[Match.collection].count_documents(
         {'search_id': search_id})
 
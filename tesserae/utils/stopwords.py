@@ -1,7 +1,20 @@
 """Functions for interfacing stopwords with database information"""
+from collections import OrderedDict
+import hashlib
+
 import numpy as np
 
 from tesserae.db.entities import Entity, Feature
+from tesserae.utils.calculations import _corpus_key, get_corpus_counts
+
+# database collection holding frequency rankings, each stamped with the
+# version of the corpus counts from which it was computed
+RANKINGS_COLLECTION = 'stoplist_rankings'
+# number of frequency rankings to keep in memory
+RANKINGS_CACHE_SIZE = 32
+# frequency rankings by cache key and corpus counts version, from least to
+# most recently used
+_RANKINGS = OrderedDict()
 
 
 def get_feature_indices(conn, language, feature_type, stopwords):
@@ -62,64 +75,118 @@ def create_stoplist(connection, n, feature, language, basis='corpus'):
     stoplist : 1d np.array of np.unit32
         The `n` most frequent tokens in the basis texts.
     """
-    pipeline = [
-        {
-            '$match': {
-                'feature': feature,
-                'language': language
-            }
-        },
-    ]
+    return np.array(
+        get_frequency_ranking(connection, feature, language, basis)[:n],
+        dtype=np.uint32)
+
+
+def get_frequency_ranking(connection, feature, language, basis='corpus'):
+    """Rank feature types from most to least frequent
+
+    Rankings only change when the corpus changes, so they are stored in the
+    database, stamped with the version of the corpus counts (see
+    ``tesserae.utils.calculations.get_corpus_counts()``) from which they were
+    computed, and the most recently used ones are also kept in memory.
+    Storing a ranking removes the stored rankings of older corpus versions.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    feature : str
+        The type of feature to consider
+    language : str
+        The language of the features to rank
+    basis : list of tesserae.db.entities.Text or 'corpus'
+        The texts to use as the frequency basis. If 'corpus', use frequencies
+        across the entire corpus.
 
+    Returns
+    -------
+    1d np.array of ints
+        feature indices, from most to least frequent; among feature types
+        with the same frequency, lower indices come first
+    """
+    _, version = get_corpus_counts(connection, feature, language)
     if basis == 'corpus':
-        pipeline.append({
-            '$project': {
-                '_id': False,
-                'index': True,
-                'token': True,
-                'frequency': {
-                    '$reduce': {
-                        'input': {
-                            '$objectToArray': '$frequencies'
-                        },
-                        'initialValue': 0,
-                        'in': {
-                            '$sum': ['$$value', '$$this.v']
-                        }
-                    }
-                }
-            }
+        text_ids = []
+        basis_name = 'corpus'
+    else:
+        text_ids = sorted(
+            str(t.id if isinstance(t, Entity) else t) for t in basis)
+        basis_name = hashlib.sha1(
+            ' '.join(text_ids).encode('utf-8')).hexdigest()
+        basis = text_ids
+    doc_id = f'{language}_{feature}_{basis_name}'
+    key = (_corpus_key(connection, feature, language), basis_name, version)
+    ranking = _RANKINGS.get(key)
+    if ranking is not None:
+        _RANKINGS.move_to_end(key)
+        return ranking
+    rankings_db = connection.connection[RANKINGS_COLLECTION]
+    doc = rankings_db.find_one({'_id': doc_id, 'corpus_version': version})
+    if doc is not None:
+        ranking = np.frombuffer(doc['ranking'], dtype=np.uint32)
+    else:
+        ranking = _compute_ranking(connection, feature, language, basis)
+        rankings_db.replace_one({'_id': doc_id}, {
+            'language': language,
+            'feature': feature,
+            'texts': text_ids,
+            'corpus_version': version,
+            'ranking': ranking.tobytes()
+        }, upsert=True)
+        rankings_db.delete_many({
+            'language': language,
+            'feature': feature,
+            'corpus_version': {'$lt': version}
         })
+    _RANKINGS[key] = ranking
+    if len(_RANKINGS) > RANKINGS_CACHE_SIZE:
+        _RANKINGS.popitem(last=False)
+    return ranking
+
+
+def _compute_ranking(connection, feature, language, basis):
+    """Rank feature types by frequency using the database
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    feature, language
+        see ``get_frequency_ranking()``
+    basis : list of str or 'corpus'
+        the string forms of the ObjectIds of the basis texts, or 'corpus'
+
+    Returns
+    -------
+    1d np.array of ints
+        see ``get_frequency_ranking()``
+    """
+    if basis == 'corpus':
+        frequencies, _ = get_corpus_counts(connection, feature, language)
     else:
-        basis = [t.id if isinstance(t, Entity) else t for t in basis]
-        pipeline.extend([{
+        pipeline = [{
+            '$match': {
+                'feature': feature,
+                'language': language
+            }
+        }, {
             '$project': {
                 '_id': False,
                 'index': True,
-                'token': True,
                 'frequency': {
-                    '$sum': ['$frequencies.' + str(t_id) for t_id in basis]
+                    '$sum': ['$frequencies.' + t_id for t_id in basis]
                 }
             }
-        }])
-
-    pipeline.extend([{
-        '$sort': {
-            'frequency': -1
-        }
-    }, {
-        '$limit': n
-    }, {
-        '$project': {
-            'token': True,
-            'index': True,
-            'frequency': True
-        }
-    }])
-
-    stoplist = connection.aggregate(Feature.collection, pipeline, encode=False)
-    stoplist = list(stoplist)
-    return np.array([s['index'] for s in stoplist], dtype=np.uint32)
+        }]
+        found = list(
+            connection.aggregate(Feature.collection, pipeline, encode=False))
+        # feature indices need not be contiguous
+        frequencies = np.zeros(
+            max((f['index'] for f in found), default=-1) + 1, dtype=np.int64)
+        for f in found:
+            frequencies[f['index']] = f['frequency']
+    return np.argsort(-frequencies, kind='mergesort').astype(np.uint32)
 
 
 def get_stoplist_indices(connection, stopwords, feature=None, language=None):
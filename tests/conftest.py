@@ -12,6 +12,7 @@ import pytest
 
 from tesserae.db import TessMongoConnection
 from tesserae.db.entities import Feature, Text
+import tesserae.utils.cache
 from tesserae.utils import ingest_text
 from tesserae.utils.delete import obliterate
 from tesserae.utils.multitext import BigramWriter
@@ -19,6 +20,8 @@ from tesserae.utils.search import get_results, PageOptions
 
 # Make sure that bigram databases are written out to a temporary location
 BigramWriter.BIGRAM_DB_DIR = tempfile.mkdtemp()
+# Likewise for cached search data
+tesserae.utils.cache.CACHE_DIR = tempfile.mkdtemp()
 
 
 def pytest_addoption(parser):
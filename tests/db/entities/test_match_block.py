@@ -0,0 +1,39 @@
+import numpy as np
+from bson.objectid import ObjectId
+
+from tesserae.db.entities.match_block import MatchBlock
+
+
+def _make_columns(unit_ids):
+    ids = np.array([list(u.binary) for u in unit_ids], dtype=np.uint8)
+    return {
+        'source_unit_ids': ids,
+        'target_unit_ids': ids[::-1],
+        'feature_breaks': np.array([0, 2, 3]),
+        'feature_inds': np.array([5, 9, 1]),
+        'highlight_breaks': np.array([0, 2, 4]),
+        'source_positions': np.array([0, 3, 1, 1]),
+        'target_positions': np.array([2, 2, 0, 4]),
+    }
+
+
+def test_from_arrays_roundtrip():
+    search_id = ObjectId()
+    scores = np.array([7.25, 3.5])
+    columns = _make_columns([ObjectId(), ObjectId()])
+    block = MatchBlock.from_arrays(search_id, 3, 'latin', 'lemmata', scores,
+                                   columns)
+    assert block.count == 2
+    assert block.max_score == 7.25
+    assert isinstance(block.scores, bytes)
+    assert isinstance(block.columns, bytes)
+
+    decoded = MatchBlock.json_decode(block.json_encode())
+    assert decoded.search_id == search_id
+    assert decoded.index == 3
+    assert np.array_equal(decoded.get_scores(), scores)
+    found = decoded.get_columns()
+    assert found.keys() == columns.keys()
+    for name, values in columns.items():
+        assert np.array_equal(found[name], values)
+        assert found[name].dtype == values.dtype
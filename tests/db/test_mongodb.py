@@ -14,6 +14,7 @@ test_init
     Test schemes for initializing TessMongoConnection.
 test_insert
 test_find
+test_iter_find
 test_update
 test_delete
     Test CRUD operations mediated by TessMongoConnection.
@@ -249,8 +250,14 @@ def test_insert(request, test_data, depopulate):
         result = conn.insert(ents)
         assert result == []
 
+        # Only entities without ids are inserted from a mixed batch.
+        copy = entity(**val[0])
+        result = conn.insert(ents + [copy])
+        assert result.inserted_ids == [copy.id]
+
         # Clean up
-        conn.connection[key].delete_many({'_id': {'$in': [e.id for e in ents]}})
+        conn.connection[key].delete_many(
+            {'_id': {'$in': [e.id for e in ents] + [copy.id]}})
 
 def test_find(request, populate):
     conf = request.config
@@ -283,6 +290,40 @@ def test_find(request, populate):
         assert result == []
 
 
+def test_iter_find(request, populate):
+    conf = request.config
+    conn = TessMongoConnection(conf.getoption('db_host'),
+                               conf.getoption('db_port'),
+                               conf.getoption('db_user'),
+                               password=conf.getoption('db_passwd',
+                                                       default=None),
+                               db=conf.getoption('db_name',
+                                                 default=None))
+
+    for key, val in populate.items():
+        # Streamed entries should be the same as those found all at once.
+        expected = [r.json_encode() for r in conn.find(key)]
+        result = [r.json_encode() for r in conn.iter_find(key, batch_size=2)]
+        assert result == expected
+        result = [r.json_encode() for r in conn.iter_aggregate(
+            key, [{'$match': {}}], batch_size=2)]
+        assert result == expected
+
+        # Projected documents hold only the requested fields.
+        field = next(k for k in val[0].keys() if k != 'id')
+        for entry in val:
+            result = list(conn.iter_find(key, projection=[field],
+                                         encode=False, _id=entry['id']))
+            assert len(result) == 1
+            assert set(result[0].keys()) <= {'_id', field}
+            assert result[0]['_id'] == entry['id']
+            if field in result[0]:
+                assert result[0][field] == entry[field]
+
+        # Test streaming non-existent entries
+        assert list(conn.iter_find(key, foo='bar')) == []
+
+
 def test_update(request, populate):
     conf = request.config
     conn = TessMongoConnection(conf.getoption('db_host'),
@@ -321,6 +362,16 @@ def test_update(request, populate):
             doc[changes[doc['_id']][0]] == changes[doc['_id']][1]
             for doc in found])
 
+        # test updating only some fields of an entity
+        guinea_pig = entity(**val[0])
+        guinea_pig.eats = 'hay'
+        guinea_pig.sleeps = {'where': 'hutch', 'when': 'noon'}
+        result = conn.update(guinea_pig, fields=['sleeps.where'])
+        assert result.matched_count == 1
+        found = conn.connection[key].find({'_id': guinea_pig.id})[0]
+        assert found['eats'] == 'pellet'
+        assert found['sleeps'] == {'where': 'hutch'}
+
 
 def test_delete(request, populate):
     conf = request.config
@@ -2,13 +2,15 @@ import math
 import uuid
 
 import pytest
+import numpy as np
 
 from tesserae.data import load_greek_to_latin
 from tesserae.db import Feature, Search, Text, \
                         TessMongoConnection
 from tesserae.matchers import GreekToLatinSearch
 from tesserae.matchers.greek_to_latin import \
-    _build_greek_ind_to_other_greek_inds, _get_greek_to_latin_inv_freqs_by_text
+    _get_greek_to_latin_inv_freqs_by_text, get_greek_synonym_matrix, \
+    get_translation_matrix
 from tesserae.matchers.sparse_encoding import _get_units
 from tesserae.matchers.text_options import TextOptions
 from tesserae.utils import ingest_text
@@ -27,30 +29,52 @@ def g2lpop(request, mini_g2l_metadata):
 
 def test_greek_to_latin_inv_freq_by_text(g2lpop, v3checker):
     greek_to_latin = load_greek_to_latin()
-    greek_ind_to_other_greek_inds = _build_greek_ind_to_other_greek_inds(
-        g2lpop, greek_to_latin)
+    greek_synonym_matrix = get_greek_synonym_matrix(g2lpop, greek_to_latin)
     greek_text = g2lpop.find(Text.collection, language='greek')[0]
     greek_text_options = TextOptions(greek_text, 'line')
     greek_text_length = sum(
         len(u['forms'])
         for u in _get_units(g2lpop, greek_text_options, 'lemmata'))
     inv_freqs = _get_greek_to_latin_inv_freqs_by_text(
-        g2lpop, greek_text_options, greek_text_length,
-        greek_ind_to_other_greek_inds)
+        g2lpop, greek_text_options, greek_text_length, greek_synonym_matrix)
     v3_total, v3_counts = v3checker._load_v3_mini_text_freqs_file(
         g2lpop, greek_text, 'g_l')
-    assert len(v3_counts) == len(inv_freqs)
+    assert len(v3_counts) == np.count_nonzero(inv_freqs)
     greek_forms = {
         f.index: f.token
         for f in g2lpop.find(
             Feature.collection, language='greek', feature='form')
     }
     for token, count in v3_counts.items():
-        assert token in inv_freqs
+        assert inv_freqs[token] > 0
         assert math.isclose(inv_freqs[token],
                             float(v3_total) / count), greek_forms[token]
 
 
+def test_translation_matrix(g2lpop):
+    greek_to_latin = load_greek_to_latin()
+    greek_features = g2lpop.find(Feature.collection,
+                                 language='greek',
+                                 feature='lemmata')
+    latin_features = g2lpop.find(Feature.collection,
+                                 language='latin',
+                                 feature='lemmata')
+    latin_features.sort(key=lambda x: x.index)
+    matrix = get_translation_matrix(g2lpop, greek_to_latin, latin_features)
+    assert matrix.shape == (len(greek_features), len(latin_features))
+    latin_tokens = {f.token for f in latin_features}
+    for f in greek_features:
+        expected = {
+            t
+            for t in greek_to_latin.get(f.token, []) if t in latin_tokens
+        }
+        row = matrix.indices[matrix.indptr[f.index]:matrix.indptr[f.index +
+                                                                   1]]
+        assert {latin_features[i].token for i in row} == expected
+    cached = get_translation_matrix(g2lpop, greek_to_latin, latin_features)
+    assert (cached != matrix).nnz == 0
+
+
 def test_greek_to_latin_texts_basis(g2lpop, mini_g2l_metadata, v3checker):
     texts = g2lpop.find(Text.collection,
                         title=[m['title'] for m in mini_g2l_metadata])
@@ -2,16 +2,29 @@ import uuid
 
 import pytest
 import numpy as np
+from bson.objectid import ObjectId
 
 from tesserae.db import Feature, Search, Text, \
-                        TessMongoConnection
+                        TessMongoConnection, Unit
 from tesserae.matchers.sparse_encoding import \
         SparseMatrixSearch, get_inverse_text_frequencies, \
-        get_corpus_frequencies, _get_units
+        get_corpus_frequencies, _get_units, _aggregate_units, \
+        _extract_features_and_positions, _bin_hits_to_unit_indices, \
+        gen_hits2positions, _get_distance_by_least_frequency, \
+        _get_distance_by_span, _get_distances_by_least_frequency, \
+        _get_distances_by_span, _MatchResultsBuilder, _map_source_blocks, \
+        _plan_source_blocks, \
+        _construct_unit_feature_matrix, _construct_feature_unit_matrix, \
+        _count_features_by_unit, _find_block_hits, _group_hits, \
+        _breaks_to_unit_inds, _match_sounds, _select_segments, _SoundIndex, \
+        UnitArrays, _ScoreThreshold, _get_score_bounds
+from tesserae.matchers import sparse_encoding
 from tesserae.matchers.text_options import TextOptions
 from tesserae.tokenizers import LatinTokenizer
 from tesserae.unitizer import Unitizer
 from tesserae.utils import ingest_text
+from tesserae.utils.calculations import get_feature_counts_by_text, \
+    get_sound_inverse_text_freq, increment_text_version
 from tesserae.utils.delete import obliterate
 from tesserae.utils.search import get_results, PageOptions
 from tesserae.utils.tessfile import TessFile
@@ -29,6 +42,375 @@ def punctpop(request, mini_punctuation_metadata):
     obliterate(conn)
 
 
+@pytest.fixture(scope='session')
+def numberspop(request, tessfiles_latin_path, mini_latin_metadata):
+    conn = TessMongoConnection('localhost', 27017, None, None, 'numberstess')
+    numbers_metadata = {
+        'title': 'numbers',
+        'author': 'augustine',
+        'language': 'latin',
+        'year': 426,
+        'path': str(tessfiles_latin_path.joinpath(
+            'test.numbers_in_latin.tess')),
+        'is_prose': True
+    }
+    for metadata in [numbers_metadata, mini_latin_metadata[0]]:
+        text = Text.json_decode(metadata)
+        ingest_text(conn, text)
+    yield conn
+    obliterate(conn)
+
+
+def test_get_units_cached(minipop, mini_latin_metadata):
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    textoptions = TextOptions(texts[0], 'line')
+    expected = _aggregate_units(minipop, textoptions, 'lemmata')
+    # first call populates the cache; second call reads from it
+    assert list(_get_units(minipop, textoptions, 'lemmata')) == expected
+    cached = _get_units(minipop, textoptions, 'lemmata')
+    assert list(cached) == expected
+    stoplist_set = {0, 1, 2}
+    for start, end in [(0, 3), (2, 7), (5, len(expected))]:
+        assert list(cached[start:end]) == expected[start:end]
+        for a, b in zip(
+                _extract_features_and_positions(cached[start:end],
+                                                stoplist_set),
+                _extract_features_and_positions(expected[start:end],
+                                                stoplist_set)):
+            assert np.array_equal(a, b)
+
+
+def test_get_units_text_version(minipop, mini_latin_metadata):
+    text = minipop.find(Text.collection,
+                        title=mini_latin_metadata[0]['title'])[0]
+    textoptions = TextOptions(text, 'line')
+    before = list(_get_units(minipop, textoptions, 'form'))
+    # change the units behind the local cache's back, as another host would
+    units_db = minipop.connection[Unit.collection]
+    first = units_db.find_one({'text': text.id, 'unit_type': 'line',
+                               'index': 0})
+    units_db.update_one({'_id': first['_id']},
+                        {'$set': {'snippet': 'changed'}})
+    try:
+        assert list(_get_units(minipop, textoptions, 'form')) == before
+        increment_text_version(minipop, text.id)
+        after = _get_units(minipop, textoptions, 'form')
+        assert after[0]['snippet'] == 'changed'
+    finally:
+        units_db.update_one({'_id': first['_id']},
+                            {'$set': {'snippet': first['snippet']}})
+        increment_text_version(minipop, text.id)
+
+
+def test_group_hits():
+    target_breaks = np.array([0, 2, 5])
+    source_breaks = np.array([0, 3, 4])
+    row2t_unit_ind = np.array([0, 0, 1, 1, 1])
+    rows = np.array([0, 1, 2, 0, 4, 3, 1])
+    cols = np.array([0, 2, 3, 3, 1, 0, 0])
+    t_inds, s_inds, hit_breaks, t_poses, s_poses = _group_hits(
+        rows, cols, row2t_unit_ind, _breaks_to_unit_inds(source_breaks),
+        target_breaks, source_breaks, 10)
+    # unit pairs with only one hit are dropped
+    assert np.array_equal(t_inds, [0, 1])
+    assert np.array_equal(s_inds, [10, 10])
+    assert np.array_equal(hit_breaks, [0, 3, 5])
+    # hits keep the order in which they were found
+    assert np.array_equal(t_poses, [0, 1, 1, 2, 1])
+    assert np.array_equal(s_poses, [0, 2, 0, 1, 0])
+
+
+def test_bin_hits_to_unit_indices():
+    target_breaks = np.array([0, 2, 5])
+    source_breaks = np.array([0, 3, 4])
+    row2t_unit_ind = np.array([0, 0, 1, 1, 1])
+    rows = np.array([0, 1, 2, 0, 4, 3, 1])
+    cols = np.array([0, 2, 3, 3, 1, 0, 0])
+    hits2positions = _bin_hits_to_unit_indices(rows, cols, row2t_unit_ind,
+                                               target_breaks, source_breaks,
+                                               10)
+    # unit pairs with only one hit are dropped
+    assert set(hits2positions.keys()) == {(0, 10), (1, 10)}
+    # hits keep the order in which they were found
+    assert np.array_equal(hits2positions[(0, 10)], [[0, 0], [1, 2], [1, 0]])
+    assert np.array_equal(hits2positions[(1, 10)], [[2, 1], [1, 0]])
+
+
+def test_gen_hits2positions(monkeypatch):
+    class _NoopConnection:
+        def update(self, entity, fields=None):
+            pass
+
+    rng = np.random.RandomState(3)
+    target_units = [{
+        'features': [
+            list(rng.choice(10, size=rng.randint(1, 3), replace=False))
+            for _ in range(rng.randint(1, 6))
+        ]
+    } for _ in range(20)]
+    source_units = target_units[::-1]
+    target_matrix, target_breaks = _construct_unit_feature_matrix(
+        target_units, set(), 10)
+    source_matrix, source_breaks = _construct_feature_unit_matrix(
+        source_units, set(), 10)
+    coo = target_matrix.dot(source_matrix).tocoo()
+    expected = _bin_hits_to_unit_indices(coo.row, coo.col,
+                                         _breaks_to_unit_inds(target_breaks),
+                                         target_breaks, source_breaks, 0)
+    # force several blocks of source units
+    monkeypatch.setattr(sparse_encoding, 'MATCH_MEMORY_BUDGET',
+                        20 * sparse_encoding._BYTES_PER_PRODUCT_NONZERO)
+    search = Search(results_id=uuid.uuid4())
+    search.add_new_stage('match and score')
+    found = {}
+    blocks = 0
+    for hits2positions in gen_hits2positions(search, _NoopConnection(),
+                                             target_matrix, target_breaks,
+                                             source_units, set(), 10):
+        found.update(hits2positions)
+        blocks += 1
+    assert blocks > 1
+    assert found.keys() == expected.keys()
+    for key, positions in expected.items():
+        assert np.array_equal(found[key], positions)
+
+
+def test_batched_distances():
+    rng = np.random.RandomState(42)
+    forms = rng.randint(0, 8, size=20)
+    inv_freqs = rng.randint(1, 5, size=8).astype(float)
+    get_inv_freq = lambda f: inv_freqs[f]
+    segments = [rng.randint(0, 20, size=rng.randint(1, 7)) for _ in range(200)]
+    hit_breaks = np.cumsum([0] + [len(s) for s in segments])
+    positions = np.concatenate(segments)
+    hit_forms = forms[positions]
+    freq_distances = _get_distances_by_least_frequency(
+        hit_breaks, positions, hit_forms, inv_freqs[hit_forms])
+    span_distances = _get_distances_by_span(hit_breaks, positions, hit_forms)
+    for i, seg in enumerate(segments):
+        assert freq_distances[i] == _get_distance_by_least_frequency(
+            get_inv_freq, seg, forms)
+        assert span_distances[i] == _get_distance_by_span(seg, forms)
+
+
+def test_match_results_select():
+    builder = _MatchResultsBuilder()
+    builder.add(0, 1, [4.0, 8.0], 3, np.array([0, 2]), np.array([1, 5]),
+                {7})
+    builder.add(2, 3, [1.0, 1.0, 1.0], 4, np.array([1, 3, 4]),
+                np.array([0, 1, 2]), {8, 9})
+    builder.add(4, 5, [30.0, 10.0], 2, np.array([5, 6]), np.array([3, 4]),
+                {10})
+    results = builder.build()
+    assert np.allclose(results.scores,
+                       np.log([12.0, 3.0, 40.0]) - np.log([3, 4, 2]))
+    kept = results.select(results.scores >= 1)
+    assert len(kept) == 2
+    assert np.array_equal(kept.target_inds, [0, 4])
+    assert np.array_equal(kept.source_inds, [1, 5])
+    assert np.array_equal(kept.highlight_breaks, [0, 2, 4])
+    assert np.array_equal(kept.target_positions, [0, 2, 5, 6])
+    assert np.array_equal(kept.source_positions, [1, 5, 3, 4])
+    assert np.array_equal(kept.feature_breaks, [0, 1, 2])
+    assert np.array_equal(kept.feature_inds, [7, 10])
+
+
+def test_match_results_to_blocks(monkeypatch):
+    monkeypatch.setattr(sparse_encoding, 'COMPACT_BLOCK_SIZE', 2)
+    builder = _MatchResultsBuilder()
+    builder.add(0, 1, [4.0, 8.0], 3, np.array([0, 2]), np.array([1, 5]),
+                {7})
+    builder.add(2, 3, [1.0, 1.0, 1.0], 4, np.array([1, 3, 4]),
+                np.array([0, 1, 2]), {8, 9})
+    builder.add(1, 0, [30.0, 10.0], 2, np.array([5, 6]), np.array([3, 4]),
+                {10})
+    results = builder.build()
+    units = [{'_id': ObjectId()} for _ in range(4)]
+    search_id = ObjectId()
+    blocks = results.to_blocks(search_id, 5, units, units, 'latin', 'form')
+    assert [b.index for b in blocks] == [5, 6]
+    assert [b.count for b in blocks] == [2, 1]
+    assert all(b.search_id == search_id for b in blocks)
+    assert np.array_equal(
+        np.concatenate([b.get_scores() for b in blocks]), results.scores)
+    last = blocks[1].get_columns()
+    assert bytes(last['source_unit_ids'][0]) == units[0]['_id'].binary
+    assert bytes(last['target_unit_ids'][0]) == units[1]['_id'].binary
+    assert np.array_equal(last['feature_breaks'], [0, 1])
+    assert np.array_equal(last['feature_inds'], [10])
+    assert np.array_equal(last['highlight_breaks'], [0, 2])
+    assert np.array_equal(last['target_positions'], [5, 6])
+    assert np.array_equal(last['source_positions'], [3, 4])
+
+
+def test_map_source_blocks_parallel():
+    class _NoopConnection:
+        def update(self, entity, fields=None):
+            pass
+
+    block_bounds = np.array([0, 3, 4, 10, 11, 20])
+    expected = list(zip(block_bounds[:-1], block_bounds[1:]))
+    for processes in [1, 3]:
+        search = Search(results_id=uuid.uuid4())
+        search.add_new_stage('match and score')
+        results = list(
+            _map_source_blocks([search], _NoopConnection(), block_bounds,
+                               lambda su_start, su_end: (su_start, su_end),
+                               processes))
+        assert results == expected
+
+
+def test_plan_source_blocks():
+    target_units = [
+        {'features': [[0], [1], [0, 2]]},
+        {'features': [[0], [3]]},
+    ]
+    # target positions with each feature: 0 -> 3, 1 -> 1, 2 -> 1, 3 -> 1
+    target_matrix, _ = _construct_unit_feature_matrix(target_units, set(), 5)
+    source_units = [
+        {'features': [[0], [1]]},
+        {'features': [[4]]},
+        {'features': [[0, 2], [0]]},
+        {'features': [[3]]},
+    ]
+    block_bounds, estimated_nnzs = _plan_source_blocks(
+        target_matrix, source_units, set(), 4)
+    # unit costs are 4, 0, 7, 1; a unit costing more than the limit gets a
+    # block of its own
+    assert np.array_equal(block_bounds, [0, 2, 3, 4])
+    assert np.array_equal(estimated_nnzs, [4, 7, 1])
+    block_bounds, _ = _plan_source_blocks(target_matrix, source_units,
+                                          set(), 100)
+    assert np.array_equal(block_bounds, [0, 4])
+
+
+def test_find_block_hits_prefilter():
+    rng = np.random.RandomState(7)
+
+    def _random_units(count):
+        return [{
+            'features': [
+                list(rng.choice(12, size=rng.randint(0, 3), replace=False))
+                for _ in range(rng.randint(0, 6))
+            ]
+        } for _ in range(count)]
+
+    target_units = _random_units(40)
+    source_units = _random_units(30)
+    stoplist_set = {3}
+    target_matrix, target_breaks = _construct_unit_feature_matrix(
+        target_units, stoplist_set, 12)
+    row2t_unit_ind = _breaks_to_unit_inds(target_breaks)
+    target_unit_matrix = _count_features_by_unit(target_matrix,
+                                                 row2t_unit_ind,
+                                                 len(target_units))
+    grouped, _ = _find_block_hits(target_matrix, target_breaks,
+                                  row2t_unit_ind, target_unit_matrix,
+                                  source_units, 10, 25, stoplist_set, 12)
+    # without the prefilter
+    source_matrix, source_breaks = _construct_feature_unit_matrix(
+        source_units[10:25], stoplist_set, 12)
+    coo = target_matrix.dot(source_matrix).tocoo()
+    expected = _group_hits(coo.row, coo.col, row2t_unit_ind,
+                           _breaks_to_unit_inds(source_breaks),
+                           target_breaks, source_breaks, 10)
+    assert len(grouped[0]) > 0
+    for result, answer in zip(grouped, expected):
+        assert np.array_equal(result, answer)
+
+
+def test_find_block_hits_upper_triangle():
+    rng = np.random.RandomState(11)
+    units = [{
+        'features': [
+            list(rng.choice(8, size=rng.randint(1, 3), replace=False))
+            for _ in range(rng.randint(1, 6))
+        ]
+    } for _ in range(40)]
+    matrix, breaks = _construct_unit_feature_matrix(units, set(), 8)
+    row2t_unit_ind = _breaks_to_unit_inds(breaks)
+    unit_matrix = _count_features_by_unit(matrix, row2t_unit_ind, len(units))
+    for su_start, su_end in [(0, 15), (10, 25), (30, 40)]:
+        full, _ = _find_block_hits(matrix, breaks, row2t_unit_ind,
+                                   unit_matrix, units, su_start, su_end,
+                                   set(), 8)
+        upper, _ = _find_block_hits(matrix, breaks, row2t_unit_ind,
+                                    unit_matrix, units, su_start, su_end,
+                                    set(), 8, upper_triangle=True)
+        t_inds, s_inds, hit_breaks, t_poses, s_poses = full
+        keep = np.flatnonzero(t_inds < s_inds)
+        kept_breaks, kept_hits = _select_segments(hit_breaks, keep)
+        assert len(upper[0]) > 0
+        assert np.array_equal(upper[0], t_inds[keep])
+        assert np.array_equal(upper[1], s_inds[keep])
+        assert np.array_equal(upper[2], kept_breaks)
+        assert np.array_equal(upper[3], t_poses[kept_hits])
+        assert np.array_equal(upper[4], s_poses[kept_hits])
+
+
+def test_unit_arrays_feature_matrix():
+    rng = np.random.RandomState(5)
+    units = [{
+        '_id': ObjectId(),
+        'index': i,
+        'forms': [0],
+        'features': [
+            list(rng.randint(-1, 8, size=rng.randint(0, 4)))
+            for _ in range(rng.randint(1, 6))
+        ],
+        'tags': [str(i)],
+        'snippet': ''
+    } for i in range(30)]
+    unit_arrays = UnitArrays.from_dicts(ObjectId(), units)
+    for stoplist_set in [set(), {0, 3}]:
+        for start, stop in [(0, 30), (4, 17)]:
+            expected, expected_breaks = _construct_unit_feature_matrix(
+                units[start:stop], stoplist_set, 8)
+            matrix, breaks = _construct_unit_feature_matrix(
+                unit_arrays[start:stop], stoplist_set, 8)
+            assert (matrix != expected).nnz == 0
+            assert np.array_equal(breaks, expected_breaks)
+            transposed, _ = _construct_feature_unit_matrix(
+                unit_arrays[start:stop], stoplist_set, 8)
+            assert (transposed != expected.T).nnz == 0
+    # masking a stoplist must leave the stored matrix intact
+    assert _construct_unit_feature_matrix(unit_arrays, set(), 8)[0].nnz == \
+        _construct_unit_feature_matrix(units, set(), 8)[0].nnz
+
+
+def test_match_sounds():
+    rng = np.random.RandomState(3)
+
+    def _random_sounds(count):
+        sounds = [list(rng.randint(-1, 10, size=rng.randint(0, 15)))
+                  for _ in range(count)]
+        breaks = np.cumsum([0] + [len(x) for x in sounds])
+        flat = np.array([x for unit in sounds for x in unit], dtype=np.int32)
+        return sounds, _SoundIndex(flat, breaks, -1, 11)
+
+    target_sounds, target_index = _random_sounds(20)
+    source_sounds, source_index = _random_sounds(20)
+    t_inds = rng.randint(0, 20, size=60)
+    s_inds = rng.randint(0, 20, size=60)
+    sound_breaks, t_positions, s_positions, matched_sounds = _match_sounds(
+        t_inds, s_inds, target_index, source_index)
+    for i, (t_ind, s_ind) in enumerate(zip(t_inds, s_inds)):
+        expected_t = []
+        expected_s = []
+        for target in target_sounds[t_ind]:
+            for source in source_sounds[s_ind]:
+                if target == source:
+                    expected_t.append(target_sounds[t_ind].index(target))
+                    expected_s.append(source_sounds[s_ind].index(source))
+        start, end = sound_breaks[i], sound_breaks[i + 1]
+        assert t_positions[start:end].tolist() == expected_t
+        assert s_positions[start:end].tolist() == expected_s
+        assert matched_sounds[start:end].tolist() == [
+            target_sounds[t_ind][p] for p in expected_t
+        ]
+
+
 def test_mini_latin_search_text_freqs(minipop, mini_latin_metadata, v3checker):
     texts = minipop.find(Text.collection,
                          title=[m['title'] for m in mini_latin_metadata])
@@ -54,6 +436,157 @@ def test_mini_latin_search_text_freqs(minipop, mini_latin_metadata, v3checker):
                                    'mini_latin_results.tab')
 
 
+def test_mini_latin_match_many(minipop, mini_latin_metadata):
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    params = {
+        'feature': 'lemmata',
+        'stopwords': ['et', 'neque', 'qui'],
+        'stopword_basis': 'texts',
+        'score_basis': 'lemmata',
+        'freq_basis': 'corpus',
+        'max_distance': 10,
+        'distance_basis': 'frequency',
+        'min_score': 0
+    }
+    matcher = SparseMatrixSearch(minipop)
+    targets = [texts[1], texts[0]]
+    searches = [Search(results_id=uuid.uuid4()) for _ in targets]
+    minipop.insert(searches)
+    many = matcher.match_many(searches, TextOptions(texts[0], 'line'),
+                              [TextOptions(t, 'line') for t in targets],
+                              **params)
+    assert len(many) == len(targets)
+    for search, target, matches in zip(searches, targets, many):
+        single_search = Search(results_id=uuid.uuid4())
+        minipop.insert(single_search)
+        single = matcher.match(single_search, TextOptions(texts[0], 'line'),
+                               TextOptions(target, 'line'), **params)
+        assert all(m.search_id == search.id for m in matches)
+        assert sorted((m.source_tag, m.target_tag, m.score)
+                      for m in matches) == sorted(
+                          (m.source_tag, m.target_tag, m.score)
+                          for m in single)
+
+
+def test_mini_latin_match_batches(minipop, mini_latin_metadata):
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    params = {
+        'feature': 'lemmata',
+        'stopwords': ['et', 'neque', 'qui'],
+        'stopword_basis': 'texts',
+        'score_basis': 'lemmata',
+        'freq_basis': 'texts',
+        'max_distance': 10,
+        'distance_basis': 'frequency',
+        'min_score': 0
+    }
+    matcher = SparseMatrixSearch(minipop)
+    search = Search(results_id=uuid.uuid4())
+    minipop.insert(search)
+    batches = list(
+        matcher.match_batches(search, TextOptions(texts[0], 'line'),
+                              TextOptions(texts[1], 'line'),
+                              memory_budget=1,
+                              **params))
+    assert len(batches) == len(search.match_stats['block_sizes'])
+    single = matcher.match(search, TextOptions(texts[0], 'line'),
+                           TextOptions(texts[1], 'line'), **params)
+    assert [(m.source_tag, m.target_tag, m.score)
+            for batch in batches for m in batch] == [
+                (m.source_tag, m.target_tag, m.score) for m in single
+            ]
+
+
+def test_mini_latin_match_sweep(minipop, mini_latin_metadata):
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    params = {
+        'stopwords': ['et', 'neque', 'qui'],
+        'stopword_basis': 'texts',
+        'score_basis': 'lemmata',
+        'freq_basis': 'texts'
+    }
+    scorings = [{
+        'max_distance': 10,
+        'distance_basis': 'frequency',
+        'min_score': 0
+    }, {
+        'max_distance': 5,
+        'distance_basis': 'span',
+        'min_score': 0
+    }, {
+        'max_distance': 999,
+        'distance_basis': 'frequency',
+        'min_score': 4
+    }]
+    matcher = SparseMatrixSearch(minipop)
+    searches = [Search(results_id=uuid.uuid4()) for _ in scorings]
+    minipop.insert(searches)
+    swept = matcher.match_sweep(searches, TextOptions(texts[0], 'line'),
+                                TextOptions(texts[1], 'line'), 'lemmata',
+                                scorings, **params)
+    assert len(swept) == len(scorings)
+    for search, scoring, matches in zip(searches, scorings, swept):
+        single_search = Search(results_id=uuid.uuid4())
+        minipop.insert(single_search)
+        single = matcher.match(single_search, TextOptions(texts[0], 'line'),
+                               TextOptions(texts[1], 'line'), 'lemmata',
+                               **params, **scoring)
+        assert all(m.search_id == search.id for m in matches)
+        assert [(m.source_tag, m.target_tag, m.score) for m in matches] == [
+            (m.source_tag, m.target_tag, m.score) for m in single
+        ]
+
+
+def test_mini_latin_match_top_k(minipop, mini_latin_metadata):
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    params = {
+        'stopwords': ['et', 'neque', 'qui'],
+        'stopword_basis': 'texts',
+        'score_basis': 'lemmata',
+        'freq_basis': 'texts',
+        'max_distance': 10,
+        'distance_basis': 'frequency',
+        'min_score': 0
+    }
+    matcher = SparseMatrixSearch(minipop)
+    search = Search(results_id=uuid.uuid4())
+    minipop.insert(search)
+    full = matcher.match(search, TextOptions(texts[0], 'line'),
+                         TextOptions(texts[1], 'line'), 'lemmata', **params)
+    expected = sorted(full, key=lambda m: -m.score)
+    for top_k in [1, 3, len(full) + 1]:
+        top_search = Search(results_id=uuid.uuid4())
+        minipop.insert(top_search)
+        top = matcher.match(top_search, TextOptions(texts[0], 'line'),
+                            TextOptions(texts[1], 'line'), 'lemmata',
+                            top_k=top_k, **params)
+        assert [(m.source_tag, m.target_tag, m.score) for m in top] == [
+            (m.source_tag, m.target_tag, m.score)
+            for m in expected[:top_k]
+        ]
+    with pytest.raises(ValueError):
+        matcher.match(search, TextOptions(texts[0], 'line'),
+                      TextOptions(texts[1], 'line'), 'lemmata', top_k=0,
+                      **params)
+
+
+def test_score_threshold():
+    threshold = _ScoreThreshold({'min_score': 1, 'top_k': 2})
+    assert not threshold.admits(0.5)
+    assert threshold.admits(1)
+    for score in [3, 0.5, 2, 5]:
+        threshold.record(score)
+    assert threshold.admits(3)
+    assert not threshold.admits(2.5)
+    bounds = _get_score_bounds(np.array([0, 2, 3]), np.array([1., 2., 4.]),
+                               np.array([1., 1., 4.]), np.array([2, 4]))
+    assert np.allclose(bounds, [np.log(5 / 2), np.log(8 / 4)])
+
+
 def test_mini_greek_search_text_freqs(minipop, mini_greek_metadata, v3checker):
     texts = minipop.find(Text.collection,
                          title=[m['title'] for m in mini_greek_metadata])
@@ -165,6 +698,34 @@ def test_mini_punctuation(punctpop, mini_punctuation_metadata):
     # the point of this test is to make sure no Exception is thrown
 
 
+def test_numbers_text_freqs(numberspop):
+    numbers = numberspop.find(Text.collection, title='numbers')[0]
+    other = numberspop.find(Text.collection, title='miniaeneid')[0]
+    for feature in ('form', 'lemmata'):
+        counts = get_feature_counts_by_text(numberspop, feature, numbers)
+        assert np.all(counts >= 0)
+        inv_freqs = get_inverse_text_frequencies(numberspop, feature,
+                                                 numbers.id)
+        assert np.all(np.isfinite(inv_freqs))
+    assert np.all(np.isfinite(
+        get_sound_inverse_text_freq(numberspop, numbers.id)))
+    search_result = Search(results_id=uuid.uuid4())
+    numberspop.insert(search_result)
+    matcher = SparseMatrixSearch(numberspop)
+    v5_matches = matcher.match(search_result,
+                               TextOptions(numbers, 'phrase'),
+                               TextOptions(other, 'line'),
+                               'lemmata',
+                               stopwords=10,
+                               stopword_basis='texts',
+                               score_basis='lemmata',
+                               freq_basis='texts',
+                               max_distance=10,
+                               distance_basis='frequency',
+                               min_score=0)
+    assert len(v5_matches) > 0
+
+
 def test_latin_sound(minipop, mini_latin_metadata, v3checker):
     texts = minipop.find(Text.collection,
                          title=[m['title'] for m in mini_latin_metadata])
@@ -0,0 +1,59 @@
+from bson.objectid import ObjectId
+import numpy as np
+
+from tesserae.utils.cache import \
+    clear_all, clear_prefix, clear_text, load_arrays, save_arrays
+
+
+def test_roundtrip():
+    text_id = ObjectId()
+    key = f'{str(text_id)}_line_lemmata'
+    assert load_arrays('test', key) is None
+    arrays = {'a': np.arange(5), 'b': np.array([[1, 2], [3, 4]])}
+    save_arrays('test', key, arrays)
+    loaded = load_arrays('test', key)
+    assert set(loaded) == set(arrays)
+    for name, values in arrays.items():
+        assert np.array_equal(values, loaded[name])
+
+
+def test_versions():
+    key = f'{str(ObjectId())}_line_lemmata'
+    save_arrays('test', key, {'a': np.arange(3)}, 2)
+    assert load_arrays('test', key, 1) is None
+    loaded = load_arrays('test', key, 2)
+    assert set(loaded) == {'a'}
+    assert np.array_equal(loaded['a'], np.arange(3))
+    # arrays saved without a version never match one
+    save_arrays('test', key, {'a': np.arange(3)})
+    assert load_arrays('test', key, 0) is None
+    assert load_arrays('test', key) is not None
+
+
+def test_clear_text():
+    text_id = ObjectId()
+    other_id = ObjectId()
+    save_arrays('test', f'{str(text_id)}_line_lemmata', {'a': np.arange(2)})
+    save_arrays('test', f'{str(text_id)}_line_form', {'a': np.arange(2)})
+    save_arrays('test', f'{str(other_id)}_line_form', {'a': np.arange(2)})
+    clear_text(text_id, 'lemmata')
+    assert load_arrays('test', f'{str(text_id)}_line_lemmata') is None
+    assert load_arrays('test', f'{str(text_id)}_line_form') is not None
+    clear_text(text_id)
+    assert load_arrays('test', f'{str(text_id)}_line_form') is None
+    assert load_arrays('test', f'{str(other_id)}_line_form') is not None
+    clear_all()
+    assert load_arrays('test', f'{str(other_id)}_line_form') is None
+
+
+def test_clear_prefix():
+    for key in ['synonyms_3', 'synonyms_5', 'synonyms_7', 'other_3']:
+        save_arrays('test', key, {'a': np.arange(2)})
+    clear_prefix('test', 'synonyms_', keep='synonyms_7')
+    assert load_arrays('test', 'synonyms_3') is None
+    assert load_arrays('test', 'synonyms_5') is None
+    assert load_arrays('test', 'synonyms_7') is not None
+    assert load_arrays('test', 'other_3') is not None
+    clear_prefix('test', '')
+    assert load_arrays('test', 'synonyms_7') is None
+    assert load_arrays('test', 'other_3') is None
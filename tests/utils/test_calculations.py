@@ -1,10 +1,15 @@
 import itertools
 import math
 
+import numpy as np
+
 from tesserae.db.entities import Feature, Text
+from tesserae.utils import cache
+from tesserae.utils.cache import clear_text, save_arrays
 from tesserae.utils.calculations import \
-    get_corpus_frequencies, get_feature_counts_by_text, \
-    get_inverse_text_frequencies
+    INV_TEXT_FREQS_KIND, get_corpus_frequencies, get_feature_counts_by_text, \
+    get_inverse_text_frequencies, get_corpus_counts, get_text_version, \
+    increment_text_version, update_corpus_counts
 
 
 def _load_v3_mini_text_counts(conn, text, v3checker):
@@ -16,13 +21,13 @@ def test_mini_get_feature_counts_by_text(minipop, v3checker):
     for text in minipop.find(Text.collection):
         v5_counts = get_feature_counts_by_text(minipop, 'form', text)
         v3_counts = _load_v3_mini_text_counts(minipop, text, v3checker)
-        in_v5 = set(v5_counts.keys())
+        in_v5 = set(np.flatnonzero(v5_counts).tolist())
         in_v3 = set(v3_counts.keys())
         assert len(in_v5) == len(in_v3)
         assert len(in_v5 - in_v3) == 0
         assert len(in_v3 - in_v5) == 0
-        for feature_index, v5_count in v5_counts.items():
-            assert v5_count == v3_counts[feature_index]
+        for feature_index in in_v5:
+            assert v5_counts[feature_index] == v3_counts[feature_index]
 
 
 def _load_v3_mini_text_stem_freqs(conn, text, v3checker):
@@ -42,9 +47,10 @@ def test_mini_text_frequencies(
         )
         text_id = title2id[metadata['title']]
         v5freqs = get_inverse_text_frequencies(minipop, 'lemmata', text_id)
-        for form_index, freq in v5freqs.items():
+        for form_index in np.flatnonzero(v5freqs).tolist():
             assert form_index in v3freqs
-            assert math.isclose(v3freqs[form_index], 1.0 / freq)
+            assert math.isclose(v3freqs[form_index],
+                                1.0 / v5freqs[form_index])
 
 
 def _load_v3_mini_corpus_stem_freqs(conn, language, lang_path):
@@ -85,3 +91,68 @@ def test_mini_corpus_frequencies(
             assert form_index in v3freqs
             assert math.isclose(v3freqs[form_index], freq), \
                 f'Mismatch on {index2token[form_index]} ({form_index})'
+
+
+def test_mini_corpus_counts(minipop):
+    for lang in ['greek', 'latin']:
+        counts, version = get_corpus_counts(minipop, 'lemmata', lang)
+        for f in minipop.find(Feature.collection, feature='lemmata',
+                              language=lang):
+            assert counts[f.index] == sum(f.frequencies.values())
+        update_corpus_counts(minipop, lang, ['lemmata'])
+        updated, updated_version = get_corpus_counts(minipop, 'lemmata', lang)
+        assert updated_version != version
+        assert (updated == counts).all()
+
+
+def test_mini_corpus_counts_other_host(minipop, tmp_path, monkeypatch):
+    counts, version = get_corpus_counts(minipop, 'lemmata', 'latin')
+    feature = minipop.find(Feature.collection, feature='lemmata',
+                           language='latin', index=0)[0]
+    features = minipop.connection[Feature.collection]
+    features.update_one({'_id': feature.id},
+                        {'$set': {'frequencies.other': 5}})
+    try:
+        # another host, with a local cache of its own, updates the counts
+        with monkeypatch.context() as m:
+            m.setattr(cache, 'CACHE_DIR', str(tmp_path))
+            update_corpus_counts(minipop, 'latin', ['lemmata'])
+        updated, updated_version = get_corpus_counts(minipop, 'lemmata',
+                                                     'latin')
+        assert updated_version != version
+        assert updated[0] == counts[0] + 5
+    finally:
+        features.update_one({'_id': feature.id},
+                            {'$unset': {'frequencies.other': ''}})
+        update_corpus_counts(minipop, 'latin', ['lemmata'])
+
+
+def test_mini_text_tables_cached(minipop):
+    for text in minipop.find(Text.collection):
+        computed = get_inverse_text_frequencies(minipop, 'lemmata', text.id)
+        assert np.array_equal(
+            get_inverse_text_frequencies(minipop, 'lemmata', text.id),
+            computed)
+        counts = get_feature_counts_by_text(minipop, 'form', text)
+        assert np.array_equal(
+            get_feature_counts_by_text(minipop, 'form', text), counts)
+        clear_text(text.id, 'lemmata')
+        assert np.array_equal(
+            get_inverse_text_frequencies(minipop, 'lemmata', text.id),
+            computed)
+
+
+def test_mini_text_tables_text_version(minipop):
+    text = minipop.find(Text.collection, language='latin')[0]
+    computed = get_inverse_text_frequencies(minipop, 'lemmata', text.id)
+    # tables cached for the current version of the text are served as is
+    key = f'{str(text.id)}_lemmata'
+    save_arrays(INV_TEXT_FREQS_KIND, key, {'values': np.zeros(3)},
+                get_text_version(minipop, text.id))
+    assert np.array_equal(
+        get_inverse_text_frequencies(minipop, 'lemmata', text.id),
+        np.zeros(3))
+    # once the text changes on any host, they are computed again
+    increment_text_version(minipop, text.id)
+    assert np.array_equal(
+        get_inverse_text_frequencies(minipop, 'lemmata', text.id), computed)
@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from tesserae.db.entities import Search
+from tesserae.utils.progress import ProgressReporter
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.updates = []
+        self.written = threading.Event()
+
+    def update(self, entity, fields=None):
+        self.updates.append(
+            ([e.progress[-1]['value'] for e in entity], fields))
+        self.written.set()
+
+
+def test_progress_reporter_coalesces():
+    conn = RecordingConnection()
+    searches = [Search(), Search()]
+    with ProgressReporter(conn, searches, interval=60) as progress:
+        for i in range(100):
+            progress.report(i / 100)
+        # nothing is written until the interval passes
+        assert conn.updates == []
+    assert conn.updates == [([0.99, 0.99], ['progress'])]
+    assert all(s.progress[-1]['value'] == 0.99 for s in searches)
+
+
+def test_progress_reporter_background():
+    conn = RecordingConnection()
+    search = Search()
+    with ProgressReporter(conn, [search], interval=0.01) as progress:
+        progress.report(0.5)
+        assert conn.written.wait(5)
+        assert conn.updates == [([0.5], ['progress'])]
+    # no new progress was reported before closing
+    assert conn.updates == [([0.5], ['progress'])]
+
+
+def test_progress_reporter_nothing_reported():
+    conn = RecordingConnection()
+    with ProgressReporter(conn, [Search()], interval=0.01):
+        pass
+    assert conn.updates == []
+
+
+class FailingConnection:
+    def update(self, entity, fields=None):
+        raise ConnectionError('database unreachable')
+
+
+def test_progress_reporter_write_error():
+    search = Search()
+    with pytest.raises(KeyError):
+        with ProgressReporter(FailingConnection(), [search],
+                              interval=60) as progress:
+            progress.report(0.5)
+            raise KeyError('stage failed')
+    progress = ProgressReporter(FailingConnection(), [search], interval=60)
+    with progress:
+        progress.report(0.75)
+    assert 'database unreachable' in progress.error
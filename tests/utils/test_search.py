@@ -1,11 +1,17 @@
 import pytest
+import multiprocessing
 import random
 import string
+import threading
 import uuid
 
 from tesserae.db import TessMongoConnection
-from tesserae.db.entities import Search, Match
-from tesserae.utils.search import get_results, NORMAL_SEARCH, PageOptions
+from tesserae.db.entities import Search, Match, Text
+import tesserae.matchers.sparse_encoding
+from tesserae.matchers.sparse_encoding import SparseMatrixSearch
+from tesserae.matchers.text_options import TextOptions
+from tesserae.utils.search import get_results, NORMAL_SEARCH, PageOptions, \
+    _MatchWriter, _run_search
 
 
 def _create_random_word():
@@ -77,6 +83,13 @@ def test_get_results_dump(resultsdb):
     _assert_equivalent_results(got_results, true_results)
 
 
+def test_get_results_dump_score_order(resultsdb):
+    search = resultsdb.find(Search.collection)[0]
+    got_results = get_results(resultsdb, search.id, PageOptions())
+    scores = [r['score'] for r in got_results]
+    assert scores == sorted(scores, reverse=True)
+
+
 def test_get_results_sort_score(resultsdb):
     search = resultsdb.find(Search.collection)[0]
     page_options = PageOptions(
@@ -211,3 +224,47 @@ def test_get_results_sort_matched_features(resultsdb):
     true_results.sort(key=lambda x: x.matched_features, reverse=False)
     _assert_equivalent_results(got_results, true_results[40:60])
     page_options.sort_order = 1
+
+
+def test_run_search_processes(minipop, mini_latin_metadata, monkeypatch):
+    texts = minipop.find(Text.collection,
+                         title=[m['title'] for m in mini_latin_metadata])
+    # the MatchWriter threads running whenever workers are forked
+    writers_at_fork = []
+
+    def _get_context(method):
+        writers_at_fork.append([
+            t for t in threading.enumerate() if isinstance(t, _MatchWriter)
+        ])
+        return multiprocessing.get_context(method)
+
+    monkeypatch.setattr(tesserae.matchers.sparse_encoding.multiprocessing,
+                        'get_context', _get_context)
+    found = []
+    for processes in [1, 3]:
+        search = Search(results_id=uuid.uuid4().hex,
+                        search_type=NORMAL_SEARCH)
+        minipop.insert(search)
+        _run_search(
+            minipop, search, SparseMatrixSearch.matcher_type, {
+                'source': TextOptions(texts[0], 'line'),
+                'target': TextOptions(texts[1], 'line'),
+                'feature': 'lemmata',
+                'stopwords': ['et', 'neque', 'qui'],
+                'stopword_basis': 'texts',
+                'score_basis': 'lemmata',
+                'freq_basis': 'texts',
+                'max_distance': 10,
+                'distance_basis': 'frequency',
+                'min_score': 0,
+                'processes': processes,
+                'memory_budget': 1
+            })
+        search = minipop.find(Search.collection, _id=search.id)[0]
+        assert search.status == Search.DONE
+        found.append(
+            sorted((m['source_tag'], m['target_tag'], m['score'])
+                   for m in get_results(minipop, search.id, PageOptions())))
+    assert found[0] and found[0] == found[1]
+    # workers were forked, and not while the writer thread was running
+    assert writers_at_fork == [[]]
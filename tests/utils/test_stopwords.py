@@ -0,0 +1,62 @@
+import numpy as np
+
+from tesserae.db.entities import Feature, Text
+from tesserae.utils.calculations import get_corpus_counts, \
+    update_corpus_counts
+from tesserae.utils import stopwords
+from tesserae.utils.stopwords import RANKINGS_COLLECTION, create_stoplist
+
+
+def _get_frequencies(conn, language, text_ids=None):
+    return {
+        f.index: sum(count for t_id, count in f.frequencies.items()
+                     if text_ids is None or t_id in text_ids)
+        for f in conn.find(Feature.collection,
+                           feature='lemmata',
+                           language=language)
+    }
+
+
+def test_create_stoplist_corpus(minipop):
+    for lang in ['greek', 'latin']:
+        frequencies = _get_frequencies(minipop, lang)
+        stoplist = create_stoplist(minipop, 10, 'lemmata', lang)
+        assert stoplist.dtype == np.uint32
+        assert [frequencies[i] for i in stoplist] == \
+            sorted(frequencies.values(), reverse=True)[:10]
+        assert np.array_equal(create_stoplist(minipop, 4, 'lemmata', lang),
+                              stoplist[:4])
+        # a new corpus version must give the same stoplist
+        update_corpus_counts(minipop, lang, ['lemmata'])
+        assert np.array_equal(create_stoplist(minipop, 10, 'lemmata', lang),
+                              stoplist)
+
+
+def test_create_stoplist_texts(minipop):
+    texts = minipop.find(Text.collection, language='latin')
+    frequencies = _get_frequencies(minipop, 'latin',
+                                   {str(t.id) for t in texts})
+    stoplist = create_stoplist(minipop, 10, 'lemmata', 'latin', basis=texts)
+    assert [frequencies[i] for i in stoplist] == \
+        sorted(frequencies.values(), reverse=True)[:10]
+    assert np.array_equal(
+        create_stoplist(minipop, 10, 'lemmata', 'latin',
+                        basis=[t.id for t in reversed(texts)]), stoplist)
+    # rankings are stored in the database with the corpus version
+    _, version = get_corpus_counts(minipop, 'lemmata', 'latin')
+    rankings_db = minipop.connection[RANKINGS_COLLECTION]
+    stored = rankings_db.find_one({'texts': sorted(str(t.id) for t in texts)})
+    assert stored['corpus_version'] == version
+    # another process finds the stored ranking
+    stopwords._RANKINGS.clear()
+    assert np.array_equal(
+        create_stoplist(minipop, 10, 'lemmata', 'latin', basis=texts),
+        stoplist)
+    # rankings of older corpus versions are removed
+    update_corpus_counts(minipop, 'latin', ['lemmata'])
+    create_stoplist(minipop, 10, 'lemmata', 'latin', basis=texts[:1])
+    assert rankings_db.count_documents({
+        'language': 'latin',
+        'feature': 'lemmata',
+        'corpus_version': {'$lt': version + 1}
+    }) == 0